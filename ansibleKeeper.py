@@ -9,11 +9,33 @@ __maintainer__ = "Jan Kogut"
 __status__     = "Beta"
 
 
+import os
+import sys
 import json
 import toml
+import zlib
+import shutil
+import mmap
+import fcntl
+import bisect
+import struct
+import fnmatch
+import functools
+import itertools
+import socket
+import time
+import signal
+import uuid
+import tempfile
+import threading
+import socketserver
 import configparser
+from collections import deque
+from urllib.parse import quote
 from optparse import OptionParser,OptionGroup
 from kazoo.client import KazooClient
+from kazoo.recipe.cache import TreeCache, TreeEvent
+from kazoo.exceptions import NoNodeError, RolledBackError, BadVersionError, KazooException
 
 
 
@@ -29,6 +51,33 @@ cfg = OurConfig()
 
 cfg.zkServers  = 'con1:2181,con2:2181,con3:2181'
 cfg.aPath      = '/ansible-test'
+cfg.zkSessionTimeout  = 10.0  ## zookeeper session timeout in seconds
+cfg.zkConnectTimeout  = 15.0  ## max seconds to wait for the first connection
+cfg.zkConnectionRetry = {'max_tries': 3, 'delay': 0.5, 'backoff': 2, 'max_delay': 10}  ## kazoo KazooRetry kwargs
+cfg.zkCommandRetry    = None  ## kazoo KazooRetry kwargs of zk.retry() for library callers (None: kazoo default), plain requests are never retried
+cfg.fetchWindow = 512    ## max number of async zookeeper requests kept in flight
+cfg.zkObservers = ''     ## comma separated observers (host:port) read by fanout reads besides cfg.zkServers
+cfg.readFanout  = 0      ## read-only sessions to the closest servers sharing inventory reads, 0 disables fanout
+cfg.fanoutProbeTimeout = 1.0  ## max seconds to wait for TCP connect when measuring server latency
+cfg.fanoutRetries = 3   ## fanout reads repeated while sessions end at different inventory states, then one session is read
+cfg.cacheFile   = os.path.expanduser('~/.cache/ansible-keeper/inventory.json')  ## None disables the cache
+cfg.hostStoreFile = os.path.expanduser('~/.cache/ansible-keeper/hosts-{}.akb')  ## --host lookup store ({} is a hash of zkServers and aPath), None disables it
+cfg.hostStoreTtl  = 30.0  ## seconds --host trusts lookup store without asking zookeeper if it is still valid
+cfg.valueCompressMin = 4096  ## compress stored hostvar values (v1) and packed hostvars (v2) larger than this (None disables)
+cfg.valueChunkBytes  = 256 * 1024  ## split stored values larger than this into chunk znodes, keep below cfg.txnMaxBytes
+cfg.indexValueMax   = 256   ## hostvar values longer than this are left out of value indexes (see --index-var)
+cfg.migrateBatch    = 100   ## hosts converted per transaction by --migrate-layout
+cfg.importBatch     = 1000  ## hosts read from file and planned at once by --import-bin
+cfg.writeRetries    = 5     ## attempts of a write racing with concurrent writers (at least one is made)
+cfg.txnMaxOps       = 1000  ## max operations in one zookeeper transaction
+cfg.txnMaxBytes     = 512 * 1024  ## max estimated size of one transaction, keep below jute.maxbuffer (1 MB default)
+cfg.useSnapshot     = True  ## -I ansible reads {aPath}/snapshot when it is not stale
+cfg.inventoryGroups = os.environ.get('ANSIBLE_KEEPER_GROUPS')  ## comma separated groups -I ansible is narrowed to (see --groups)
+cfg.snapshotOnWrite = False ## rebuild {aPath}/snapshot after every write instead of leaving it stale
+cfg.snapshotChunkBytes = 256 * 1024  ## max size of one snapshot chunk znode
+cfg.serveSocket     = os.environ.get('ANSIBLE_KEEPER_SOCKET',
+                                     os.path.expanduser('~/.cache/ansible-keeper/serve.sock'))  ## --serve unix socket
+cfg.serveDebounce   = 0.2   ## --serve: seconds of quiet after a change before -I ansible response is rendered again
 
 #################################################
 ## END of config section 
@@ -50,19 +99,67 @@ def oParser():
     parser.add_option("-D", nargs = 1,
                       help="delete host or group recursively: groupname1:hostname1 or groupname1 or hosts:hostname1")
     parser.add_option("-U", nargs = 1,
-                      help="update host variables with comma separated hostvars: groupname1:hostname1,var1:newvalue1,var2:newvalue2")
+                      help="update host variables with comma separated hostvars: groupname1:hostname1,var1:newvalue1,var2:newvalue2 (hostname1 may be a glob: groupname1:* or hosts:web*)")
+    parser.add_option("--create-missing", action="store_true", default=False,
+                      help="create hostvars given to: -U (on the commandline and in --batch) which do not exist instead of reporting them NOT UPDATED")
     parser.add_option("-R", nargs = 1,
                       help="rename existing hostname or groupname: groups:oldgroupname:newgroupname or hosts:oldhostname:newhostname")
     parser.add_option("-S", nargs = 1,
                       help="show host variables for a given host or group: groupname1:hostname1 or groupname1")
+    parser.add_option("--group-vars", nargs = 1,
+                      help="set group vars with comma separated vars: groupname1,var1:value1,var2:value2")
+    parser.add_option("--add-child", nargs = 1,
+                      help="add child group to parent group: parentgroupname:childgroupname")
+    parser.add_option("--del-child", nargs = 1,
+                      help="remove child group from parent group: parentgroupname:childgroupname")
     parser.add_option("-I", nargs = 1,
                       help="inventory mode: groups|all|ansible dumps inventory in json format from zookeeper")
     parser.add_option("--host", nargs = 1,
                       help="ansible compliant option for hostvars access: --host hostname")
+    parser.add_option("--effective", action="store_true", default=False,
+                      help="merge vars of the host's groups and their parent groups into: --host hostvars")
+    parser.add_option("--fanout", nargs = 1, type="int",
+                      help="spread reads of: -I ansible|all, -S over sessions to a given number of closest servers")
+    parser.add_option("--no-cache", action="store_true", default=False,
+                      help="bypass local inventory cache for: -I ansible and --host lookup store")
+    parser.add_option("--groups", nargs = 1,
+                      help="narrow -I ansible to hosts of comma separated groups and their child groups (ANSIBLE_KEEPER_GROUPS)")
     parser.add_option("--import-toml", nargs=1, help="import inventory from TOML file")
     parser.add_option("--export-toml", nargs=1, help="export inventory to TOML file")
     parser.add_option("--import-ini", nargs=1, help="import inventory from INI file")
+    parser.add_option("--sync-toml", nargs=1, help="make inventory match TOML file (deletes what is not in it)")
+    parser.add_option("--sync-ini", nargs=1, help="make inventory match INI file (deletes what is not in it)")
     parser.add_option("--export-ini", nargs=1, help="export inventory to INI file")
+    parser.add_option("--export-bin", nargs=1, help="export inventory to binary file (backup, offline --host and -S)")
+    parser.add_option("--import-bin", nargs=1, help="import inventory from binary file written by --export-bin")
+    parser.add_option("--from-bin", nargs=1,
+                      help="answer --host and -S from binary file written by --export-bin instead of zookeeper")
+    parser.add_option("--serve", action="store_true", default=False,
+                      help="serve -I ansible|all|groups|hosts, --host and -S requests from memory on a unix socket")
+    parser.add_option("--rebuild-snapshot", action="store_true", default=False,
+                      help="rebuild inventory snapshot znode read by: -I ansible")
+    parser.add_option("--rebuild-index", action="store_true", default=False,
+                      help="rebuild host-groups index used by: -R hosts:... and -D hosts:..., group tree and hostvar value indexes")
+    parser.add_option("--index-var", nargs=1,
+                      help="index values of comma separated hostvars for: -Q (rebuilt by --rebuild-index)")
+    parser.add_option("-Q", nargs = 1,
+                      help="query hosts by indexed hostvar value: var=value or var~prefix")
+    parser.add_option("--batch", nargs=1,
+                      help="run -A|-G|-D|-U|-R operations from file (- for stdin), one per line: -A groupname1:hostname1,var1:value1")
+    parser.add_option("--export-delta", nargs=1,
+                      help="print JSON changeset of hosts, hostvars and groups changed after a given zxid (0 for all)")
+    parser.add_option("--apply-delta", nargs=1,
+                      help="apply JSON changeset written by --export-delta from file (- for stdin)")
+    parser.add_option("--stats", action="store_true", default=False,
+                      help="print zookeeper request counts, latencies and bytes per command and value codec statistics to stderr")
+    parser.add_option("--stats-file", nargs=1,
+                      help="add zookeeper request metrics to counters in Prometheus textfile (node_exporter textfile collector)")
+    parser.add_option("--force", action="store_true", default=False,
+                      help="let: --sync-toml|--sync-ini apply a file without hosts and groups, deleting the whole inventory")
+    parser.add_option("--dry-run", action="store_true", default=False,
+                      help="only report operations planned by: --import-toml|--import-ini|--import-bin|--sync-toml|--sync-ini|--batch|--apply-delta")
+    parser.add_option("--migrate-layout", nargs=1,
+                      help="convert hostvars storage layout, readers keep working, stop writers first: v1 (znode per hostvar) or v2 (packed znode per host)")
 
     group = OptionGroup(parser, "Example usage",
                         "ansibleKeeper.py -A flink:flink-master01,lan_ip:10.1.1.1")
@@ -72,42 +169,620 @@ def oParser():
     (opts, args) = parser.parse_args()
     
     
-    if (opts.A or opts.G or opts.D or opts.U or opts.R or opts.S or opts.I or opts.host or opts.import_toml or opts.export_toml or opts.import_ini or opts.export_ini) == None:
+    ## options running a command, the rest only modify how commands run
+    modes = (opts.A, opts.G, opts.D, opts.U, opts.R, opts.S, opts.I, opts.host, opts.group_vars, opts.add_child,
+             opts.del_child, opts.Q, opts.index_var, opts.batch, opts.import_toml, opts.export_toml, opts.import_ini,
+             opts.export_ini, opts.sync_toml, opts.sync_ini, opts.import_bin, opts.export_bin, opts.export_delta,
+             opts.apply_delta, opts.migrate_layout, opts.serve, opts.rebuild_snapshot, opts.rebuild_index)
 
+    if not any(modes):
         parser.print_help()
         exit(-1)
-        
+
+    if opts.from_bin is not None and not (opts.host or opts.S):
+        parser.error("--from-bin answers only: --host and -S")
+
+    if opts.groups is not None and opts.I != 'ansible':
+        parser.error("--groups narrows only: -I ansible")
+
     return {'addMode':opts.A, 'groupMode':opts.G, 'deleteMode':opts.D, 'updateMode':opts.U,
             'renameMode':opts.R, 'showMode':opts.S, 'inventoryMode':opts.I, 'ansibleHost':opts.host,
             'importToml': opts.import_toml, 'exportToml': opts.export_toml,
-            'importIni': opts.import_ini, 'exportIni': opts.export_ini}
+            'importIni': opts.import_ini, 'exportIni': opts.export_ini, 'noCache': opts.no_cache,
+            'migrateLayout': opts.migrate_layout, 'dryRun': opts.dry_run,
+            'serveMode': opts.serve, 'rebuildSnapshot': opts.rebuild_snapshot,
+            'rebuildIndex': opts.rebuild_index, 'batchFile': opts.batch,
+            'showStats': opts.stats, 'groupVarsMode': opts.group_vars,
+            'addChildMode': opts.add_child, 'delChildMode': opts.del_child,
+            'exportDelta': opts.export_delta, 'applyDelta': opts.apply_delta,
+            'readFanout': opts.fanout, 'indexVars': opts.index_var, 'queryMode': opts.Q,
+            'statsFile': opts.stats_file, 'syncToml': opts.sync_toml, 'syncIni': opts.sync_ini,
+            'inventoryGroups': opts.groups, 'exportBin': opts.export_bin,
+            'importBin': opts.import_bin, 'fromBin': opts.from_bin,
+            'createMissing': opts.create_missing, 'effectiveVars': opts.effective,
+            'force': opts.force}
+
+
+class OpMetrics(object):
+    ''' Zookeeper request counts, latency histograms and payload bytes per high-level command for this process '''
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float('inf'))  ## seconds
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.local    = threading.local()
+        self.ops      = {}  ## {(command, op): [count, seconds, bytes, bucket counts]}
+        self.commands = {}  ## {command: [runs, seconds]}
+
+    def stack(self):
+        '''
+        Return list (names of high-level commands running in this thread, outermost first).
+        '''
+
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+
+        return self.local.stack
+
+    def current(self):
+        '''
+        Return string (outermost high-level command running in this thread or 'other').
+        '''
+
+        stack = self.stack()
+        return stack[0] if stack else 'other'
+
+    def record(self, command, op, seconds, size):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+
+        with self.lock:
+            entry = self.ops.setdefault((command, op), [0, 0.0, 0, [0] * len(self.BUCKETS)])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += size
+            entry[3][bucket] += 1
+
+    def recordCommand(self, command, seconds):
+        with self.lock:
+            entry = self.commands.setdefault(command, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def quantile(self, buckets, q):
+        '''
+        Return float (upper bound of histogram bucket holding quantile q).
+        '''
+
+        rank, seen = q * sum(buckets), 0
+
+        for bound, count in zip(self.BUCKETS, buckets):
+            seen += count
+            if count and seen >= rank:
+                return bound
+
+        return self.BUCKETS[-1]
+
+    def summary(self):
+        '''
+        Return string (ZK STATS ... lines per command and request type).
+        '''
+
+        lines = []
+
+        with self.lock:
+            for command in sorted(set(command for command, op in self.ops) | set(self.commands)):
+                runs, seconds = self.commands.get(command, [0, 0.0])
+                ops           = sorted((op, entry) for (name, op), entry in self.ops.items() if name == command)
+
+                lines.append("ZK STATS  ==> {0}: {1} runs in {2:.3f}s, {3} requests, {4} bytes".format(
+                    command, runs, seconds, sum(entry[0] for op, entry in ops), sum(entry[2] for op, entry in ops)))
+
+                for op, (count, seconds, size, buckets) in ops:
+                    lines.append("    {0}: {1} requests, {2} bytes, avg {3:.2f}ms, p50 <= {4}ms, p99 <= {5}ms".format(
+                        op, count, size, 1000 * seconds / count,
+                        1000 * self.quantile(buckets, 0.5), 1000 * self.quantile(buckets, 0.99)))
+
+        return '\n'.join(lines) or "ZK STATS  ==> no zookeeper requests"
+
+    def samples(self):
+        '''
+        Return dict ({prometheus metric name with labels: value}).
+        '''
+
+        samples = {}
+
+        with self.lock:
+            for command, (runs, seconds) in self.commands.items():
+                samples['ansible_keeper_command_runs_total{{command="{0}"}}'.format(command)] = runs
+                samples['ansible_keeper_command_seconds_total{{command="{0}"}}'.format(command)] = seconds
+
+            for (command, op), (count, seconds, size, buckets) in self.ops.items():
+                labels = 'command="{0}",op="{1}"'.format(command, op)
+                seen   = 0
+
+                for bound, bucketCount in zip(self.BUCKETS, buckets):
+                    seen += bucketCount
+                    samples['ansible_keeper_zk_request_seconds_bucket{{{0},le="{1}"}}'.format(
+                        labels, '+Inf' if bound == float('inf') else repr(bound))] = seen
+
+                samples['ansible_keeper_zk_request_seconds_sum{{{0}}}'.format(labels)]   = seconds
+                samples['ansible_keeper_zk_request_seconds_count{{{0}}}'.format(labels)] = count
+                samples['ansible_keeper_zk_request_bytes_total{{{0}}}'.format(labels)]   = size
+
+        return samples
+
+    def writePrometheus(self, filePath):
+        '''
+        Add metrics of this process to counters kept in Prometheus textfile filePath (node_exporter
+        textfile collector), the file is replaced atomically. Concurrent runs take turns on lock file
+        <filePath>.lock, so none of them loses the increments of another.
+        '''
+
+        with open(filePath + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            self.addToTextfile(filePath)
+
+    def addToTextfile(self, filePath):
+        '''
+        Read-modify-write of Prometheus textfile filePath (see writePrometheus).
+        '''
+
+        ## every sample is a counter, so totals of all runs are kept by summing with the previous file
+        samples = self.samples()
+
+        try:
+            with open(filePath, 'r') as f:
+                for line in f:
+                    if line.strip() and not line.startswith('#'):
+                        name, value = line.rsplit(' ', 1)
+                        samples[name] = samples.get(name, 0) + float(value)
+        except (IOError, ValueError):
+            pass
+
+        metricHelp = {
+            'ansible_keeper_command_runs_total': ('counter', 'Runs of ansibleKeeper.py high-level commands.'),
+            'ansible_keeper_command_seconds_total': ('counter', 'Wall time of ansibleKeeper.py high-level commands.'),
+            'ansible_keeper_zk_request_seconds': ('histogram', 'Latency of zookeeper requests per command and request type.'),
+            'ansible_keeper_zk_request_bytes_total': ('counter', 'Payload bytes of zookeeper requests per command and request type.'),
+        }
+
+        lines = []
+
+        for metric, (kind, text) in sorted(metricHelp.items()):
+            lines += ["# HELP {0} {1}".format(metric, text), "# TYPE {0} {1}".format(metric, kind)]
+            lines += ["{0} {1}".format(name, repr(float(value))) for name, value in sorted(samples.items())
+                      if name.split('{')[0] in (metric, metric + '_bucket', metric + '_sum', metric + '_count')]
+
+        directory = os.path.dirname(os.path.abspath(filePath))
+        tmpFd, tmpPath = tempfile.mkstemp(dir=directory, prefix='.ansible-keeper-stats.')
+
+        with os.fdopen(tmpFd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        os.chmod(tmpPath, 0o644)
+        os.replace(tmpPath, filePath)
+
+
+opMetrics = OpMetrics()
+
+
+def measured(function):
+    '''
+    Decorator of high-level commands: zookeeper requests made by the command (and by the commands it calls)
+    are accounted to its name in opMetrics together with its wall time.
+
+    Return function.
+    '''
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack   = opMetrics.stack()
+        started = time.time()
+        stack.append(function.__name__)
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.pop()
+            if not stack:
+                opMetrics.recordCommand(function.__name__, time.time() - started)
+
+    return wrapper
+
+
+def payloadSize(op, result):
+    '''
+    Estimate payload bytes of zookeeper request result (data read, children names or written value).
+
+    Return int.
+    '''
+
+    if op == 'get':
+        return len(result[0] or b'')
+    if op == 'get_children':
+        return sum(len(child) for child in result)
+
+    return 0
+
+
+class MeasuredTransaction(object):
+    ''' Kazoo transaction wrapper accounting its commit to opMetrics as one multi request '''
+
+    def __init__(self, zk, txn):
+        self.zk, self.txn, self.size = zk, txn, 0
+
+    def create(self, path, value=b'', *args, **kwargs):
+        self.size += len(value)
+        return self.txn.create(path, value, *args, **kwargs)
+
+    def set_data(self, path, value, *args, **kwargs):
+        self.size += len(value)
+        return self.txn.set_data(path, value, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.txn.delete(*args, **kwargs)
+
+    def check(self, *args, **kwargs):
+        return self.txn.check(*args, **kwargs)
+
+    def commit(self):
+        return self.zk.call('multi', self.txn.commit, (), {}, self.size)
+
+
+class MeasuredClient(object):
+    ''' Kazoo client wrapper accounting every request to opMetrics, other attributes are the client's '''
+
+    def __init__(self, zk):
+        self.zk = zk
+
+    def __getattr__(self, name):
+        return getattr(self.zk, name)
+
+    def call(self, op, method, args, kwargs, size=0):
+        command = opMetrics.current()
+        started = time.time()
+        result  = None
+
+        try:
+            result = method(*args, **kwargs)
+            return result
+        finally:
+            opMetrics.record(command, op, time.time() - started, size + (payloadSize(op, result) if result is not None else 0))
+
+    def callAsync(self, op, method, args, kwargs):
+        command = opMetrics.current()
+        started = time.time()
+
+        def done(asyncResult):
+            size = payloadSize(op, asyncResult.value) if asyncResult.successful() and asyncResult.value is not None else 0
+            opMetrics.record(command, op, time.time() - started, size)
+
+        asyncResult = method(*args, **kwargs)
+        asyncResult.rawlink(done)
+        return asyncResult
+
+    def get(self, *args, **kwargs):
+        return self.call('get', self.zk.get, args, kwargs)
+
+    def get_children(self, *args, **kwargs):
+        return self.call('get_children', self.zk.get_children, args, kwargs)
+
+    def exists(self, *args, **kwargs):
+        return self.call('exists', self.zk.exists, args, kwargs)
+
+    def sync(self, *args, **kwargs):
+        return self.call('sync', self.zk.sync, args, kwargs)
+
+    def create(self, path, value=b'', *args, **kwargs):
+        return self.call('create', self.zk.create, (path, value) + args, kwargs, len(value))
+
+    def set(self, path, value, *args, **kwargs):
+        return self.call('set', self.zk.set, (path, value) + args, kwargs, len(value))
+
+    def delete(self, *args, **kwargs):
+        return self.call('delete', self.zk.delete, args, kwargs)
+
+    def ensure_path(self, *args, **kwargs):
+        return self.call('ensure_path', self.zk.ensure_path, args, kwargs)
+
+    def transaction(self):
+        return MeasuredTransaction(self, self.zk.transaction())
+
+    def get_async(self, *args, **kwargs):
+        return self.callAsync('get', self.zk.get_async, args, kwargs)
+
+    def get_children_async(self, *args, **kwargs):
+        return self.callAsync('get_children', self.zk.get_children_async, args, kwargs)
+
+    def exists_async(self, *args, **kwargs):
+        return self.callAsync('exists', self.zk.exists_async, args, kwargs)
+
+    def sync_async(self, *args, **kwargs):
+        return self.callAsync('sync', self.zk.sync_async, args, kwargs)
+
+
+class ZkSession(object):
+    '''
+    Zookeeper session shared by all operations of the process.
+
+    Client is connected lazily on first use in read-only mode and reconnected in read-write mode
+    only when a write is needed. Use it as a context manager to close the session:
+
+        with ansibleKeeper.zkSession:
+            ansibleKeeper.ansibleInventoryDump()
+            ansibleKeeper.updateZnode(znodeDict)
+    '''
+
+    def __init__(self):
+        self.zk       = None
+        self.readOnly = None
+        self.reader   = None
+
+    def client(self, readWrite=False):
+        '''
+        Connect or reuse zookeeper client, read-write client serves reads as well.
+
+        Return zookeeper connection object.
+        '''
+
+        if self.zk is not None and (readWrite is False or self.readOnly is False):
+            return self.zk
+
+        self.close()
+
+        zk = MeasuredClient(KazooClient(hosts=cfg.zkServers, read_only=not readWrite, timeout=cfg.zkSessionTimeout,
+                                        connection_retry=cfg.zkConnectionRetry, command_retry=cfg.zkCommandRetry))
+        zk.start(timeout=cfg.zkConnectTimeout)
+
+        self.zk, self.readOnly = zk, not readWrite
+        return zk
+
+    def fanout(self):
+        '''
+        Connect or reuse fanout reader of cfg.readFanout sessions (see fanoutReader).
+
+        Return FanoutReader or zookeeper connection object (when no fanout session could connect).
+        '''
+
+        if self.reader is None:
+            self.reader = fanoutReader(self.client(), cfg.readFanout)
+
+        return self.reader
+
+    def close(self):
+        '''
+        Stop and close zookeeper clients if connected.
+        '''
+
+        if isinstance(self.reader, FanoutReader):
+            self.reader.close()
+        self.reader = None
+
+        if self.zk is not None:
+            try:
+                self.zk.stop()
+                self.zk.close()
+            finally:
+                self.zk, self.readOnly = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+zkSession = ZkSession()
 
 
 def zkStartRo():
     '''
-    Start a zookeeper client connection in read-only mode.
+    Get shared zookeeper client connection, read-only unless read-write is already connected.
 
     Return zookeeper read-only connection object.
     '''
 
-    zk = KazooClient(hosts=cfg.zkServers, read_only = True)
-    zk.start()
-    
-    return zk
+    return zkSession.client()
 
 
 def zkStartRw():
     '''
-    Start a zookeeper client connection in read-write mode.
+    Get shared zookeeper client connection in read-write mode.
 
     Return zookeeper read-write connection object.
     '''
 
-    zk = KazooClient(hosts=cfg.zkServers)
-    zk.start()
-    
-    return zk
-    
+    return zkSession.client(readWrite=True)
+
+
+def zkStartFanout():
+    '''
+    Get shared fanout reader when cfg.readFanout is set, shared zookeeper client connection otherwise.
+
+    Return FanoutReader or zookeeper connection object.
+    '''
+
+    if cfg.readFanout:
+        return zkSession.fanout()
+
+    return zkSession.client()
+
+
+def probeLatency(server):
+    '''
+    Measure TCP connect time to zookeeper server host:port.
+
+    Return float (seconds) or None (unreachable server).
+    '''
+
+    host, sep, port = server.rpartition(':')
+
+    if not sep:
+        host, port = port, '2181'
+
+    started = time.time()
+
+    try:
+        socket.create_connection((host, int(port)), cfg.fanoutProbeTimeout).close()
+    except (OSError, ValueError):
+        return None
+
+    return time.time() - started
+
+
+class FanoutReader(object):
+    '''
+    Read-only zookeeper client lookalike spreading reads over sessions to several servers: reads of
+    a host or group subtree go to one session picked by the name hash, closer servers (lower latency)
+    get proportionally more names, other reads go to the closest server.
+    '''
+
+    def __init__(self, sessions):
+        self.sessions    = [zk for zk, latency in sessions]
+        self.fetchWindow = cfg.fetchWindow * len(sessions)  ## keeps cfg.fetchWindow in flight per session
+        weights          = [1.0 / max(latency, 1e-4) for zk, latency in sessions]
+        self.slots       = []
+
+        for zk, weight in zip(self.sessions, weights):
+            self.slots += [zk] * max(1, int(round(16 * len(sessions) * weight / sum(weights))))
+
+    def client(self, path):
+        parts = path[len(cfg.aPath) + 1:].split('/') if path.startswith(cfg.aPath + '/') else []
+
+        if len(parts) >= 2 and parts[0] in ('hosts', 'groups'):
+            return self.slots[zlib.crc32(parts[1].encode('utf-8')) % len(self.slots)]
+
+        return self.sessions[0]
+
+    def get(self, path):
+        return self.client(path).get(path)
+
+    def get_children(self, path):
+        return self.client(path).get_children(path)
+
+    def exists(self, path):
+        return self.client(path).exists(path)
+
+    def get_async(self, path):
+        return self.client(path).get_async(path)
+
+    def get_children_async(self, path):
+        return self.client(path).get_children_async(path)
+
+    def exists_async(self, path):
+        return self.client(path).exists_async(path)
+
+    def settle(self):
+        '''
+        Sync every session and read inventory state (see inventoryCacheKey) from each of them.
+
+        Return list (inventory state all sessions are at) or None (sessions are at different states).
+        '''
+
+        for synced in [zk.sync_async(cfg.aPath) for zk in self.sessions]:
+            synced.get()
+
+        keys = [inventoryCacheKey(zk) for zk in self.sessions]
+
+        return keys[0] if all(key == keys[0] for key in keys) else None
+
+    def close(self):
+        for zk in self.sessions:
+            zk.stop()
+            zk.close()
+
+
+def consistentRead(zk, fetch, discard=None):
+    '''
+    Run fetch(zk) over fanout reader until all its sessions are at the same inventory state before
+    and after the fetch (see FanoutReader.settle), so results merged from several servers come from
+    one state, results of other fetches are given to discard. After cfg.fanoutRetries attempts fetch
+    reads from the closest session only. Other clients run fetch once.
+
+    Return result of fetch.
+    '''
+
+    ## inventory state covers hosts and groups created or deleted and modcounter bumped after
+    ## every write, so a write committed during the fetch changes it on every session after sync
+
+    if not isinstance(zk, FanoutReader):
+        return fetch(zk)
+
+    for attempt in range(cfg.fanoutRetries):
+        before = zk.settle()
+
+        if before is None:
+            continue
+
+        result = fetch(zk)
+
+        if zk.settle() == before:
+            return result
+
+        if discard is not None:
+            discard(result)
+
+    return fetch(zk.sessions[0])
+
+
+def fanoutReader(zk, count):
+    '''
+    Connect read-only sessions to count closest servers of cfg.zkServers and cfg.zkObservers
+    (by TCP connect time) and sync them to the zxid zk session is at.
+
+    Return FanoutReader or zk (when no fanout session could connect).
+    '''
+
+    ## after sync() a server has applied every write committed before it, zxid of the next reply
+    ## is checked against zxid of zk, so no session answers from an older state than zk would
+
+    servers, sep, chroot = cfg.zkServers.partition('/')
+    servers = [server.strip() for server in (servers + ',' + cfg.zkObservers).split(',') if server.strip()]
+    servers = sorted(set(servers), key=servers.index)
+    probes  = {}
+    threads = [threading.Thread(target=lambda server: probes.update({server: probeLatency(server)}), args=(server,))
+               for server in servers]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    closest  = sorted((probes[server], server) for server in servers if probes[server] is not None)[:count]
+    sessions = []
+
+    for latency, server in closest:
+        client = MeasuredClient(KazooClient(hosts=server + sep + chroot, read_only=True, timeout=cfg.zkSessionTimeout,
+                                            connection_retry=cfg.zkConnectionRetry, command_retry=cfg.zkCommandRetry))
+        sessions.append((client, latency, client.start_async()))
+
+    zk.sync(cfg.aPath)
+    zk.exists(cfg.aPath)
+    floor = zk.last_zxid
+    ready = []
+
+    for client, latency, started in sessions:
+        started.wait(cfg.zkConnectTimeout)
+
+        try:
+            if client.connected:
+                client.sync(cfg.aPath)
+                client.exists(cfg.aPath)
+
+                if client.last_zxid >= floor:
+                    ready.append((client, latency))
+                    continue
+        except KazooException:
+            pass
+
+        client.stop()
+        client.close()
+
+    if not ready:
+        return zk
+
+    return FanoutReader(ready)
+
 
 class ArgError(object):
     ''' Class for handling errors '''
@@ -220,640 +895,4636 @@ def splitRenameZnodeString(renameZnodeString):
     else:
         return ArgError('NO_VALID_KEYWORDS_STRING', ERROR_MSGS['NO_VALID_KEYWORDS_STRING']).format()
 
-    
-def addHostWithHostvars(znodeDict):
-    '''
-    Add existing znode to new group.
 
-    Return string (ADDED    ==> host: hostname to group: groupname).
+def pipelineRequests(zk, requests, window=None):
     '''
-  
-    zk = zkStartRw()
-
-    groupName      = list(znodeDict.keys())[0]
-    hostName       = list(znodeDict[groupName].keys())[0]
-    groupPath      = "{0}/groups/{1}".format(cfg.aPath, groupName)
-    hostPath       = "{0}/hosts/{1}".format(cfg.aPath, hostName)
-    hostGroupPath  = "{0}/{1}".format(groupPath, hostName)
+    Issue (method, path) requests with kazoo async calls keeping at most window of them in flight.
+    Method is one of kazoo read methods: get|get_children|exists.
 
-    ERROR_MSGS = {
-        'HOST_EXISTS': "host: {0} exists !!!".format(hostName),
-        'HOST_EXISTS_IN_GROUP': "host: {0} in group {1} exists !!!".format(hostName, groupName)
-    }
+    Return generator of (path, result) tuples in request order (result is None for nonexistent znode).
+    '''
 
-    COMMON_MSGS = {
-        'ADDED_HOST_TO_GROUP': "ADDED  ==> host: {0} to group: {1}".format(hostName, groupName)
-    }
+    ## zookeeper answers requests of one session in order, so waiting for the oldest
+    ## request while the next ones are already on the wire costs no extra round trips
 
-    try:
-        if zk.exists(hostPath):
-            return ArgError('HOST_EXISTS',ERROR_MSGS['HOST_EXISTS']).format()
+    if window is None:
+        window = getattr(zk, 'fetchWindow', cfg.fetchWindow)
 
-        elif zk.exists(hostGroupPath):
-            return ArgError('HOST_EXISTS_IN_GROUP',ERROR_MSGS['HOST_EXISTS_IN_GROUP']).format()
+    inFlight = deque()
 
-        else:
-            zk.ensure_path(hostPath)
-            zk.ensure_path(hostGroupPath)
+    def collect(path, asyncResult):
+        try:
+            return path, asyncResult.get()
+        except NoNodeError:
+            return path, None
 
-            for key in znodeDict[groupName][hostName]:
-                varPath = "{0}/{1}".format(hostPath, key)
-                varVal  = znodeDict[groupName][hostName][key]
-                zk.create(varPath, varVal)
+    for method, path in requests:
+        if len(inFlight) >= window:
+            yield collect(*inFlight.popleft())
+        inFlight.append((path, getattr(zk, '{}_async'.format(method))(path)))
 
-            return CommonInformer('ADDED_HOST_TO_GROUP',COMMON_MSGS['ADDED_HOST_TO_GROUP']).format()
+    while inFlight:
+        yield collect(*inFlight.popleft())
 
-    finally:
-        zk.stop()    
-    
 
-def addHostToGroup(znodeStringSplited):
+def fetchGroupMembers(zk, groupList):
     '''
-    Add host to group.
+    Fetch members of every group from groupList with pipelined async calls.
 
-    Return string (ADDED  ==> host: hostname to group: groupname).
+    Return dict ({groupname: [hostname1, hostname2]}).
     '''
 
-    zk = zkStartRw()
+    requests = [('get_children', "{0}/groups/{1}".format(cfg.aPath, group)) for group in groupList]
+    members  = pipelineRequests(zk, requests)
 
-    groupName, groupPath              = znodeStringSplited[0]
-    hostName, hostPath, hostGroupPath = znodeStringSplited[1]
+    return dict((group, children or []) for group, (path, children) in zip(groupList, members))
 
-    ERROR_MSGS = {
-        'HOST_EXISTS_IN_GROUP': "ERROR  ==> host: {0} in group {1} exists !!!".format(hostName, groupName),
-        'HOST_DOES_NOT_EXIST': "ERROR  ==> host: {0} does not exist !!! Could not add non-existent host: {0} to group: {1}".format(hostName, groupName)
-    }
 
-    COMMON_MSGS = {
-        'ADDED_HOST_TO_GROUP': "ADDED  ==> host: {0} to group: {1}".format(hostName, groupName)
-    }
-  
-    try:
-        if zk.exists(hostGroupPath):
-            return ArgError('HOST_EXISTS_IN_GROUP',ERROR_MSGS['HOST_EXISTS_IN_GROUP']).format()
+def getLayout(zk):
+    '''
+    Read hostvars storage layout marker from {aPath}/layout.
 
-        if zk.exists(hostPath) is None:
-            return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
-        
-        zk.ensure_path(hostGroupPath)
-        return CommonInformer('ADDED_HOST_TO_GROUP',COMMON_MSGS['ADDED_HOST_TO_GROUP']).format()
+    Return string (v1|v2|migrating:v1|migrating:v2).
+    '''
 
-    finally:
-        zk.stop()
+    ## v1          : every hostvar is its own znode {aPath}/hosts/<host>/<var>
+    ## v2          : all hostvars of a host are packed into {aPath}/hosts/<host> data
+    ## migrating:vX: conversion to vX is running, readers merge both forms, writers write vX form
+
+    try:
+        return zk.get("{}/layout".format(cfg.aPath))[0].decode('utf-8') or 'v1'
+    except NoNodeError:
+        return 'v1'
 
 
-def deleteZnodeRecur(znodeStringSplited):
+def setLayout(zk, layout):
+    '''
+    Write hostvars storage layout marker to {aPath}/layout.
+    '''
+
+    layoutPath = "{}/layout".format(cfg.aPath)
+
+    try:
+        zk.set(layoutPath, layout.encode('utf-8'))
+    except NoNodeError:
+        zk.create(layoutPath, layout.encode('utf-8'), makepath=True)
+
+
+def hostVarText(value):
+    '''
+    Convert hostvar value given by user, file or zookeeper into text.
+
+    Return string.
+    '''
+
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+
+    return str(value)
+
+
+def packHostVars(varDict):
+    '''
+    Serialize hostvars into v2 layout host znode value: compact JSON
+    (stored through the value codec, see valueOps).
+
+    Return bytes.
+    '''
+
+    if not varDict:
+        return b''
+
+    return json.dumps(varDict, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def unpackHostVars(data):
+    '''
+    Deserialize v2 layout host znode value (JSON always starts with "{", zlib stream
+    written by older releases with "x").
+
+    Return dict.
+    '''
+
+    if not data:
+        return {}
+
+    if not data.startswith(b'{'):
+        data = zlib.decompress(data)
+
+    return json.loads(data.decode('utf-8'))
+
+
+class ValueStats(object):
+    ''' Byte counters of the value codec for this process '''
+
+    def __init__(self):
+        self.written = self.stored = self.read = self.loaded = self.chunked = 0
+
+    def summary(self):
+        '''
+        Return string (VALUE CODEC ...).
+        '''
+
+        return ("VALUE CODEC  ==> written: {0} bytes as {1} bytes (saved {2}), read: {3} bytes as {4} bytes (saved {5}), "
+                "chunked values: {6}".format(self.written, self.stored, self.written - self.stored,
+                                             self.loaded, self.read, self.loaded - self.read, self.chunked))
+
+
+valueStats = ValueStats()
+
+
+## stored value is raw bytes (UTF-8 text or JSON) or starts with VALUE_MARK, which never starts UTF-8 text:
+## VALUE_MARK + b'z' + zlib stream            compressed value
+## VALUE_MARK + b'c' + JSON manifest          value split into chunk znodes <path>/.chunk-<build>-<number>
+## VALUE_MARK + b'r' + raw bytes              raw value starting with VALUE_MARK itself
+##                                            (concatenated chunks are the stored value, possibly compressed)
+
+VALUE_MARK   = b'\xff'
+CHUNK_PREFIX = '.chunk-'
+
+
+def valueOps(path, raw, exists, version=-1, oldChunks=(), chunked=True):
+    '''
+    Plan transaction operations storing raw bytes into znode path through the value codec: zlib compressed
+    above cfg.valueCompressMin bytes, split into chunk znodes above cfg.valueChunkBytes bytes (unless chunked
+    is False for znodes whose children mean something else). Znode is created unless it exists,
+    chunks of its previous value (oldChunks) are deleted.
+
+    Return list of transaction operations or raise ValueError (value too large).
+    '''
+
+    ## new chunks are created before the manifest pointing to them is stored
+    ## and old chunks are deleted after it, so chunked readers never miss a chunk of the current value
+
+    data = raw
+
+    if cfg.valueCompressMin is not None and len(raw) > cfg.valueCompressMin:
+        compressed = VALUE_MARK + b'z' + zlib.compress(raw)
+        if len(compressed) < len(raw):
+            data = compressed
+
+    if data is raw and raw.startswith(VALUE_MARK):
+        data = VALUE_MARK + b'r' + raw
+
+    chunkCreates = []
+
+    if len(data) > cfg.valueChunkBytes and not chunked:
+        raise ValueError("value of {0} is too large: {1} bytes stored".format(path, len(data)))
+
+    if len(data) > cfg.valueChunkBytes:
+        build    = uuid.uuid4().hex[:12]
+        chunks   = [data[start:start + cfg.valueChunkBytes] for start in range(0, len(data), cfg.valueChunkBytes)]
+        chunkCreates = [('create', "{0}/{1}{2}-{3:04d}".format(path, CHUNK_PREFIX, build, number), chunk)
+                    for number, chunk in enumerate(chunks)]
+        data     = VALUE_MARK + b'c' + json.dumps({'build': build, 'chunks': len(chunks)}).encode('utf-8')
+        valueStats.chunked += 1
+
+    valueStats.written += len(raw)
+    valueStats.stored  += len(data) + sum(len(op[2]) for op in chunkCreates)
+
+    if exists:
+        ops = chunkCreates + [('set_data', path, data, version)]
+    else:
+        ops = [('create', path, data)] + chunkCreates
+
+    return ops + [('delete', "{0}/{1}".format(path, chunk), -1) for chunk in oldChunks]
+
+
+def valueChunks(data):
+    '''
+    List chunk znode names of a stored value.
+
+    Return list.
+    '''
+
+    if not data.startswith(VALUE_MARK + b'c'):
+        return []
+
+    try:
+        manifest = json.loads(data[2:].decode('utf-8'))
+        return ["{0}{1}-{2:04d}".format(CHUNK_PREFIX, manifest['build'], number) for number in range(manifest['chunks'])]
+    except (ValueError, KeyError, TypeError):  ## raw value written before the value codec
+        return []
+
+
+def decodeValue(data):
+    '''
+    Decode stored value (reassembled from chunks) into raw bytes, values written before
+    the value codec which merely start with VALUE_MARK are returned as they are.
+
+    Return bytes.
+    '''
+
+    if data.startswith(VALUE_MARK + b'z'):
+        try:
+            return zlib.decompress(data[2:])
+        except zlib.error:
+            return data
+
+    if data.startswith(VALUE_MARK + b'r'):
+        return data[2:]
+
+    return data
+
+
+def decodeValues(zk, stored):
+    '''
+    Decode stored values ({path: data}) read from zookeeper, chunks of chunked values
+    are fetched with pipelined async calls.
+
+    Return dict ({path: (raw bytes, chunk names)}), values of znodes deleted meanwhile are missing.
+    '''
+
+    decoded = {}
+
+    for attempt in writeAttempts():
+        pending  = dict((path, valueChunks(data)) for path, data in stored.items())
+        requests = [('get', "{0}/{1}".format(path, chunk)) for path, chunks in pending.items() for chunk in chunks]
+        results  = pipelineRequests(zk, requests)
+        retry    = []
+
+        for path, chunks in pending.items():
+            data = stored[path]
+
+            if chunks:
+                parts = [result for chunkPath, result in (next(results) for chunk in chunks)]
+                if None in parts:  ## value was rewritten meanwhile, read its manifest again
+                    retry.append(path)
+                    continue
+                data = b''.join(part[0] for part in parts)
+
+            valueStats.read += len(data)
+            data = decodeValue(data)
+            valueStats.loaded += len(data)
+            decoded[path] = (data, chunks)
+
+        if not retry:
+            break
+
+        stored = dict((path, result[0]) for path, result in pipelineRequests(zk, [('get', path) for path in retry])
+                      if result is not None)
+
+    return decoded
+
+
+def iterHostRecords(zk, hostList, layout, versions=None):
+    '''
+    Fetch stored hostvars for every host from hostList in batches of fetch window hosts
+    with pipelined async calls, reading znodes of a given storage layout. Versions of hostvar
+    znodes read are stored into a given versions dict ({var path: version}).
+
+    Return generator of (hostname, record) tuples, record is None for nonexistent host
+    or tuple (hostStat, packedVars, childVars, chunks).
+    '''
+
+    ## hostStat is known only for layouts storing packed hostvars (it is None for v1),
+    ## chunks lists chunk znode names of chunked values: {host or var path: [chunk1, chunk2]}
+
+    readPacked   = layout != 'v1'
+    readChildren = layout != 'v2'
+    window       = getattr(zk, 'fetchWindow', cfg.fetchWindow)
+
+    for start in range(0, len(hostList), window):
+        batch    = hostList[start:start + window]
+        requests = []
+
+        for host in batch:
+            hostPath = "{0}/hosts/{1}".format(cfg.aPath, host)
+            if readPacked:
+                requests.append(('get', hostPath))
+            if readChildren:
+                requests.append(('get_children', hostPath))
+
+        results  = pipelineRequests(zk, requests)
+        hostData = []
+        stored   = {}
+
+        for host in batch:
+            exists, hostStat, varList = True, None, []
+
+            if readPacked:
+                path, result = next(results)
+                if result is None:
+                    exists = False
+                else:
+                    stored[path], hostStat = result
+
+            if readChildren:
+                path, result = next(results)
+                if result is None:
+                    exists = False
+                else:
+                    varList = [var for var in result if not var.startswith(CHUNK_PREFIX)]
+
+            hostData.append((host, exists, hostStat, varList))
+
+        requests = [('get', "{0}/hosts/{1}/{2}".format(cfg.aPath, host, var))
+                    for host, exists, hostStat, varList in hostData for var in varList]
+
+        for path, result in pipelineRequests(zk, requests):
+            if result is not None:  ## skip hostvar deleted in the meantime
+                stored[path] = result[0]
+                if versions is not None:
+                    versions[path] = result[1].version
+
+        values = decodeValues(zk, stored)
+
+        for host, exists, hostStat, varList in hostData:
+            hostPath   = "{0}/hosts/{1}".format(cfg.aPath, host)
+            packedVars = {}
+            childVars  = {}
+            chunks     = {}
+
+            if readPacked and exists:
+                if hostPath not in values:  ## deleted in the meantime
+                    exists = False
+                else:
+                    data, chunks[hostPath] = values[hostPath]
+                    packedVars = unpackHostVars(data)
+
+            for var in varList:
+                varPath = "{0}/{1}".format(hostPath, var)
+                if varPath in values:
+                    data, chunks[varPath] = values[varPath]
+                    childVars[var] = data.decode('utf-8')
+
+            if exists:
+                yield host, (hostStat, packedVars, childVars, chunks)
+            else:
+                yield host, None
+
+
+def recordVars(record):
+    '''
+    Merge hostvars of host record (see iterHostRecords) kept in both storage forms.
+
+    Return dict ({var1: value1}, empty for nonexistent host).
+    '''
+
+    varDict = {}
+
+    if record is not None:
+        hostStat, packedVars, childVars, chunks = record
+        varDict.update(childVars)
+        varDict.update(packedVars)
+
+    return varDict
+
+
+def iterHostVars(zk, hostList, layout=None):
+    '''
+    Fetch hostvars for every host from hostList regardless of storage layout.
+
+    Return generator of (hostname, {var1: value1, var2: value2}) tuples.
+    '''
+
+    if layout is None:
+        layout = getLayout(zk)
+
+    for host, record in iterHostRecords(zk, hostList, layout):
+        yield host, recordVars(record)
+
+
+def fetchHostVars(zk, hostList, layout=None):
+    '''
+    Fetch hostvars for every host from hostList.
+
+    Return dict ({hostname: {var1: value1, var2: value2}}).
+    '''
+
+    return dict(iterHostVars(zk, hostList, layout))
+
+
+def chunkOps(ops):
+    '''
+    Split transaction operations into chunks of at most cfg.txnMaxOps operations
+    and cfg.txnMaxBytes estimated request size, to stay under zookeeper jute.maxbuffer.
+
+    Return list of lists.
+    '''
+
+    ## operation is a tuple of kazoo TransactionRequest method name and its arguments:
+    ## ('create', path, value) || ('set_data', path, value, version) || ('delete', path, version) || ('check', path, version)
+
+    chunks, chunk, chunkBytes = [], [], 0
+
+    for op in ops:
+        opBytes = opSize(op)
+
+        if chunk and (len(chunk) >= cfg.txnMaxOps or chunkBytes + opBytes > cfg.txnMaxBytes):
+            chunks.append(chunk)
+            chunk, chunkBytes = [], 0
+
+        chunk.append(op)
+        chunkBytes += opBytes
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def opSize(op):
+    '''
+    Return int (estimated request size of transaction operation).
+    '''
+
+    return 64 + len(op[1]) + (len(op[2]) if op[0] in ('create', 'set_data') else 0)
+
+
+def opsSummary(ops):
+    '''
+    Count transaction operations by type.
+
+    Return string (create: N, set_data: N, delete: N, check: N).
+    '''
+
+    return ", ".join("{0}: {1}".format(opType, len([op for op in ops if op[0] == opType]))
+                     for opType in ('create', 'set_data', 'delete', 'check'))
+
+
+def writeAttempts():
+    '''
+    Attempts of a write racing with concurrent writers, at least one even when cfg.writeRetries is below 1.
+
+    Return range.
+    '''
+
+    return range(max(1, cfg.writeRetries))
+
+
+def commitOps(zk, ops, progress=None):
+    '''
+    Commit transaction operations in chunked transactions, every chunk is applied atomically.
+    Per chunk throughput is printed with a given progress label.
+
+    Return None or exception of the operation which failed a chunk (next chunks are not committed).
+    '''
+
+    chunks = chunkOps(ops)
+
+    for number, chunk in enumerate(chunks, 1):
+        started = time.time()
+        txn     = zk.transaction()
+
+        for op in chunk:
+            getattr(txn, op[0])(*op[1:])
+
+        for result in txn.commit():
+            if isinstance(result, Exception) and not isinstance(result, RolledBackError):
+                return result
+
+        if progress is not None:
+            elapsed = max(time.time() - started, 1e-6)
+            print("{0}  ==> chunk {1}/{2}: {3} ops in {4:.3f}s ({5:.0f} ops/s)".format(
+                progress, number, len(chunks), len(chunk), elapsed, len(chunk) / elapsed))
+
+    return None
+
+
+def hostVarsOps(hostName, record, varDict, layout, replace=False, versions=None):
+    '''
+    Plan transaction operations storing varDict on top of host record in the form of a given layout
+    (or instead of all its hostvars when replace is set), hostvars kept in the other form
+    (during migration) are converted as well. Hostvar znodes are written and deleted at versions
+    read along with the record ({var path: version}, see iterHostRecords), any version otherwise.
+
+    Return list of transaction operations.
+    '''
+
+    hostPath = "{0}/hosts/{1}".format(cfg.aPath, hostName)
+    target   = layout.split(':')[-1]
+    varDict  = dict((var, hostVarText(val)) for var, val in varDict.items())
+    ops      = []
+
+    if record is None:  ## new host
+        if target == 'v2':
+            return valueOps(hostPath, packHostVars(varDict), False)
+
+        ops.append(('create', hostPath, b''))
+        for var, val in varDict.items():
+            ops += valueOps("{0}/{1}".format(hostPath, var), val.encode('utf-8'), False)
+        return ops
+
+    hostStat, packedVars, childVars, chunks = record
+    versions = versions or {}
+
+    if target == 'v2':
+        newVars = dict(childVars)
+        newVars.update(packedVars)
+        newVars.update(varDict)
+
+        if replace:
+            newVars = dict(varDict)
+
+        if not childVars and newVars == packedVars:
+            return ops
+
+        ops += valueOps(hostPath, packHostVars(newVars), True, hostStat.version, chunks.get(hostPath, []))
+
+        for var in childVars:
+            varPath = "{0}/{1}".format(hostPath, var)
+            ops += [('delete', "{0}/{1}".format(varPath, chunk), -1) for chunk in chunks.get(varPath, [])]
+            ops.append(('delete', varPath, versions.get(varPath, -1)))
+        return ops
+
+    newVars = dict(packedVars)
+    newVars.update(varDict)
+
+    if replace:
+        newVars = dict(varDict)
+
+        for var in childVars:
+            if var not in newVars:
+                varPath = "{0}/{1}".format(hostPath, var)
+                ops += [('delete', "{0}/{1}".format(varPath, chunk), -1) for chunk in chunks.get(varPath, [])]
+                ops.append(('delete', varPath, versions.get(varPath, -1)))
+
+    for var, val in newVars.items():
+        varPath = "{0}/{1}".format(hostPath, var)
+        if var not in childVars:
+            ops += valueOps(varPath, val.encode('utf-8'), False)
+        elif childVars[var] != val:
+            ops += valueOps(varPath, val.encode('utf-8'), True, versions.get(varPath, -1), chunks.get(varPath, []))
+
+    if packedVars:
+        ops.append(('set_data', hostPath, b'', hostStat.version))
+        ops += [('delete', "{0}/{1}".format(hostPath, chunk), -1) for chunk in chunks.get(hostPath, [])]
+
+    return ops
+
+
+def setHostVars(zk, hostName, varDict, layout=None):
+    '''
+    Create or overwrite given hostvars of a host (host znode is created if missing)
+    in current storage layout.
+    '''
+
+    if layout is None:
+        layout = getLayout(zk)
+
+    for attempt in writeAttempts():
+        record = dict(iterHostRecords(zk, [hostName], layout))[hostName]
+
+        if record is None:
+            zk.ensure_path("{}/hosts".format(cfg.aPath))
+
+        oldVars = recordVars(record)
+        newVars = dict(oldVars)
+        newVars.update((var, hostVarText(val)) for var, val in varDict.items())
+
+        error = commitOps(zk, hostVarsOps(hostName, record, varDict, layout) +
+                          varIndexOps(zk, [(hostName, oldVars, newVars)]))
+
+        if error is None:
+            return
+
+    ## concurrent writer kept changing the host
+    raise error
+
+
+@measured
+def migrateLayout(targetLayout):
+    '''
+    Convert hostvars of all hosts into targetLayout (v1|v2) in batches of cfg.migrateBatch hosts,
+    readers keep working during migration. Writes of commands started before the layout marker
+    changed are not seen by the migration, so stop writers while it runs.
+
+    Return string (MIGRATED ... || NOT MIGRATED ... || ERROR ...).
+    '''
+
+    if targetLayout not in ('v1', 'v2'):
+        return "ERROR  ==> no valid hostvars layout: {0} [v1|v2] !!!".format(targetLayout)
+
+    zk = zkStartRw()
+
+    layout = getLayout(zk)
+
+    if layout == targetLayout:
+        return "NOT MIGRATED  ==> hostvars layout is already {0}".format(targetLayout)
+
+    ## from now on every writer stores converted hostvars only
+    layout = 'migrating:{0}'.format(targetLayout)
+    setLayout(zk, layout)
+
+    zk.ensure_path("{}/hosts".format(cfg.aPath))
+    hostList = zk.get_children("{}/hosts".format(cfg.aPath))
+
+    for start in range(0, len(hostList), cfg.migrateBatch):
+        batch = hostList[start:start + cfg.migrateBatch]
+
+        for attempt in writeAttempts():
+            ops      = []
+            versions = {}
+
+            ## hostvar znodes are deleted at versions they were read with, so hostvars
+            ## changed meanwhile fail the batch instead of being lost
+            for host, record in iterHostRecords(zk, batch, layout, versions):
+                if record is not None:
+                    ops += hostVarsOps(host, record, {}, layout, versions=versions)
+
+            error = commitOps(zk, ops)
+
+            if error is None:
+                break
+        else:
+            raise error
+
+        print("MIGRATING  ==> {0}/{1} hosts".format(start + len(batch), len(hostList)))
+
+    setLayout(zk, targetLayout)
+    markInventoryChanged(zk)
+
+    return "MIGRATED  ==> {0} hosts to hostvars layout {1}".format(len(hostList), targetLayout)
+
+
+def markInventoryChanged(zk):
+    '''
+    Bump inventory modification counter, every write invalidates local inventory caches
+    and inventory snapshot this way. Snapshot is rebuilt right away when cfg.snapshotOnWrite is set.
+    '''
+
+    modCounterPath = "{}/modcounter".format(cfg.aPath)
+
+    try:
+        zk.set(modCounterPath, b'')
+    except NoNodeError:
+        zk.ensure_path(modCounterPath)
+
+    dropHostStore()
+
+    if cfg.snapshotOnWrite:
+        rebuildSnapshot(zk)
+
+
+def existingPaths(zk, paths):
+    '''
+    Check existence of many znodes with pipelined async calls.
+
+    Return set of existing paths.
+    '''
+
+    return set(path for path, stat in pipelineRequests(zk, [('exists', path) for path in paths]) if stat is not None)
+
+
+def subtreeDeleteOps(zk, *paths):
+    '''
+    Plan delete of znodes with all their descendants, reading the subtrees level by level.
+
+    Return list of transaction operations (children before parents).
+    '''
+
+    levels, level = [], list(paths)
+
+    while level:
+        levels.append(level)
+        nextLevel = []
+
+        for parent, (parentPath, children) in zip(level, pipelineRequests(zk, [('get_children', p) for p in level])):
+            nextLevel += ["{0}/{1}".format(parent, child) for child in children or []]
+
+        level = nextLevel
+
+    return [('delete', p, -1) for level in reversed(levels) for p in level]
+
+
+def hostGroupsIndexed(zk):
+    '''
+    Check if host-groups index {aPath}/index/host-groups/<host>/<group> is maintained (see --rebuild-index).
+
+    Return bool.
+    '''
+
+    return zk.exists("{}/index/host-groups".format(cfg.aPath)) is not None
+
+
+def fetchHostGroups(zk, hostList):
+    '''
+    Find groups of every host from hostList in host-groups index, hosts missing in the index
+    (or all hosts when there is no index) are looked up by scanning members of all groups.
+
+    Return dict ({hostname: [groupname1, groupname2]}).
+    '''
+
+    indexPath = "{}/index/host-groups".format(cfg.aPath)
+    requests  = [('get_children', "{0}/{1}".format(indexPath, host)) for host in hostList]
+    hostGroupDict, unindexed = {}, []
+
+    for host, (path, groups) in zip(hostList, pipelineRequests(zk, requests)):
+        if groups is None:
+            unindexed.append(host)
+        else:
+            hostGroupDict[host] = groups
+
+    ## index written by clients unaware of it may be stale, keep only existing memberships
+    members = existingPaths(zk, ["{0}/groups/{1}/{2}".format(cfg.aPath, group, host)
+                                 for host, groups in hostGroupDict.items() for group in groups])
+
+    for host, groups in hostGroupDict.items():
+        hostGroupDict[host] = [group for group in groups
+                               if "{0}/groups/{1}/{2}".format(cfg.aPath, group, host) in members]
+
+    if unindexed:
+        groupList = zk.get_children("{}/groups".format(cfg.aPath))
+        members   = dict((group, set(hosts)) for group, hosts in fetchGroupMembers(zk, groupList).items())
+
+        for host in unindexed:
+            hostGroupDict[host] = [group for group in groupList if host in members[group]]
+
+    return hostGroupDict
+
+
+def addMemberOps(zk, memberList, indexed):
+    '''
+    Plan creation of group memberships from memberList [(groupname, hostname)] together with
+    their host-groups index entries (index host znode is created when missing).
+
+    Return list of transaction operations.
+    '''
+
+    indexPath = "{}/index/host-groups".format(cfg.aPath)
+    ops       = []
+
+    if indexed:
+        hostList    = sorted(set(host for group, host in memberList))
+        indexedList = existingPaths(zk, ["{0}/{1}".format(indexPath, host) for host in hostList])
+        ops        += [('create', "{0}/{1}".format(indexPath, host), b'') for host in hostList
+                       if "{0}/{1}".format(indexPath, host) not in indexedList]
+
+    for group, host in memberList:
+        ops.append(('create', "{0}/groups/{1}/{2}".format(cfg.aPath, group, host), b''))
+        if indexed:
+            ops.append(('create', "{0}/{1}/{2}".format(indexPath, host, group), b''))
+
+    return ops
+
+
+def removeMemberOps(zk, memberList, withIndex=True):
+    '''
+    Plan delete of existing group memberships from memberList [(groupname, hostname)]
+    together with their existing host-groups index entries (unless withIndex is False).
+
+    Return list of transaction operations.
+    '''
+
+    paths = []
+
+    for group, host in memberList:
+        paths.append("{0}/groups/{1}/{2}".format(cfg.aPath, group, host))
+        if withIndex:
+            paths.append("{0}/index/host-groups/{1}/{2}".format(cfg.aPath, host, group))
+
+    existing = existingPaths(zk, paths)
+
+    return [('delete', path, -1) for path in paths if path in existing]
+
+
+def commitOrRaise(zk, ops):
+    '''
+    Commit transaction operations in chunked transactions, raise exception of the failed operation.
+    '''
+
+    error = commitOps(zk, ops)
+
+    if error is not None:
+        raise error
+
+
+def indexedVars(zk):
+    '''
+    Read names of hostvars with value index {aPath}/index/vars/<var>/<value>/<host> (see --index-var).
+
+    Return list.
+    '''
+
+    try:
+        return zk.get_children("{}/index/vars".format(cfg.aPath))
+    except NoNodeError:
+        return []
+
+
+def indexValueName(value):
+    '''
+    Encode hostvar value into value index znode name: '=' followed by URL quoted value text,
+    so every value (empty, '.', with '/') makes a valid name and value prefixes stay name prefixes.
+
+    Return string or None (value longer than cfg.indexValueMax is not indexed).
+    '''
+
+    value = hostVarText(value)
+
+    if len(value) > cfg.indexValueMax:
+        return None
+
+    return '=' + quote(value, safe='')
+
+
+def varIndexOps(zk, changes, indexed=None):
+    '''
+    Plan value index updates for hostvar changes [(hostname, oldVars, newVars)] (empty oldVars for
+    a new host, empty newVars for a deleted one) of indexed hostvars, value znodes left without hosts
+    are deleted.
+
+    Return list of transaction operations.
+    '''
+
+    if indexed is None:
+        indexed = indexedVars(zk)
+
+    removed, added = {}, {}
+
+    for host, oldVars, newVars in changes:
+        for var in indexed:
+            oldName = indexValueName(oldVars[var]) if var in oldVars else None
+            newName = indexValueName(newVars[var]) if var in newVars else None
+
+            if oldName != newName:
+                if oldName is not None:
+                    removed.setdefault("{0}/index/vars/{1}/{2}".format(cfg.aPath, var, oldName), set()).add(host)
+                if newName is not None:
+                    added.setdefault("{0}/index/vars/{1}/{2}".format(cfg.aPath, var, newName), set()).add(host)
+
+    valuePaths = sorted(set(removed) | set(added))
+    ops        = []
+
+    ## writers racing on one value znode fail the transaction on its create or delete
+    for valuePath, (path, hosts) in zip(valuePaths, pipelineRequests(zk, [('get_children', path) for path in valuePaths])):
+        current = set(hosts or [])
+        gone    = removed.get(valuePath, set()) & current
+        new     = added.get(valuePath, set()) - current
+
+        if hosts is None and new:
+            ops.append(('create', valuePath, b''))
+
+        ops += [('delete', "{0}/{1}".format(valuePath, host), -1) for host in sorted(gone)]
+        ops += [('create', "{0}/{1}".format(valuePath, host), b'') for host in sorted(new)]
+
+        if hosts is not None and not (current - gone) | new:
+            ops.append(('delete', valuePath, -1))
+
+    return ops
+
+
+@measured
+def rebuildIndex():
+    '''
+    Rebuild host-groups index {aPath}/index/host-groups/<host>/<group> from group members,
+    group tree {aPath}/index/group-tree from group znodes and value indexes of indexed hostvars.
+
+    Return string (REBUILT ... || ERROR ...).
+    '''
+
+    zk = zkStartRw()
+
+    indexPath = "{}/index/host-groups".format(cfg.aPath)
+
+    ## writers maintain the index from now on, index is read before groups
+    ## so memberships changed meanwhile are either created here or fail the chunk and get retried
+    zk.ensure_path(indexPath)
+
+    for attempt in writeAttempts():
+        indexHosts = zk.get_children(indexPath)
+        indexed    = dict((host, set(groups or [])) for host, (path, groups) in zip(
+            indexHosts, pipelineRequests(zk, [('get_children', "{0}/{1}".format(indexPath, host)) for host in indexHosts])))
+
+        zk.ensure_path("{}/groups".format(cfg.aPath))
+        zk.ensure_path("{}/hosts".format(cfg.aPath))
+        wanted = dict((host, set()) for host in zk.get_children("{}/hosts".format(cfg.aPath)))
+
+        for group, hosts in fetchGroupMembers(zk, zk.get_children("{}/groups".format(cfg.aPath))).items():
+            for host in hosts:
+                wanted.setdefault(host, set()).add(group)
+
+        ops = []
+
+        for host, groups in sorted(wanted.items()):
+            if host not in indexed:
+                ops.append(('create', "{0}/{1}".format(indexPath, host), b''))
+            ops += [('create', "{0}/{1}/{2}".format(indexPath, host, group), b'')
+                    for group in sorted(groups - indexed.get(host, set()))]
+
+        for host, groups in sorted(indexed.items()):
+            ops += [('delete', "{0}/{1}/{2}".format(indexPath, host, group), -1)
+                    for group in sorted(groups - wanted.get(host, set()))]
+            if host not in wanted:
+                ops.append(('delete', "{0}/{1}".format(indexPath, host), -1))
+
+        error = commitOps(zk, ops, progress="INDEXING")
+
+        if error is None:
+            break
+    else:
+        raise error
+
+    for attempt in writeAttempts():
+        groupPaths = ["{0}/groups/{1}".format(cfg.aPath, group) for group in zk.get_children("{}/groups".format(cfg.aPath))]
+        stored     = dict((path, result[0]) for path, result in pipelineRequests(zk, [('get', path) for path in groupPaths])
+                          if result is not None)
+        groups     = dict((path.split('/')[-1], unpackGroupData(value)) for path, (value, chunks) in decodeValues(zk, stored).items())
+
+        tree, version, chunks = readGroupTree(zk)
+
+        try:
+            error = commitOps(zk, groupTreeOps(zk, tree, version, chunks, groups))
+        except ValueError as e:
+            return "ERROR  ==> could not rebuild group tree: {0} !!!".format(e)
+
+        if error is None:
+            break
+    else:
+        raise error
+
+    message = "REBUILT  ==> host-groups index of {0} hosts ({1}), group tree of {2} groups".format(
+        len(wanted), opsSummary(ops), len([group for group in groups.values() if group['vars'] or group['children']]))
+
+    varList = indexedVars(zk)
+
+    if varList:
+        message += ", {0}".format(rebuildVarIndex(zk, varList))
+
+    return message
+
+
+def rebuildVarIndex(zk, varList):
+    '''
+    Enable value index of hostvars from varList (creating {aPath}/index/vars/<var>) and make it
+    equal to hostvars of all hosts.
+
+    Return string (INDEXED ...).
+    '''
+
+    ## writers maintain the index from the moment <var> znode exists, index is read before hosts
+    ## so values changed meanwhile fail the chunk (entry already created or deleted) and get retried
+    for var in varList:
+        zk.ensure_path("{0}/index/vars/{1}".format(cfg.aPath, var))
+
+    for attempt in writeAttempts():
+        indexed = {}
+
+        for var in varList:
+            varPath    = "{0}/index/vars/{1}".format(cfg.aPath, var)
+            valueNames = zk.get_children(varPath)
+            requests   = [('get_children', "{0}/{1}".format(varPath, name)) for name in valueNames]
+
+            for name, (path, hosts) in zip(valueNames, pipelineRequests(zk, requests)):
+                indexed[path] = set(hosts or [])
+
+        zk.ensure_path("{}/hosts".format(cfg.aPath))
+        wanted = {}
+
+        for host, varDict in iterHostVars(zk, zk.get_children("{}/hosts".format(cfg.aPath))):
+            for var in varList:
+                name = indexValueName(varDict[var]) if var in varDict else None
+                if name is not None:
+                    wanted.setdefault("{0}/index/vars/{1}/{2}".format(cfg.aPath, var, name), set()).add(host)
+
+        ops = []
+
+        for valuePath, hosts in sorted(wanted.items()):
+            if valuePath not in indexed:
+                ops.append(('create', valuePath, b''))
+            ops += [('create', "{0}/{1}".format(valuePath, host), b'')
+                    for host in sorted(hosts - indexed.get(valuePath, set()))]
+
+        for valuePath, hosts in sorted(indexed.items()):
+            ops += [('delete', "{0}/{1}".format(valuePath, host), -1)
+                    for host in sorted(hosts - wanted.get(valuePath, set()))]
+            if valuePath not in wanted:
+                ops.append(('delete', valuePath, -1))
+
+        error = commitOps(zk, ops, progress="INDEXING")
+
+        if error is None:
+            break
+    else:
+        raise error
+
+    return "INDEXED  ==> hostvars {0}: {1} values ({2})".format(', '.join(varList), len(wanted), opsSummary(ops))
+
+
+@measured
+def indexVars(varString):
+    '''
+    Enable and build value index of comma separated hostvars for -Q queries.
+
+    Return string (INDEXED ... || ERROR ...).
+    '''
+
+    varList = [var.strip() for var in varString.split(',') if var.strip()]
+
+    if not varList or any('/' in var or var in ('.', '..') for var in varList):
+        return "ERROR  ==> {0} <-- no valid hostvar names [var1,var2] !!!".format(varString)
+
+    zk     = zkStartRw()
+    result = rebuildVarIndex(zk, varList)
+
+    if result.startswith("INDEXED"):
+        markInventoryChanged(zk)
+
+    return result
+
+
+@measured
+def queryVarIndex(queryString, zk=None):
+    '''
+    Find hosts by indexed hostvar value: var=value (equal) or var~prefix (value starts with prefix),
+    reading only the value index.
+
+    Return list (sorted hostnames) or string (in case of ERROR).
+    '''
+
+    if zk is None:
+        zk = zkStartRo()
+
+    marks = [mark for mark in ('=', '~') if mark in queryString]
+
+    if not marks:
+        return "ERROR  ==> {0} <-- no valid query [var=value|var~prefix] !!!".format(queryString)
+
+    mark = min(marks, key=queryString.index)
+    var, value = queryString.split(mark, 1)
+    varPath = "{0}/index/vars/{1}".format(cfg.aPath, var)
+
+    try:
+        valueNames = zk.get_children(varPath)
+    except NoNodeError:
+        return "ERROR  ==> hostvar: {0} is not indexed (see --index-var) !!!".format(var)
+
+    name = indexValueName(value)
+
+    if name is None:
+        return "ERROR  ==> {0} <-- value longer than {1} characters is not indexed !!!".format(queryString, cfg.indexValueMax)
+
+    if mark == '=':
+        valueNames = [valueName for valueName in valueNames if valueName == name]
+    else:
+        valueNames = [valueName for valueName in valueNames if valueName.startswith(name)]
+
+    requests = [('get_children', "{0}/{1}".format(varPath, valueName)) for valueName in valueNames]
+    hosts    = set()
+
+    for path, children in pipelineRequests(zk, requests):
+        hosts.update(children or [])
+
+    return sorted(hosts)
+
+
+def packGroupData(record):
+    '''
+    Serialize group record {'vars': {var1: value1}, 'children': [groupname1]} into group znode value:
+    compact JSON (stored through the value codec), empty for a group without vars and child groups.
+
+    Return bytes.
+    '''
+
+    if not record or not (record.get('vars') or record.get('children')):
+        return b''
+
+    return json.dumps({'vars': record.get('vars', {}), 'children': sorted(record.get('children', []))},
+                      separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def unpackGroupData(data):
+    '''
+    Deserialize group znode value.
+
+    Return dict ({'vars': {var1: value1}, 'children': [groupname1]}).
+    '''
+
+    record = json.loads(data.decode('utf-8')) if data else {}
+
+    return {'vars': record.get('vars', {}), 'children': sorted(record.get('children', []))}
+
+
+def buildGroupTree(groups):
+    '''
+    Precompute flattened group hierarchy from group records ({groupname: record}): ancestors, descendants
+    and depth of every group, so readers never walk child groups themselves.
+
+    Return dict (group tree) or raise ValueError for a child groups cycle.
+    '''
+
+    ## group tree: {'groups': {groupname: record}, 'ancestors': {groupname: [parent, grandparent]},
+    ##              'descendants': {groupname: [child, grandchild]}, 'depth': {groupname: 1}}
+    ## groups without vars and child groups are left out of 'groups', depth 0 is left out of 'depth'
+
+    parents = {}
+
+    for group, record in groups.items():
+        for child in record['children']:
+            parents.setdefault(child, set()).add(group)
+
+    ancestors, depth, visiting = {}, {}, []
+
+    def visit(group):
+        if group in ancestors:
+            return
+
+        if group in visiting:  ## visiting holds the path from a child up to this parent
+            cycle = visiting[visiting.index(group):] + [group]
+            raise ValueError("child groups cycle: {0}".format(" -> ".join(reversed(cycle))))
+
+        visiting.append(group)
+        found = set()
+
+        for parent in sorted(parents.get(group, ())):
+            visit(parent)
+            found |= ancestors[parent] | set([parent])
+
+        visiting.pop()
+        ancestors[group] = found
+        depth[group]     = 1 + max(depth[parent] for parent in parents[group]) if group in parents else 0
+
+    for group in sorted(set(groups) | set(parents)):
+        visit(group)
+
+    descendants = {}
+
+    for group, found in ancestors.items():
+        for ancestor in found:
+            descendants.setdefault(ancestor, set()).add(group)
+
+    return {'groups': groups,
+            'ancestors': dict((group, sorted(found)) for group, found in ancestors.items() if found),
+            'descendants': dict((group, sorted(found)) for group, found in descendants.items()),
+            'depth': dict((group, level) for group, level in depth.items() if level)}
+
+
+def readGroupTree(zk):
+    '''
+    Read precomputed group tree from {aPath}/index/group-tree (see buildGroupTree).
+
+    Return tuple (group tree, version, chunks), version is None when the tree was never written.
+    '''
+
+    treePath = "{}/index/group-tree".format(cfg.aPath)
+
+    try:
+        data, stat = zk.get(treePath)
+    except NoNodeError:
+        return buildGroupTree({}), None, []
+
+    values = decodeValues(zk, {treePath: data})
+
+    if treePath not in values:  ## deleted in the meantime
+        return buildGroupTree({}), None, []
+
+    value, chunks = values[treePath]
+
+    return (json.loads(value.decode('utf-8')) if value else buildGroupTree({})), stat.version, chunks
+
+
+def inGroupTree(groups, group):
+    '''
+    Check if group has vars or child groups or is a child group in group records ({groupname: record}).
+
+    Return bool.
+    '''
+
+    return group in groups or any(group in record['children'] for record in groups.values())
+
+
+def dropTreeGroup(groups, group, newName=None):
+    '''
+    Remove group from group records ({groupname: record}) and from child groups of other groups,
+    or rename it to newName everywhere.
+
+    Return dict (new group records).
+    '''
+
+    newGroups = {}
+
+    for name, record in groups.items():
+        children = [newName if child == group else child for child in record['children']]
+        children = sorted(child for child in children if child is not None)
+
+        if name == group:
+            name = newName
+
+        if name is not None and (record['vars'] or children):
+            newGroups[name] = {'vars': record['vars'], 'children': children}
+
+    return newGroups
+
+
+def groupTreeOps(zk, tree, version, chunks, groups, skip=()):
+    '''
+    Plan transaction operations storing group records ({groupname: record}) into changed group znodes
+    and the precomputed group tree {aPath}/index/group-tree read as (tree, version, chunks).
+    Groups in skip are deleted by the caller and not written.
+
+    Return list of transaction operations or raise ValueError (child groups cycle).
+    '''
+
+    ## group tree is set with the version it was read with, so concurrent hierarchy writers
+    ## fail the transaction instead of overwriting each other; cycles are rejected here, on write
+
+    groups = dict((group, unpackGroupData(packGroupData(record))) for group, record in groups.items()
+                  if record.get('vars') or record.get('children'))
+
+    if groups == tree['groups']:
+        return []
+
+    newTree   = buildGroupTree(groups)
+    ops       = []
+    indexPath = "{}/index".format(cfg.aPath)
+
+    for group in sorted(set(groups) | set(tree['groups'])):
+        if group not in skip and groups.get(group) != tree['groups'].get(group):
+            ops += valueOps("{0}/groups/{1}".format(cfg.aPath, group), packGroupData(groups.get(group)),
+                            True, chunked=False)
+
+    if version is None and zk.exists(indexPath) is None:
+        ops.append(('create', indexPath, b''))
+
+    ops += valueOps("{}/group-tree".format(indexPath), json.dumps(newTree, separators=(',', ':'), sort_keys=True).encode('utf-8'),
+                    version is not None, -1 if version is None else version, chunks)
+    return ops
+
+
+def effectiveHostVars(hostVars, memberOf, tree):
+    '''
+    Merge vars of groups from memberOf and of their ancestors taken from precomputed group tree,
+    parent groups first (then by name) like ansible does, with hostvars on top.
+
+    Return dict.
+    '''
+
+    groups = set()
+
+    for group in memberOf:
+        groups |= set([group]) | set(tree['ancestors'].get(group, []))
+
+    varDict = {}
+
+    for group in sorted(groups, key=lambda group: (tree['depth'].get(group, 0), group)):
+        varDict.update(tree['groups'].get(group, {}).get('vars', {}))
+
+    varDict.update(hostVars)
+    return varDict
+
+
+def splitGroupVarString(groupVarString):
+    '''
+    Parse string for commandline opt: --group-vars.
+
+    Return dict ({groupname: {var1: value1}}) or raise ValueError.
+    '''
+
+    ## example string: groupname,var1:val1,var2:val2
+    ## desired dict  : {"groupname": {"var1": "val1", "var2": "val2"}}
+
+    varList = groupVarString.split(',')
+
+    if not varList[0] or ':' in varList[0] or '/' in varList[0]:
+        raise ValueError("{0} <-- no valid group vars string [groupname,var1:value1]".format(groupVarString))
+
+    varDict = {}
+
+    for var in varList[1:]:
+        if ':' not in var:
+            raise ValueError("{0} <-- no valid group vars string [groupname,var1:value1]".format(groupVarString))
+        varDict[var.split(':')[0]] = var.split(':', 1)[1]
+
+    return {varList[0]: varDict}
+
+
+def commitGroupTree(zk, edit):
+    '''
+    Apply edit(groups) to group records of precomputed group tree and commit changed group znodes
+    together with the tree, retried when racing with a concurrent writer. Edit returns
+    a message of a change to report or raises ValueError with a message of a refused change.
+
+    Return string.
+    '''
+
+    for attempt in writeAttempts():
+        tree, version, chunks = readGroupTree(zk)
+        groups = json.loads(json.dumps(tree['groups']))
+
+        try:
+            message = edit(groups)
+            ops     = groupTreeOps(zk, tree, version, chunks, groups)
+        except ValueError as e:
+            return "ERROR  ==> {0} !!!".format(e)
+
+        error = commitOps(zk, ops)
+
+        if error is None:
+            if ops:
+                markInventoryChanged(zk)
+            return message
+
+    ## concurrent writer kept changing the group tree
+    raise error
+
+
+@measured
+def setGroupVars(groupVarDict):
+    '''
+    Create or overwrite given vars of a group (group znode is created if missing).
+
+    Return string (UPDATED ... || ERROR ...).
+    '''
+
+    zk = zkStartRw()
+
+    groupName = list(groupVarDict.keys())[0]
+    varDict   = dict((var, hostVarText(val)) for var, val in groupVarDict[groupName].items())
+
+    def edit(groups):
+        groups.setdefault(groupName, {'vars': {}, 'children': []})['vars'].update(varDict)
+        return "UPDATED  ==> group: {0} with new vars {1}".format(groupName, varDict)
+
+    zk.ensure_path("{0}/groups/{1}".format(cfg.aPath, groupName))
+    return commitGroupTree(zk, edit)
+
+
+
+@measured
+def addChildGroup(znodeStringSplited):
+    '''
+    Make child group member of parent group for a given [(parentName, parentPath), (childName, ...)],
+    missing groups are created and cycles in child groups are refused.
+
+    Return string (ADDED ... || ERROR ...).
+    '''
+
+    zk = zkStartRw()
+
+    parentName, parentPath = znodeStringSplited[0]
+    childName              = znodeStringSplited[1][0]
+    childPath              = "{0}/groups/{1}".format(cfg.aPath, childName)
+
+    def edit(groups):
+        record = groups.setdefault(parentName, {'vars': {}, 'children': []})
+
+        if childName in record['children']:
+            raise ValueError("group: {0} is already child of group: {1}".format(childName, parentName))
+
+        record['children'].append(childName)
+        return "ADDED  ==> child group: {0} to group: {1}".format(childName, parentName)
+
+    if childName == parentName:
+        return "ERROR  ==> could not add group: {0} as its own child !!!".format(childName)
+
+    zk.ensure_path(parentPath)
+    zk.ensure_path(childPath)
+    return commitGroupTree(zk, edit)
+
+
+
+@measured
+def deleteChildGroup(znodeStringSplited):
+    '''
+    Remove child group from parent group for a given [(parentName, parentPath), (childName, ...)],
+    both groups are kept.
+
+    Return string (DELETED ... || ERROR ...).
+    '''
+
+    zk = zkStartRw()
+
+    parentName = znodeStringSplited[0][0]
+    childName  = znodeStringSplited[1][0]
+
+    def edit(groups):
+        if childName not in groups.get(parentName, {}).get('children', []):
+            raise ValueError("could not delete group: {0} that is not child of group: {1}".format(childName, parentName))
+
+        groups[parentName]['children'].remove(childName)
+        return "DELETED ==> child group: {0} from group: {1}".format(childName, parentName)
+
+    return commitGroupTree(zk, edit)
+
+
+
+@measured
+def addHostWithHostvars(znodeDict):
+    '''
+    Add existing znode to new group.
+
+    Return string (ADDED    ==> host: hostname to group: groupname).
+    '''
+  
+    zk = zkStartRw()
+
+    groupName      = list(znodeDict.keys())[0]
+    hostName       = list(znodeDict[groupName].keys())[0]
+    groupPath      = "{0}/groups/{1}".format(cfg.aPath, groupName)
+    hostPath       = "{0}/hosts/{1}".format(cfg.aPath, hostName)
+    hostGroupPath  = "{0}/{1}".format(groupPath, hostName)
+
+    ERROR_MSGS = {
+        'HOST_EXISTS': "host: {0} exists !!!".format(hostName),
+        'HOST_EXISTS_IN_GROUP': "host: {0} in group {1} exists !!!".format(hostName, groupName)
+    }
+
+    COMMON_MSGS = {
+        'ADDED_HOST_TO_GROUP': "ADDED  ==> host: {0} to group: {1}".format(hostName, groupName)
+    }
+
+    if zk.exists(hostPath):
+        return ArgError('HOST_EXISTS',ERROR_MSGS['HOST_EXISTS']).format()
+
+    elif zk.exists(hostGroupPath):
+        return ArgError('HOST_EXISTS_IN_GROUP',ERROR_MSGS['HOST_EXISTS_IN_GROUP']).format()
+
+    else:
+        zk.ensure_path("{}/hosts".format(cfg.aPath))
+        zk.ensure_path(groupPath)
+
+        ## host, hostvars, group membership and its index entries in one transaction
+        ops  = hostVarsOps(hostName, None, znodeDict[groupName][hostName], getLayout(zk))
+        ops += addMemberOps(zk, [(groupName, hostName)], hostGroupsIndexed(zk))
+        ops += varIndexOps(zk, [(hostName, {}, znodeDict[groupName][hostName])])
+        commitOrRaise(zk, ops)
+        markInventoryChanged(zk)
+
+        return CommonInformer('ADDED_HOST_TO_GROUP',COMMON_MSGS['ADDED_HOST_TO_GROUP']).format()
+
+    
+
+@measured
+def addHostToGroup(znodeStringSplited):
+    '''
+    Add host to group.
+
+    Return string (ADDED  ==> host: hostname to group: groupname).
+    '''
+
+    zk = zkStartRw()
+
+    groupName, groupPath              = znodeStringSplited[0]
+    hostName, hostPath, hostGroupPath = znodeStringSplited[1]
+
+    ERROR_MSGS = {
+        'HOST_EXISTS_IN_GROUP': "ERROR  ==> host: {0} in group {1} exists !!!".format(hostName, groupName),
+        'HOST_DOES_NOT_EXIST': "ERROR  ==> host: {0} does not exist !!! Could not add non-existent host: {0} to group: {1}".format(hostName, groupName)
+    }
+
+    COMMON_MSGS = {
+        'ADDED_HOST_TO_GROUP': "ADDED  ==> host: {0} to group: {1}".format(hostName, groupName)
+    }
+  
+    if zk.exists(hostGroupPath):
+        return ArgError('HOST_EXISTS_IN_GROUP',ERROR_MSGS['HOST_EXISTS_IN_GROUP']).format()
+
+    if zk.exists(hostPath) is None:
+        return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
+    
+    zk.ensure_path(groupPath)
+    commitOrRaise(zk, addMemberOps(zk, [(groupName, hostName)], hostGroupsIndexed(zk)))
+    markInventoryChanged(zk)
+    return CommonInformer('ADDED_HOST_TO_GROUP',COMMON_MSGS['ADDED_HOST_TO_GROUP']).format()
+
+
+
+@measured
+def deleteZnodeRecur(znodeStringSplited):
     '''
     Delete znode recursivelly for a given string groupname or hosts:hostname or groupname:hostname.
 
-    Return string (DELETED||ERROR  ==> [host: hostname || group: groupname]).
+    Return string (DELETED||ERROR  ==> [host: hostname || group: groupname]).
+    '''
+
+    zk = zkStartRw()
+
+    if len(znodeStringSplited) > 1:  ## check if it is <groupname:hostname> case
+
+        groupName, groupPath              = znodeStringSplited[0]
+        hostName, hostPath, hostGroupPath = znodeStringSplited[1]
+
+        ERROR_MSGS = {
+            'HOST_DOES_NOT_EXIST': "ERROR  ==> could not delete host: {0} that does not exist !!!".format(hostName),
+            'HOST_DOES_NOT_EXISTS_IN_GROUP': "ERROR  ==> could not delete host: {0} that does not exist in group: {1} !!!".format(hostName, groupName),
+            'GROUP_DOES_NOT_EXIST': "ERROR  ==> could not delete group: {0} that does not exist !!!".format(groupName)
+        }
+
+        COMMON_MSGS = {
+            'DELETED_HOST_IN_GROUP': "DELETED ==> host: {0} in group: {1}".format(hostName, groupName),
+            'DELETED_GROUP': "DELETED ==> group: {0}".format(groupName),
+            'DELETED_HOST': "DELETED ==> host: {0}".format(hostName)
+            
+        }
+
+        
+        if zk.exists(hostPath) is None:
+            return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
+
+        if zk.exists(hostGroupPath) is None:
+            return  ArgError('HOST_DOES_NOT_EXISTS_IN_GROUP',ERROR_MSGS['HOST_DOES_NOT_EXISTS_IN_GROUP']).format()
+
+        ops = removeMemberOps(zk, [(groupName, hostName)])
+
+        ## delete group if there is only one host in it (groups with vars or in child groups are kept)
+        if len(zk.get_children(groupPath)) == 1 and not inGroupTree(readGroupTree(zk)[0]['groups'], groupName):
+            ops.append(('delete', groupPath, -1))
+
+        commitOrRaise(zk, ops)
+        markInventoryChanged(zk)
+        return CommonInformer('DELETED_HOST_IN_GROUP',COMMON_MSGS['DELETED_HOST_IN_GROUP']).format()
+
+    elif len(znodeStringSplited) == 1:  ## check if it is <groupname> or <hosts:hostname> case    
+        if len(znodeStringSplited[0]) == 2:  ## first check for group only
+    
+            groupName, groupPath = znodeStringSplited[0]
+
+            ERROR_MSGS  = {'GROUP_DOES_NOT_EXIST': "ERROR  ==> could not delete group: {0} that does not exist !!!".format(groupName)}
+            COMMON_MSGS = {'DELETED_GROUP': "DELETED ==> group: {0}".format(groupName)}
+   
+            if zk.exists(groupPath) is None:
+                return ArgError('GROUP_DOES_NOT_EXIST',ERROR_MSGS['GROUP_DOES_NOT_EXIST']).format()
+
+            else:
+                ## members with their index entries, the group and its place in group tree in one transaction
+                tree, version, chunks = readGroupTree(zk)
+
+                ops  = removeMemberOps(zk, [(groupName, host) for host in zk.get_children(groupPath)])
+                ops.append(('delete', groupPath, -1))
+                ops += groupTreeOps(zk, tree, version, chunks, dropTreeGroup(tree['groups'], groupName), skip=[groupName])
+                commitOrRaise(zk, ops)
+                markInventoryChanged(zk)
+                return CommonInformer('DELETED_GROUP',COMMON_MSGS['DELETED_GROUP']).format()
+        
+        else:  ## then assume check for hosts only 
+
+            hostName, hostPath, notUsedValue = znodeStringSplited[0]
+
+            ERROR_MSGS  = {'HOST_DOES_NOT_EXIST': "ERROR  ==> could not delete host: {0} that does not exist !!!".format(hostName)}
+            COMMON_MSGS = {'DELETED_HOST': "DELETED ==> host: {0}".format(hostName)}
+            
+            if zk.exists(hostPath) is None:
+                return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
+
+            else:
+                ## memberships in the host's groups only, its index znodes and the host in one transaction
+                indexHostPath = "{0}/index/host-groups/{1}".format(cfg.aPath, hostName)
+                groups        = fetchHostGroups(zk, [hostName])[hostName]
+                indexed       = indexedVars(zk)
+
+                ops = removeMemberOps(zk, [(group, hostName) for group in groups], withIndex=False)
+
+                if indexed:
+                    ops += varIndexOps(zk, [(hostName, fetchHostVars(zk, [hostName])[hostName], {})], indexed)
+
+                if zk.exists(indexHostPath) is not None:
+                    ops += subtreeDeleteOps(zk, indexHostPath)
+
+                ops += subtreeDeleteOps(zk, hostPath)
+                commitOrRaise(zk, ops)
+                markInventoryChanged(zk)
+                return CommonInformer('DELETED_HOST',COMMON_MSGS['DELETED_HOST']).format()
+        
+    else:  ## Unknown cases        
+        return "ERROR with processing znodeStrings !!!"           
+
+
+
+@measured
+def updateZnode(znodeDict, createMissing=False):
+    '''
+    Update znode with hostvars in one transaction at hostvar versions read beforehand,
+    retried when a concurrent writer changed the host. Hostvars which do not exist are created
+    in the same transaction when createMissing is set.
+
+    Return string (ERROR ... || UPDATED ... || NOT UPDATED ...).
+    '''
+
+
+    # COMMON_MSGS = {
+    #     'DELETED_HOST_IN_GROUP': "DELETED ==> host: {0} in group: {1}".format(hostName, groupName),
+    #     'DELETED_GROUP': "DELETED ==> group: {0}".format(groupName),
+    #     'DELETED_HOST': "DELETED ==> host: {0}".format(hostName)
+
+    # }
+
+    
+    zk = zkStartRw()
+    
+    groupName   = list(znodeDict.keys())[0]
+    hostName    = list(znodeDict[groupName].keys())[0]
+    hostPath    = "{0}/hosts/{1}".format(cfg.aPath, hostName)
+
+    ERROR_MSGS = {
+        'HOST_DOES_NOT_EXIST': "ERROR  ==> could not update host: {0} that does not exist !!!".format(hostName)
+        # 'HOST_DOES_NOT_EXISTS_IN_GROUP': "ERROR  ==> could not delete host: {0} that does not exist in group: {1} !!!".format(hostName, groupName),
+        # 'GROUP_DOES_NOT_EXIST': "ERROR  ==> could not delete group: {0} that does not exist !!!".format(groupName)
+    }
+
+    
+    modCounterPath = "{}/modcounter".format(cfg.aPath)
+    varDict        = znodeDict[groupName][hostName]
+
+    for attempt in writeAttempts():
+        versions = {}
+        layout, indexed, counterStat, records = readUpdateState(zk, [hostName], versions)
+        record   = records[hostName]
+
+        if record is None:
+#            return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
+            return "ERROR  ==> could not update host: {0} that does not exist !!!".format(hostName)
+
+        updatedDict, createdDict, nonExistList, writeDict = splitUpdateVars(record, varDict, createMissing)
+        ops = []
+
+        if writeDict:
+            ops = (hostVarsOps(hostName, record, writeDict, layout, versions=versions) +
+                   varIndexOps(zk, [updateChange(hostName, record, writeDict)], indexed))
+
+        if ops and counterStat is not None:
+            ops.append(('set_data', modCounterPath, b'', -1))
+
+        error = commitOps(zk, ops)
+
+        if error is None:
+            break
+    else:
+        ## concurrent writer kept changing the host
+        raise error
+
+    if ops:
+        if counterStat is None:
+            markInventoryChanged(zk)
+        else:
+            dropHostStore()
+            if cfg.snapshotOnWrite:
+                rebuildSnapshot(zk)
+
+    return updateMessage(hostName, updatedDict, createdDict, nonExistList)
+
+
+def readUpdateState(zk, hostList, versions):
+    '''
+    Read layout marker, indexed hostvars and modcounter along with host records of hostList
+    (in both storage forms), versions of hostvar znodes are stored into versions dict.
+
+    Return tuple (layout, indexed hostvars, modcounter stat or None, {hostname: record}).
+    '''
+
+    ## zookeeper answers requests of a session in order, so the first round trip reads layout marker,
+    ## indexed hostvars, modcounter and host listings, the next one hostvar znodes with their versions
+    layoutAsync  = zk.get_async("{}/layout".format(cfg.aPath))
+    indexAsync   = zk.get_children_async("{}/index/vars".format(cfg.aPath))
+    counterAsync = zk.exists_async("{}/modcounter".format(cfg.aPath))
+    records      = dict(iterHostRecords(zk, hostList, 'migrating:v2', versions))
+
+    try:
+        layout = layoutAsync.get()[0].decode('utf-8') or 'v1'
+    except NoNodeError:
+        layout = 'v1'
+
+    try:
+        indexed = indexAsync.get()
+    except NoNodeError:
+        indexed = []
+
+    return layout, indexed, counterAsync.get(), records
+
+
+def splitUpdateVars(record, varDict, createMissing=False):
+    '''
+    Split hostvars given to update into existing ones of host record and missing ones,
+    which are created when createMissing is set.
+
+    Return tuple (updated dict, created dict, list of not updated, dict of hostvars to write).
+    '''
+
+    hostVarList  = recordVars(record)
+    nonExistList = []
+    updatedDict  = {}
+    createdDict  = {}
+
+    for var in varDict:
+        varVal  = varDict[var]
+
+        if var in hostVarList: ## check if given variable exists
+            updatedDict[var] = varVal
+
+        elif createMissing:
+            createdDict[var] = varVal
+
+        else:
+            nonExistList.append(var)
+
+    writeDict = dict(updatedDict)
+    writeDict.update(createdDict)
+
+    return updatedDict, createdDict, nonExistList, writeDict
+
+
+def updateChange(hostName, record, writeDict):
+    '''
+    Return tuple (hostname, oldVars, newVars) of hostvars written on top of host record (see varIndexOps).
+    '''
+
+    oldVars = recordVars(record)
+    newVars = dict(oldVars)
+    newVars.update((var, hostVarText(val)) for var, val in writeDict.items())
+
+    return hostName, oldVars, newVars
+
+
+def updateMessage(hostName, updatedDict, createdDict, nonExistList):
+    '''
+    Return string (UPDATED ... || NOT UPDATED ...).
+    '''
+
+    if len(createdDict) > 0 and len(updatedDict) == 0:
+        return "UPDATED  ==> host: {0} with created hostvars {1}".format(hostName, createdDict)
+
+    elif len(createdDict) > 0:
+        return "UPDATED  ==> host: {0} with new hostvars {1} ===> CREATED hostvars {2}".format(hostName, updatedDict, createdDict)
+
+    elif len(nonExistList) > 0 and len(updatedDict) == 0:
+        return "NOT UPDATED  ==> host: {0} with no existing hostvars {1} ===> NOT UPDATED hostvars {2} which do not exist".format(hostName, updatedDict, nonExistList)
+
+    elif len(nonExistList) and len(updatedDict) > 0:
+        return "UPDATED  ==> host: {0} with new hostvars {1} ===> NOT UPDATED hostvars {2} which do not exist".format(hostName, updatedDict, nonExistList)
+
+    else:
+        return "UPDATED  ==> host: {0} with new hostvars {1}".format(hostName, updatedDict)
+
+
+def isHostPattern(hostName):
+    '''
+    Return bool (hostname given to -U is a glob pattern matching group members).
+    '''
+
+    return any(char in hostName for char in '*?[')
+
+
+def patternMembers(zk, groupName):
+    '''
+    Read hosts a -U host glob pattern is matched against: members of the group and of its child groups
+    (flattened in group tree, see readGroupTree), every host for groupname hosts.
+
+    Return set of hostnames or None (group does not exist).
+    '''
+
+    if groupName == 'hosts':
+        return set(zk.get_children("{}/hosts".format(cfg.aPath)))
+
+    if zk.exists("{0}/groups/{1}".format(cfg.aPath, groupName)) is None:
+        return None
+
+    groupList = [groupName] + readGroupTree(zk)[0]['descendants'].get(groupName, [])
+
+    return set(host for members in fetchGroupMembers(zk, groupList).values() for host in members)
+
+
+@measured
+def updateGroupZnodes(znodeDict, createMissing=False):
+    '''
+    Update hostvars of every member of a group matching a host glob pattern (groupname:* for all members,
+    hosts:pattern for all hosts). Hosts of child groups are members of the group as well (like -S shows them).
+    Members are read once, hosts are read with pipelined async calls
+    and written at hostvar versions read beforehand in transactions of whole hosts, hosts
+    of a transaction failed by a concurrent writer are read and applied again.
+
+    Return list of strings (result per host followed by summary).
+    '''
+
+    zk = zkStartRw()
+
+    groupName = list(znodeDict.keys())[0]
+    pattern   = list(znodeDict[groupName].keys())[0]
+    varDict   = znodeDict[groupName][pattern]
+
+    members = patternMembers(zk, groupName)
+
+    if members is None:
+        return ["ERROR  ==> could not update hosts of group: {0} that does not exist !!!".format(groupName)]
+
+    pending = sorted(fnmatch.filter(members, pattern))
+    results = {}
+    written = False
+
+    for attempt in writeAttempts():
+        if not pending:
+            break
+
+        versions = {}
+        layout, indexed, counterStat, records = readUpdateState(zk, pending, versions)
+        planned  = []
+
+        for host in pending:
+            record = records[host]
+
+            if record is None:  ## member without host znode or deleted in the meantime
+                results[host] = "ERROR  ==> could not update host: {0} that does not exist !!!".format(host)
+                continue
+
+            updatedDict, createdDict, nonExistList, writeDict = splitUpdateVars(record, varDict, createMissing)
+            results[host] = updateMessage(host, updatedDict, createdDict, nonExistList)
+
+            if writeDict:
+                ops = hostVarsOps(host, record, writeDict, layout, versions=versions)
+                if ops:
+                    planned.append((host, ops, updateChange(host, record, writeDict)))
+
+        pending = []
+
+        for batch in hostOpsBatches(planned):
+            ops   = [op for host, hostOps, change in batch for op in hostOps]
+            error = commitOps(zk, ops + varIndexOps(zk, [change for host, hostOps, change in batch], indexed))
+
+            if error is None:
+                written = True
+            else:  ## concurrent writer changed some host of the batch, read them again
+                pending += [host for host, hostOps, change in batch]
+
+    for host in pending:
+        results[host] = "ERROR  ==> could not update host: {0} changed by concurrent writers !!!".format(host)
+
+    if written:
+        markInventoryChanged(zk)
+
+    return [results[host] for host in sorted(results)] + [patternSummary(groupName, pattern, results.values())]
+
+
+def patternSummary(groupName, pattern, resultList):
+    '''
+    Return string (summary of -U host glob pattern results).
+    '''
+
+    counts = {}
+
+    for line in resultList:
+        status = line.split('  ==>')[0]
+        counts[status] = counts.get(status, 0) + 1
+
+    return "SUMMARY  ==> group: {0}, hosts matching {1}: {2} ({3} updated, {4} not updated, {5} errors)".format(
+        groupName, pattern, len(resultList), counts.get('UPDATED', 0), counts.get('NOT UPDATED', 0), counts.get('ERROR', 0))
+
+
+def hostOpsBatches(planned):
+    '''
+    Group planned host updates [(hostname, ops, change)] into batches of whole hosts
+    fitting one transaction (see chunkOps), a host larger than that makes a batch of its own.
+
+    Return list of lists.
+    '''
+
+    batches, batch, batchOps, batchBytes = [], [], 0, 0
+
+    for entry in planned:
+        entryBytes = sum(opSize(op) for op in entry[1])
+
+        if batch and (batchOps + len(entry[1]) > cfg.txnMaxOps or batchBytes + entryBytes > cfg.txnMaxBytes):
+            batches.append(batch)
+            batch, batchOps, batchBytes = [], 0, 0
+
+        batch.append(entry)
+        batchOps   += len(entry[1])
+        batchBytes += entryBytes
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+@measured
+def renameZnode(znodeRenameStringSplited):
+    '''
+    Rename znode for a given tuple of ((oldName, oldPath), (newName, newPath)).
+
+    Return string (ERROR ... || RENAMED ... || NOT RENAMED ...).
+    '''
+    
+    zk = zkStartRw()
+
+    oldName, oldPath  = znodeRenameStringSplited[0]
+    newName, newPath  = znodeRenameStringSplited[1]
+    
+    if zk.exists(oldPath) is None:
+        return "ERROR  ==> could not rename nonexistent path: {0} !!!".format(oldPath)
+
+    if zk.exists(newPath) is not None:
+        return "ERROR  ==> new path already exist: {0} !!!".format(newPath)
+
+    ## rename only when newPath does not exist
+    if zk.exists(newPath) is None:
+        if 'hosts' in oldPath:
+            ## create newPath in hosts copy hostvars from oldPath in current layout
+            layout  = getLayout(zk)
+            varDict = fetchHostVars(zk, [oldName], layout)[oldName]
+            ops     = hostVarsOps(newName, None, varDict, layout)
+
+            ## rename host in the groups it is member of (found in host-groups index)
+            groups  = fetchHostGroups(zk, [oldName])[oldName]
+            ops    += addMemberOps(zk, [(group, newName) for group in groups], hostGroupsIndexed(zk))
+            ops    += removeMemberOps(zk, [(group, oldName) for group in groups], withIndex=False)
+            ops    += varIndexOps(zk, [(oldName, varDict, {}), (newName, {}, varDict)])
+
+            ## delete oldPath from hosts and its index znode, all in one transaction
+            oldIndexPath = "{0}/index/host-groups/{1}".format(cfg.aPath, oldName)
+            if zk.exists(oldIndexPath) is not None:
+                ops += subtreeDeleteOps(zk, oldIndexPath)
+
+            ops += subtreeDeleteOps(zk, oldPath)
+            commitOrRaise(zk, ops)
+            markInventoryChanged(zk)
+
+            for group in groups:
+                print("RENAMED host {0} in group {1} --> {2}".format(oldName, group, newName))
+
+            return "RENAMED {0} --> {1}".format(oldName, newName)
+
+        elif 'groups' in oldPath:
+        ## look for hosts in the group, create new group
+        ## delete theirs znode in that group ONLY and create new ones in the group
+
+            oldChildren = zk.get_children(oldPath)
+            groupData   = zk.get(oldPath)[0]
+
+            ops  = [('create', newPath, groupData)]
+            ops += addMemberOps(zk, [(newName, child) for child in oldChildren], hostGroupsIndexed(zk))
+
+            ## delete old group with its members and their index entries, rename it in group tree
+            tree, version, chunks = readGroupTree(zk)
+
+            ops += removeMemberOps(zk, [(oldName, child) for child in oldChildren])
+            ops.append(('delete', oldPath, -1))
+            ops += groupTreeOps(zk, tree, version, chunks, dropTreeGroup(tree['groups'], oldName, newName), skip=[oldName])
+            commitOrRaise(zk, ops)
+            markInventoryChanged(zk)
+            return "RENAMED group {0} --> {1}".format(oldName, newName)
+
+        else:
+            return "ERROR no valid keywords <groups|hosts> found"
+
+            
+            
+@measured
+def showHostVars(znodeStringSplited, zk=None):
+    '''
+    Show hostvars for a given hosts:hostname or groupname.
+    
+    Return dict or string (in case of ERROR).
+    '''
+
+    if zk is None:
+        return consistentRead(zkStartFanout(), lambda reader: showHostVars(znodeStringSplited, reader))
+
+    if len(znodeStringSplited[0]) == 2:    ## check for groupname only
+
+        groupName, groupPath = znodeStringSplited[0]
+
+        if zk.exists(groupPath) is None:
+            return "ERROR  ==> no such groupname: {0} !!!".format(groupName)
+
+        else:
+            ## hosts of child groups (flattened in group tree) are hosts of the group as well
+            groupList = [groupName] + readGroupTree(zk)[0]['descendants'].get(groupName, [])
+            hostList  = []
+
+            for group, members in sorted(fetchGroupMembers(zk, groupList).items()):
+                hostList += [host for host in members if host not in hostList]
+
+            return fetchHostVars(zk, hostList)
+                
+    elif len(znodeStringSplited[0]) == 3:     ## check for hostname only   
+
+        hostName, hostPath, notUsedValue =  znodeStringSplited[0]
+
+        if zk.exists(hostPath) is None:
+            return "ERROR  ==> no such host: {0} !!!".format(hostName)
+
+        else:
+            return fetchHostVars(zk, [hostName])
+
+    else:
+        return "ERROR with processing znodeStrings !!!"
+
+
+@measured
+def inventoryDump(dumpMode, zk=None):
+    '''
+    User friendly inventory dump for all|groups modes.
+    
+    Return dict or list.
+    '''
+
+    if zk is None:
+        return consistentRead(zkStartFanout() if dumpMode == 'all' else zkStartRo(), lambda reader: inventoryDump(dumpMode, reader))
+
+    # from ipdb import set_trace; set_trace()
+    hostsList  = sorted(zk.get_children("{}/hosts".format(cfg.aPath)))
+    groupsList = sorted(zk.get_children("{}/groups".format(cfg.aPath)))
+    dumpDict   = {"hosts": hostsList}
+
+    tmpList = []
+
+    if dumpMode == 'hosts':
+        return hostsList
+
+    elif dumpMode == 'groups':
+        return groupsList
+
+    elif dumpMode == 'all':
+        groupMembers = fetchGroupMembers(zk, groupsList)
+
+        for group in groupsList:
+            tmpDict  = {}
+            tmpDict[group] = sorted(groupMembers[group])
+            tmpList.append(tmpDict)
+            
+            dumpDict["groups"] = tmpList
+
+        return dumpDict
+
+
+@measured
+def ansibleInventoryDump(zk=None, scope=None):
+    '''
+    Ansible compliant inventory dump for a given list of zookeeper servers and ansible-keeper path,
+    narrowed to hosts of groups from scope (see scopedInventory) when given.
+    
+    Return dict.
+    '''
+
+    ## The stock inventory script system detailed above works for all versions of Ansible, but calling --host for
+    ## every host can be rather expensive, especially if it involves expensive API calls to a remote subsystem.
+    ## In Ansible 1.3 or later, if the inventory script returns a top level element called “_meta”,
+    ## it is possible to return all of the host variables in one inventory script call. When this meta element
+    ## contains a value for “hostvars”, the inventory script will not be invoked with --host for each host.
+    ## This results in a significant performance increase for large numbers of hosts, and also makes client side
+    ## caching easier to implement for the inventory script.
+    ##
+    ## Source: http://docs.ansible.com/ansible/dev_guide/developing_inventory.html#tuning-the-external-inventory-script
+
+    if zk is None:
+        return consistentRead(zkStartFanout(), lambda reader: ansibleInventoryDump(reader, scope))
+
+    groupList    = zk.get_children("{}/groups".format(cfg.aPath))
+    groupMembers = fetchGroupMembers(zk, groupList)
+    groupTree    = readGroupTree(zk)[0]
+    groupDict    = {}
+
+    if scope is not None:
+        scopeHosts = scopeHostSet(groupMembers, groupTree, scope)
+
+        for group in groupList:
+            groupDict[group] = groupEntry([host for host in groupMembers[group] if host in scopeHosts], groupTree, group)
+
+        ## hostvars only of hosts in scope, members without host znode are left out like in full dump
+        groupDict['_meta'] = {'hostvars': dict((host, recordVars(record)) for host, record in
+                                               iterHostRecords(zk, sorted(scopeHosts), getLayout(zk)) if record is not None)}
+        return groupDict
+    
+    for group in groupList:
+        groupDict[group] = groupEntry(groupMembers[group], groupTree, group)
+        
+    ## building ansible compliant hostvars dict:
+    ##
+    ## {"_meta": {
+    ##     "hostvars": {
+    ##         "moocow.example.com": {"asdf" : 1234, "var2": 111 },
+    ##         "llama.example.com": {"asdf": 5678, "var2": 222 }
+    ##     }
+    ## }}
+
+    hostList    = zk.get_children("{}/hosts".format(cfg.aPath))
+    hostVarDict = {}
+
+    ## modify output dict to be compliant with ansible >= 1.3 version
+    hostVarDict['hostvars'] = fetchHostVars(zk, hostList)
+    groupDict['_meta']      = hostVarDict
+
+    return groupDict
+
+
+def groupEntry(members, tree, group):
+    '''
+    Ansible compliant group entry with vars and child groups taken from precomputed group tree.
+
+    Return dict ({'hosts': [hostname1], 'vars': {var1: value1}[, 'children': [groupname1]]}).
+    '''
+
+    record = tree['groups'].get(group, {'vars': {}, 'children': []})
+    entry  = {'hosts': members, 'vars': record['vars']}
+
+    if record['children']:
+        entry['children'] = record['children']
+
+    return entry
+
+
+def iterAnsibleInventoryJson(zk=None, scope=None):
+    '''
+    Ansible compliant inventory dump rendered into JSON text while groups and hostvars are fetched,
+    same output as json.dumps(ansibleInventoryDump(scope=scope)) holding at most cfg.fetchWindow hosts in memory.
+
+    Return generator of strings.
+    '''
+
+    if zk is None:
+        zk = zkStartRo()
+
+    groupList  = zk.get_children("{}/groups".format(cfg.aPath))
+    groupTree  = readGroupTree(zk)[0]
+    requests   = [('get_children', "{0}/groups/{1}".format(cfg.aPath, group)) for group in groupList]
+    scopeHosts = None
+
+    if scope is not None:
+        ## members of groups in scope are needed before the first group is rendered
+        scopeGroups = set(scopeGroupList(groupTree, scope)) & set(groupList)
+        scopeHosts  = scopeHostSet(fetchGroupMembers(zk, sorted(scopeGroups)), groupTree, scope)
+
+    yield '{'
+
+    for group, (path, members) in zip(groupList, pipelineRequests(zk, requests)):
+        members = [host for host in members or [] if scopeHosts is None or host in scopeHosts]
+        yield '{0}: {1}, '.format(json.dumps(group), json.dumps(groupEntry(members, groupTree, group)))
+
+    yield '"_meta": {"hostvars": {'
+
+    if scopeHosts is None:
+        hostVars = iterHostVars(zk, zk.get_children("{}/hosts".format(cfg.aPath)))
+    else:
+        hostVars = ((host, recordVars(record)) for host, record in
+                    iterHostRecords(zk, sorted(scopeHosts), getLayout(zk)) if record is not None)
+
+    for number, (host, varDict) in enumerate(hostVars):
+        yield '{0}{1}: {2}'.format(', ' if number else '', json.dumps(host), json.dumps(varDict))
+
+    yield '}}}'
+
+
+def fanoutInventoryJson(scope=None):
+    '''
+    Ansible compliant inventory JSON (see iterAnsibleInventoryJson) read over fanout reader, pieces are
+    collected before they are written out only when fanout sessions are checked (see consistentRead).
+
+    Return iterable of strings.
+    '''
+
+    reader = zkStartFanout()
+
+    if not isinstance(reader, FanoutReader):
+        return iterAnsibleInventoryJson(reader, scope)
+
+    return consistentRead(reader, lambda zk: list(iterAnsibleInventoryJson(zk, scope)))
+
+
+def parseScope(scopeString):
+    '''
+    Parse comma separated groupnames of --groups option or ANSIBLE_KEEPER_GROUPS.
+
+    Return list or None (no scope, whole inventory).
+    '''
+
+    scope = [group.strip() for group in (scopeString or '').split(',') if group.strip()]
+
+    return scope or None
+
+
+def scopeGroupList(groupTree, scope):
+    '''
+    Groups from scope with their child groups (flattened in precomputed group tree).
+
+    Return list.
+    '''
+
+    groups = set(scope)
+
+    for group in scope:
+        groups.update(groupTree['descendants'].get(group, []))
+
+    return sorted(groups)
+
+
+def scopeHostSet(groupMembers, groupTree, scope):
+    '''
+    Hosts of groups from scope and of their child groups, groupMembers ({groupname: [hostname1]})
+    has to hold members of these groups.
+
+    Return set.
+    '''
+
+    return set(host for group in scopeGroupList(groupTree, scope) for host in groupMembers.get(group, []))
+
+
+def scopedInventory(inventory, scope):
+    '''
+    Narrow ansible compliant inventory dict to hosts of groups from scope and of their child groups:
+    other hosts are left out of group host lists and of _meta hostvars, groups with their vars are kept.
+
+    Return dict.
+    '''
+
+    groups, pending = set(), list(scope)
+
+    while pending:
+        group = pending.pop()
+        if group != '_meta' and group in inventory and group not in groups:
+            groups.add(group)
+            pending += inventory[group].get('children', [])
+
+    hosts  = set(host for group in groups for host in inventory[group].get('hosts', []))
+    scoped = {}
+
+    for group, entry in inventory.items():
+        if group != '_meta':
+            scoped[group] = dict(entry, hosts=[host for host in entry.get('hosts', []) if host in hosts])
+
+    scoped['_meta'] = {'hostvars': dict((host, varDict) for host, varDict in
+                                        inventory.get('_meta', {}).get('hostvars', {}).items() if host in hosts)}
+    return scoped
+
+
+def inventoryCacheKey(zk):
+    '''
+    Read cheap znode stats which change on every inventory write.
+
+    Return list (inventory cache validation key).
+    '''
+
+    ## pzxid/cversion of hosts and groups catch added/deleted hosts and groups,
+    ## mzxid of modcounter catches everything else (hostvars, group members)
+
+    paths = ["{}/hosts".format(cfg.aPath), "{}/groups".format(cfg.aPath), "{}/modcounter".format(cfg.aPath)]
+    key   = [cfg.zkServers, cfg.aPath]
+
+    for path, stat in pipelineRequests(zk, [('exists', path) for path in paths]):
+        key.append(None if stat is None else [stat.pzxid, stat.cversion, stat.mzxid])
+
+    return key
+
+
+def openInventoryCache(key):
+    '''
+    Open cfg.cacheFile if it was stored with the same validation key.
+
+    Return file object positioned at inventory JSON or None (cache miss).
+    '''
+
+    ## cache file is the validation key JSON on the first line followed by inventory JSON,
+    ## so a cache hit is copied to the output without parsing the inventory
+
+    try:
+        f = open(cfg.cacheFile, 'r')
+    except (IOError, OSError):
+        return None
+
+    try:
+        if json.loads(f.readline()) == key:
+            return f
+    except ValueError:
+        pass
+
+    f.close()
+    return None
+
+
+def readInventoryCache(key):
+    '''
+    Read inventory from cfg.cacheFile if it was stored with the same validation key.
+
+    Return dict or None (cache miss).
+    '''
+
+    f = openInventoryCache(key)
+
+    if f is None:
+        return None
+
+    try:
+        with f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def teeInventoryCache(key, pieces):
+    '''
+    Pass inventory JSON text pieces through while storing them under validation key,
+    cfg.cacheFile is atomically replaced only after the last piece is passed.
+
+    Return generator of strings.
+    '''
+
+    ## write to a temporary file in the same directory and rename it over the cache file,
+    ## so concurrent readers see either the old or the new cache but never a partial one;
+    ## cache is best effort only, pieces are passed through even when it cannot be written
+
+    cacheDir = os.path.dirname(cfg.cacheFile) or '.'
+    f        = None
+
+    def discard():
+        try:
+            f.close()
+            os.unlink(tmpPath)
+        except (IOError, OSError):
+            pass
+
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+        fd, tmpPath = tempfile.mkstemp(dir=cacheDir, prefix='.inventory-')
+        f = os.fdopen(fd, 'w')
+        f.write(json.dumps(key) + '\n')
+    except (IOError, OSError):
+        if f is not None:
+            discard()
+        f = None
+
+    try:
+        for piece in pieces:
+            if f is not None:
+                try:
+                    f.write(piece)
+                except (IOError, OSError):
+                    discard()
+                    f = None
+            yield piece
+
+    except BaseException:
+        if f is not None:
+            discard()
+        raise
+
+    if f is not None:
+        try:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.replace(tmpPath, cfg.cacheFile)
+        except (IOError, OSError):
+            discard()
+
+
+def writeInventoryCache(key, inventory):
+    '''
+    Atomically replace cfg.cacheFile with inventory stored under validation key.
+    '''
+
+    for piece in teeInventoryCache(key, [json.dumps(inventory)]):
+        pass
+
+
+@measured
+def cachedAnsibleInventoryDump():
+    '''
+    Ansible compliant inventory dump served from cfg.cacheFile while zookeeper inventory is unchanged.
+
+    Return dict.
+    '''
+
+    if cfg.cacheFile is None:
+        return snapshotAnsibleInventoryDump()
+
+    zk = zkStartRo()
+
+    key = inventoryCacheKey(zk)
+
+    inventory = readInventoryCache(key)
+
+    if inventory is None:
+        ## key is read before the tree walk, so a write racing with the walk
+        ## only makes the next run miss the cache, never serve stale data
+        inventory = snapshotAnsibleInventoryDump(zk)
+        writeInventoryCache(key, inventory)
+
+    return inventory
+
+
+def readSnapshotData(zk):
+    '''
+    Read compressed inventory snapshot from {aPath}/snapshot if its stamp matches current modcounter.
+
+    Return bytes or None (missing or stale snapshot).
+    '''
+
+    ## {aPath}/snapshot data is a JSON header, its children are chunks of zlib compressed
+    ## ansibleInventoryDump() JSON named <build>-<number>; stamp is modcounter mzxid at build time
+
+    snapshotPath = "{}/snapshot".format(cfg.aPath)
+    requests     = [('get', snapshotPath), ('exists', "{}/modcounter".format(cfg.aPath))]
+    (path, header), (path, counterStat) = pipelineRequests(zk, requests)
+
+    if header is None or not header[0]:
+        return None
+
+    meta = json.loads(header[0].decode('utf-8'))
+
+    if meta.get('version') != 1 or meta.get('stamp') != (counterStat.mzxid if counterStat else 0):
+        return None
+
+    requests = [('get', "{0}/{1}-{2:04d}".format(snapshotPath, meta['build'], number)) for number in range(meta['chunks'])]
+    chunks   = [result for path, result in pipelineRequests(zk, requests)]
+
+    if None in chunks:  ## replaced by a newer build in the meantime
+        return None
+
+    return b''.join(data for data, stat in chunks)
+
+
+def readSnapshot(zk):
+    '''
+    Read inventory snapshot from {aPath}/snapshot if its stamp matches current modcounter.
+
+    Return dict or None (missing or stale snapshot).
+    '''
+
+    data = readSnapshotData(zk)
+
+    if data is None:
+        return None
+
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def iterSnapshotJson(data, pieceBytes=64 * 1024):
+    '''
+    Decompress inventory snapshot data piece by piece.
+
+    Return generator of strings.
+    '''
+
+    ## snapshot JSON is ASCII only (json.dumps escapes the rest), so pieces never split a character
+
+    decompressor = zlib.decompressobj()
+
+    for start in range(0, len(data), pieceBytes):
+        yield decompressor.decompress(data[start:start + pieceBytes]).decode('ascii')
+
+    yield decompressor.flush().decode('ascii')
+
+
+def snapshotAnsibleInventoryDump(zk=None):
+    '''
+    Ansible compliant inventory dump read from inventory snapshot when it is fresh,
+    from the tree otherwise (run --rebuild-snapshot to fix a stale one).
+
+    Return dict.
+    '''
+
+    if zk is None:
+        zk = zkStartRo()
+
+    inventory = readSnapshot(zk) if cfg.useSnapshot else None
+
+    if inventory is None:
+        inventory = ansibleInventoryDump(zk)
+
+    return inventory
+
+
+@measured
+def writeAnsibleInventory(out, noCache=False, scope=None):
+    '''
+    Write ansible compliant inventory JSON to out (file object) while it is read: from cfg.cacheFile
+    while zookeeper inventory is unchanged, from fresh inventory snapshot or straight from the tree,
+    cfg.cacheFile is refreshed on the way unless noCache is set.
+    With scope (list of groupnames) only hosts of these groups and their child groups are written,
+    a tree walk then reads hostvars of these hosts only and leaves cfg.cacheFile alone.
+    '''
+
+    zk       = zkStartRo()
+    useCache = cfg.cacheFile is not None and not noCache
+
+    if useCache:
+        key    = inventoryCacheKey(zk)
+        cached = openInventoryCache(key)
+
+        if cached is not None:
+            with cached:
+                if scope is None:
+                    shutil.copyfileobj(cached, out)
+                else:
+                    json.dump(scopedInventory(json.load(cached), scope), out)
+            out.write('\n')
+            return
+
+    data = readSnapshotData(zk) if cfg.useSnapshot else None
+
+    if scope is not None:
+        if data is None:
+            pieces = fanoutInventoryJson(scope)
+        else:  ## whole snapshot is cheaper than reading hostvars host by host
+            pieces = [json.dumps(scopedInventory(json.loads(''.join(iterSnapshotJson(data))), scope))]
+        useCache = False
+    else:
+        pieces = fanoutInventoryJson() if data is None else iterSnapshotJson(data)
+
+    if useCache:
+        ## key is read before the tree walk, so a write racing with the walk
+        ## only makes the next run miss the cache, never serve stale data
+        pieces = teeInventoryCache(key, pieces)
+
+    for piece in pieces:
+        out.write(piece)
+
+    out.write('\n')
+
+
+@measured
+def readAnsibleInventory(scope=None):
+    '''
+    Ansible compliant inventory from fresh inventory snapshot or straight from the tree for in-process
+    readers (ansible_keeper inventory plugin), narrowed to hosts of groups from scope when given.
+
+    Return dict.
+    '''
+
+    data = readSnapshotData(zkStartRo()) if cfg.useSnapshot else None
+
+    if data is None:
+        return ansibleInventoryDump(scope=scope)
+
+    inventory = json.loads(''.join(iterSnapshotJson(data)))
+
+    return inventory if scope is None else scopedInventory(inventory, scope)
+
+
+@measured
+def rebuildSnapshot(zk=None):
+    '''
+    Render ansibleInventoryDump() into {aPath}/snapshot chunks stamped with current modcounter,
+    switch snapshot header to them and delete chunks of the previous build.
+
+    Return string (REBUILT ... || NOT REBUILT ...).
+    '''
+
+    if zk is None:
+        zk = zkStartRw()
+
+    snapshotPath = "{}/snapshot".format(cfg.aPath)
+    counterStat  = zk.exists("{}/modcounter".format(cfg.aPath))
+    stamp        = counterStat.mzxid if counterStat else 0
+
+    ## stamp is read before the tree walk, a write racing with the walk makes the snapshot stale
+    inventory = ansibleInventoryDump(zk)
+    data      = zlib.compress(json.dumps(inventory, separators=(',', ':')).encode('utf-8'))
+    chunks    = [data[start:start + cfg.snapshotChunkBytes] for start in range(0, len(data), cfg.snapshotChunkBytes)]
+    build     = uuid.uuid4().hex
+    meta      = {'version': 1, 'stamp': stamp, 'build': build, 'chunks': len(chunks), 'bytes': len(data),
+                 'hosts': len(inventory['_meta']['hostvars'])}
+
+    zk.ensure_path(snapshotPath)
+    oldChunks = zk.get_children(snapshotPath)
+    oldStat   = zk.exists(snapshotPath)
+
+    error = commitOps(zk, [('create', "{0}/{1}-{2:04d}".format(snapshotPath, build, number), chunk)
+                           for number, chunk in enumerate(chunks)])
+    if error is not None:
+        raise error
+
+    try:
+        zk.set(snapshotPath, json.dumps(meta).encode('utf-8'), version=oldStat.version)
+    except BadVersionError:
+        ## concurrent rebuild switched the header first, drop our chunks
+        oldChunks = ["{0}-{1:04d}".format(build, number) for number in range(len(chunks))]
+        meta      = None
+
+    commitOps(zk, [('delete', "{0}/{1}".format(snapshotPath, chunk), -1) for chunk in oldChunks])
+
+    if meta is None:
+        return "NOT REBUILT  ==> snapshot was rebuilt concurrently"
+
+    return "REBUILT  ==> snapshot of {0} hosts in {1} chunks ({2} bytes) at stamp {3}".format(
+        meta['hosts'], meta['chunks'], meta['bytes'], stamp)
+
+
+@measured
+def ansibleHostAccess(hostName, zk=None, effective=False):
+    '''
+    Ansible pre 1.3 compliant hostvars dump, merged on top of the vars of the host's groups
+    and their parents when effective is set (ansible applies group vars of -I ansible itself).
+
+    Return dict.
+    '''
+
+    ## Before version 1.0, each group could only have a list of hostnames/IP addresses, like the webservers,
+    ## marietta, and 5points groups above.
+    ##
+    ## When called with the arguments --host <hostname> (where <hostname> is a host from above), the script
+    ## must print either an empty JSON hash/dictionary, or a hash/dictionary of variables to make available
+    ## to templates and playbooks. Printing variables is optional, if the script does not wish to do this,
+    ## printing an empty hash/dictionary is the way to go
+    ##
+    ## Source: http://docs.ansible.com/ansible/dev_guide/developing_inventory.html#script-conventions
+    
+    if zk is None:
+        zk = zkStartRo()
+
+    hostPath = "{0}/hosts/{1}".format(cfg.aPath, hostName)
+
+    if zk.exists(hostPath) is None:
+        return "ERROR  ==> no such host: {0} !!!".format(hostName)
+
+    hostVars  = fetchHostVars(zk, [hostName])[hostName]
+
+    if not effective:
+        return hostVars
+
+    groupTree = readGroupTree(zk)[0]
+
+    if not groupTree['groups']:  ## no group vars anywhere
+        return hostVars
+
+    ## vars of the host's groups and their parent groups merged from precomputed group tree
+    return effectiveHostVars(hostVars, fetchHostGroups(zk, [hostName])[hostName], groupTree)
+
+        
+    
+@measured
+def exportToToml(filePath):
+    '''
+    Export inventory to TOML file.
+    '''
+    inventory = ansibleInventoryDump()
+    with open(filePath, 'w') as f:
+        toml.dump(inventory, f)
+    return "Exported inventory to {}".format(filePath)
+
+def planImport(zk, groups, hostvars, layout, groupRecords=None, memberHosts=True):
+    '''
+    Plan creation of groups, hosts, group members and hostvars from groups ({groupname: [hostname1, hostname2]})
+    and hostvars ({hostname1: {var1: value1}}) which are missing or different in zookeeper, group vars and
+    child groups from groupRecords ({groupname: {'vars': {var1: value1}, 'children': [groupname1]}}) are added.
+    Every host is written once, no matter in how many groups it is, hosts of hostvars in no group are written too.
+    With memberHosts False only hosts of hostvars are written, other group members are only added to groups.
+
+    Return list of transaction operations or raise ValueError (child groups cycle).
+    '''
+
+    groupRecords = groupRecords or {}
+    groups       = dict(groups)
+
+    ## groups known only from [group:vars] or [group:children] sections are created as well
+    for group, record in groupRecords.items():
+        groups.setdefault(group, [])
+        for child in record.get('children', []):
+            groups.setdefault(child, [])
+
+    groupsPath = "{}/groups".format(cfg.aPath)
+    hostsPath  = "{}/hosts".format(cfg.aPath)
+
+    (path, groupList), (path, hostList) = pipelineRequests(zk, [('get_children', groupsPath), ('get_children', hostsPath)])
+    existingGroups = set(groupList or [])
+    existingHosts  = set(hostList or [])
+
+    members   = fetchGroupMembers(zk, [group for group in groups if group in existingGroups])
+    hostOrder = []
+    seen      = set()
+
+    for host in itertools.chain(*(list(groups.values()) + [hostvars])):
+        if host not in seen and (memberHosts or host in hostvars):
+            hostOrder.append(host)
+            seen.add(host)
+
+    records = dict(iterHostRecords(zk, [host for host in hostOrder if host in existingHosts], layout))
+    ops     = []
+    newList = []
+    changes = []
+
+    for host in hostOrder:
+        ops += hostVarsOps(host, records.get(host), hostvars.get(host, {}), layout)
+
+        oldVars = recordVars(records.get(host))
+        newVars = dict(oldVars)
+        newVars.update((var, hostVarText(val)) for var, val in hostvars.get(host, {}).items())
+        changes.append((host, oldVars, newVars))
+
+    ops += varIndexOps(zk, changes)
+
+    for group, hosts in groups.items():
+        memberSet = set(members.get(group, []))
+
+        if group not in existingGroups:
+            ops.append(('create', "{}/{}".format(groupsPath, group), b''))
+
+        for host in hosts:
+            if host not in memberSet:
+                newList.append((group, host))
+                memberSet.add(host)
+
+    ops += addMemberOps(zk, newList, hostGroupsIndexed(zk))
+
+    tree, version, chunks = readGroupTree(zk)
+    treeGroups = json.loads(json.dumps(tree['groups']))
+
+    for group, record in groupRecords.items():
+        treeRecord = treeGroups.setdefault(group, {'vars': {}, 'children': []})
+        treeRecord['vars'].update((var, hostVarText(val)) for var, val in record.get('vars', {}).items())
+        treeRecord['children'] = sorted(set(treeRecord['children']) | set(record.get('children', [])))
+
+    return ops + groupTreeOps(zk, tree, version, chunks, treeGroups)
+
+
+@measured
+def importInventory(source, groups, hostvars, dryRun=False, groupRecords=None):
+    '''
+    Import groups ({groupname: [hostname1, hostname2]}), hostvars ({hostname1: {var1: value1}}) and group vars
+    with child groups (see planImport) with chunked transactions, in dryRun mode only report planned operations.
+
+    Return string.
+    '''
+
+    if dryRun:
+        zk = zkStartRo()
+
+        try:
+            ops = planImport(zk, groups, hostvars, getLayout(zk), groupRecords)
+        except ValueError as e:
+            return "ERROR  ==> could not import inventory from {0}: {1} !!!".format(source, e)
+
+        return "DRY RUN  ==> import from {0}: {1} operations in {2} transactions ({3})".format(
+            source, len(ops), len(chunkOps(ops)), opsSummary(ops))
+
+    zk      = zkStartRw()
+    started = time.time()
+
+    zk.ensure_path("{}/groups".format(cfg.aPath))
+    zk.ensure_path("{}/hosts".format(cfg.aPath))
+    layout = getLayout(zk)
+
+    for attempt in writeAttempts():
+        try:
+            ops = planImport(zk, groups, hostvars, layout, groupRecords)
+        except ValueError as e:
+            return "ERROR  ==> could not import inventory from {0}: {1} !!!".format(source, e)
+
+        if attempt == 0:
+            planned = len(ops)
+
+        ## a chunk raced with a concurrent writer, committed chunks are not planned again
+        error = commitOps(zk, ops, progress="IMPORTING")
+
+        if error is None:
+            break
+    else:
+        ## chunks committed before the failed one changed the inventory
+        markInventoryChanged(zk)
+        raise error
+
+    markInventoryChanged(zk)
+
+    elapsed = max(time.time() - started, 1e-6)
+    return "Imported inventory from {0}: {1} operations in {2:.3f}s ({3:.0f} ops/s)".format(
+        source, planned, elapsed, planned / elapsed)
+
+
+def planSummary(plan):
+    '''
+    Count planned changes (see planChangeset) by kind.
+
+    Return string (hosts: +1 -0 ~2, groups: +0 -0 ~1, members: +1 -0).
+    '''
+
+    counts = dict(((kind, mark), 0) for kind in ('host', 'group', 'member') for mark in '+-~')
+
+    for change in plan:
+        mark, kind = change.split(' ', 2)[:2]
+        counts[(kind, mark)] += 1
+
+    return "hosts: +{0} -{1} ~{2}, groups: +{3} -{4} ~{5}, members: +{6} -{7}".format(
+        counts[('host', '+')], counts[('host', '-')], counts[('host', '~')],
+        counts[('group', '+')], counts[('group', '-')], counts[('group', '~')],
+        counts[('member', '+')], counts[('member', '-')])
+
+
+@measured
+def syncInventory(source, groups, hostvars, groupRecords=None, dryRun=False, force=False):
+    '''
+    Make zookeeper inventory match groups ({groupname: [hostname1, hostname2]}), hostvars ({hostname1: {var1: value1}})
+    and group records (see planImport): hosts, groups, members, hostvars and group vars missing in them are deleted,
+    the rest is written only where it differs, with chunked transactions. In dryRun mode only report planned changes.
+    Empty inventory (which would delete everything) is refused unless force is set.
+
+    Return string.
+    '''
+
+    ## the inventory is turned into a changeset covering every host and group (see planChangeset),
+    ## hosts are members of groups or have hostvars
+    groupRecords = groupRecords or {}
+    changeset    = {'groups': {}, 'hosts': {}}
+
+    for group in set(groups) | set(groupRecords) | set(child for record in groupRecords.values()
+                                                        for child in record.get('children', [])):
+        record = groupRecords.get(group, {})
+        changeset['groups'][group] = {
+            'hosts': sorted(set(groups.get(group, []))),
+            'vars': dict((var, hostVarText(val)) for var, val in record.get('vars', {}).items()),
+            'children': sorted(set(record.get('children', [])))}
+
+    for host in set(host for members in groups.values() for host in members) | set(hostvars):
+        changeset['hosts'][host] = dict((var, hostVarText(val)) for var, val in hostvars.get(host, {}).items())
+
+    changeset['groupList'] = sorted(changeset['groups'])
+    changeset['hostList']  = sorted(changeset['hosts'])
+
+    if not (changeset['groups'] or changeset['hosts'] or dryRun or force):
+        return "ERROR  ==> no hosts or groups in {0}, sync would delete the whole inventory (use --force) !!!".format(source)
+
+    if dryRun:
+        zk = zkStartRo()
+
+        try:
+            ops, plan = planChangeset(zk, changeset, getLayout(zk))
+        except ValueError as e:
+            return "ERROR  ==> could not sync inventory from {0}: {1} !!!".format(source, e)
+
+        return '\n'.join(plan + ["DRY RUN  ==> sync from {0}: {1}, {2} operations in {3} transactions ({4})".format(
+            source, planSummary(plan), len(ops), len(chunkOps(ops)), opsSummary(ops))])
+
+    zk      = zkStartRw()
+    started = time.time()
+
+    zk.ensure_path("{}/groups".format(cfg.aPath))
+    zk.ensure_path("{}/hosts".format(cfg.aPath))
+    layout = getLayout(zk)
+
+    for attempt in writeAttempts():
+        try:
+            ops, plan = planChangeset(zk, changeset, layout)
+        except ValueError as e:
+            return "ERROR  ==> could not sync inventory from {0}: {1} !!!".format(source, e)
+
+        if attempt == 0:
+            planned = plan
+
+        ## a chunk raced with a concurrent writer, the rest is planned again from what is committed
+        error = commitOps(zk, ops, progress="SYNCING")
+
+        if error is None:
+            break
+    else:
+        ## chunks committed before the failed one changed the inventory
+        markInventoryChanged(zk)
+        raise error
+
+    markInventoryChanged(zk)
+
+    return "SYNCED  ==> inventory from {0}: {1} in {2:.3f}s".format(source, planSummary(planned), time.time() - started)
+
+
+def readTomlInventory(filePath):
+    '''
+    Read groups, hostvars and group records (see planImport) from TOML file.
+
+    Return tuple (groups, hostvars, groupRecords) or string (in case of ERROR).
+    '''
+    try:
+        with open(filePath, 'r') as f:
+            inventory = toml.load(f)
+    except (IOError, toml.TomlDecodeError) as e:
+        return "Error reading TOML file: {}".format(e)
+
+    groups   = dict((group, data.get('hosts', [])) for group, data in inventory.items() if group != '_meta')
+    hostvars = inventory.get('_meta', {}).get('hostvars', {})
+    records  = dict((group, {'vars': data.get('vars', {}), 'children': data.get('children', [])})
+                    for group, data in inventory.items() if group != '_meta' and (data.get('vars') or data.get('children')))
+
+    return groups, hostvars, records
+
+
+def importFromToml(filePath, dryRun=False):
+    '''
+    Import inventory from TOML file.
+    '''
+    inventory = readTomlInventory(filePath)
+
+    if not isinstance(inventory, tuple):
+        return inventory
+
+    groups, hostvars, records = inventory
+    return importInventory(filePath, groups, hostvars, dryRun, records)
+
+
+def syncFromToml(filePath, dryRun=False, force=False):
+    '''
+    Make zookeeper inventory match TOML file.
+    '''
+    inventory = readTomlInventory(filePath)
+
+    if not isinstance(inventory, tuple):
+        return inventory
+
+    groups, hostvars, records = inventory
+    return syncInventory(filePath, groups, hostvars, records, dryRun, force)
+
+
+@measured
+def exportToIni(filePath):
+    '''
+    Export inventory to INI file.
+    '''
+    inventory = ansibleInventoryDump()
+    config = configparser.ConfigParser(allow_no_value=True)
+
+    for group, data in inventory.items():
+        if group == '_meta':
+            continue
+        
+        config.add_section(group)
+        for host in data.get('hosts', []):
+            config.set(group, host, None)
+
+        if data.get('vars'):
+            config.add_section("{}:vars".format(group))
+            for var, val in data['vars'].items():
+                config.set("{}:vars".format(group), var, val)
+
+        if data.get('children'):
+            config.add_section("{}:children".format(group))
+            for child in data['children']:
+                config.set("{}:children".format(group), child, None)
+
+    if '_meta' in inventory and 'hostvars' in inventory['_meta']:
+        for host, hostvars in inventory['_meta']['hostvars'].items():
+            section_name = "hostvars:{}".format(host)
+            config.add_section(section_name)
+            for var, val in hostvars.items():
+                config.set(section_name, var, val)
+
+    with open(filePath, 'w') as f:
+        config.write(f)
+    return "Exported inventory to {}".format(filePath)
+
+def readIniInventory(filePath):
+    '''
+    Read groups, hostvars and group records (see planImport) from INI file.
+
+    Return tuple (groups, hostvars, groupRecords) or string (in case of ERROR).
+    '''
+    config = configparser.ConfigParser(allow_no_value=True)
+    try:
+        with open(filePath, 'r') as f:
+            config.read_file(f)
+    except (IOError, configparser.Error) as e:
+        return "Error reading INI file: {}".format(e)
+
+    groups, hostvars, records = {}, {}, {}
+
+    for section in config.sections():
+        if section.startswith('hostvars:'):
+            hostvars[section.split(':', 1)[1]] = dict(config.items(section))
+            continue
+
+        if section.endswith(':vars') or section.endswith(':children'):
+            group, kind = section.rsplit(':', 1)
+            record = records.setdefault(group, {'vars': {}, 'children': []})
+
+            if kind == 'vars':
+                record['vars'].update(config.items(section))
+            else:
+                record['children'] += config.options(section)
+            continue
+
+        groups[section] = config.options(section)
+
+    return groups, hostvars, records
+
+
+def importFromIni(filePath, dryRun=False):
+    '''
+    Import inventory from INI file.
+    '''
+    inventory = readIniInventory(filePath)
+
+    if not isinstance(inventory, tuple):
+        return inventory
+
+    groups, hostvars, records = inventory
+    return importInventory(filePath, groups, hostvars, dryRun, records)
+
+
+def syncFromIni(filePath, dryRun=False, force=False):
+    '''
+    Make zookeeper inventory match INI file.
+    '''
+    inventory = readIniInventory(filePath)
+
+    if not isinstance(inventory, tuple):
+        return inventory
+
+    groups, hostvars, records = inventory
+    return syncInventory(filePath, groups, hostvars, records, dryRun, force)
+
+
+class BinaryInventory(object):
+    '''
+    Memory mapped binary inventory written by exportToBinary, read without parsing the whole file:
+
+        header     magic, counts, hash table sizes, section offsets, zxid of the export
+        strings    (count + 1) file offsets of UTF-8 strings: hostnames, groupnames and var names
+        hosts      host records (name, number of groups, offset of group numbers, offset of hostvar blob)
+        groups     group records (name, number of members, offset of host numbers)
+        hash       open addressing tables of host and group numbers + 1 keyed by crc32 of the name
+        tree       length-prefixed group tree JSON (group vars and child groups, see buildGroupTree)
+
+    Hostvar blob is length-prefixed too: number of vars, then (var name, value length, value) per var.
+    Host with hostvar blob offset 0 is a group member without host znode.
+    '''
+
+    MAGIC  = b'AKINV\x00\x00\x01'
+    HEADER = struct.Struct('<8sIIIIIQQQQQQQ')
+    HOST   = struct.Struct('<IIQQ')
+    GROUP  = struct.Struct('<IIQ')
+
+    def __init__(self, filePath):
+        self.file = open(filePath, 'rb')
+
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            header    = self.HEADER.unpack_from(self.data, 0)
+        except (ValueError, struct.error, OSError):
+            self.file.close()
+            raise ValueError("not an ansible-keeper binary inventory")
+
+        if header[0] != self.MAGIC:
+            self.close()
+            raise ValueError("not an ansible-keeper binary inventory")
+
+        (magic, self.stringCount, self.hostCount, self.groupCount, self.hostSlots, self.groupSlots,
+         self.stringsAt, self.hostsAt, self.groupsAt, self.hostHashAt, self.groupHashAt, self.treeAt, self.zxid) = header
+
+        ## truncated or corrupt file: every section has to lie within the file
+        sections = ((self.stringsAt, 8 * (self.stringCount + 1)),
+                    (self.hostsAt, self.HOST.size * self.hostCount),
+                    (self.groupsAt, self.GROUP.size * self.groupCount),
+                    (self.hostHashAt, 4 * self.hostSlots),
+                    (self.groupHashAt, 4 * self.groupSlots),
+                    (self.treeAt, 4))
+
+        if any(offset < self.HEADER.size or offset + length > len(self.data) for offset, length in sections) or \
+           self.treeAt + 4 + struct.unpack_from('<I', self.data, self.treeAt)[0] > len(self.data):
+            self.close()
+            raise ValueError("truncated or corrupt binary inventory")
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @staticmethod
+    def slot(name, slots):
+        '''
+        Return int (first hash table slot of name).
+        '''
+
+        return zlib.crc32(name.encode('utf-8')) & (slots - 1)
+
+    def string(self, number):
+        start, end = struct.unpack_from('<QQ', self.data, self.stringsAt + 8 * number)
+        return self.data[start:end].decode('utf-8')
+
+    def find(self, name, hashAt, slots, tableAt, record):
+        '''
+        Look name up in hash table (linear probing).
+
+        Return tuple (record number, record fields) or None.
+        '''
+
+        slot = self.slot(name, slots)
+
+        for probe in range(slots):
+            number = struct.unpack_from('<I', self.data, hashAt + 4 * slot)[0]
+
+            if number == 0:
+                return None
+
+            fields = record.unpack_from(self.data, tableAt + record.size * (number - 1))
+
+            if self.string(fields[0]) == name:
+                return number - 1, fields
+
+            slot = (slot + 1) & (slots - 1)
+
+        return None
+
+    def host(self, hostName):
+        '''
+        Return tuple (host number, host record fields) or None.
+        '''
+
+        return self.find(hostName, self.hostHashAt, self.hostSlots, self.hostsAt, self.HOST)
+
+    def group(self, groupName):
+        '''
+        Return tuple (group number, group record fields) or None.
+        '''
+
+        return self.find(groupName, self.groupHashAt, self.groupSlots, self.groupsAt, self.GROUP)
+
+    def numbers(self, offset, count):
+        return struct.unpack_from('<{}I'.format(count), self.data, offset)
+
+    def hostName(self, number):
+        return self.string(self.HOST.unpack_from(self.data, self.hostsAt + self.HOST.size * number)[0])
+
+    def groupName(self, number):
+        return self.string(self.GROUP.unpack_from(self.data, self.groupsAt + self.GROUP.size * number)[0])
+
+    def hostVars(self, fields):
+        '''
+        Decode hostvar blob of host record fields.
+
+        Return dict ({var1: value1}) or None (group member without host znode).
+        '''
+
+        nameNumber, groupCount, groupsAt, blobAt = fields
+
+        if blobAt == 0:
+            return None
+
+        offset  = blobAt + 4  ## blob length
+        varDict = {}
+
+        for var in range(struct.unpack_from('<I', self.data, offset)[0]):
+            varNumber, length = struct.unpack_from('<II', self.data, offset + 4)
+            varDict[self.string(varNumber)] = self.data[offset + 12:offset + 12 + length].decode('utf-8')
+            offset += 8 + length
+
+        return varDict
+
+    def hostGroups(self, fields):
+        '''
+        Return list (groupnames of host record fields).
+        '''
+
+        return [self.groupName(number) for number in self.numbers(fields[2], fields[1])]
+
+    def groupMembers(self, fields):
+        '''
+        Return list (hostnames of group record fields).
+        '''
+
+        return [self.hostName(number) for number in self.numbers(fields[2], fields[1])]
+
+    def groupTree(self):
+        '''
+        Return dict (group tree, see buildGroupTree).
+        '''
+
+        length = struct.unpack_from('<I', self.data, self.treeAt)[0]
+        return json.loads(self.data[self.treeAt + 4:self.treeAt + 4 + length].decode('utf-8'))
+
+    def iterGroups(self):
+        '''
+        Return generator of (groupname, [hostname1, hostname2]) tuples in file order.
+        '''
+
+        for number in range(self.groupCount):
+            fields = self.GROUP.unpack_from(self.data, self.groupsAt + self.GROUP.size * number)
+            yield self.string(fields[0]), self.groupMembers(fields)
+
+    def iterHosts(self):
+        '''
+        Return generator of (hostname, [groupname1], {var1: value1} or None) tuples in file order.
+        '''
+
+        for number in range(self.hostCount):
+            fields = self.HOST.unpack_from(self.data, self.hostsAt + self.HOST.size * number)
+            yield self.string(fields[0]), self.hostGroups(fields), self.hostVars(fields)
+
+
+def hashTable(names, slot):
+    '''
+    Build open addressing hash table (linear probing) of record numbers + 1 for names,
+    at least twice as large as the number of names.
+
+    Return tuple (number of slots, bytes).
+    '''
+
+    slots = 1
+
+    while slots < 2 * len(names):
+        slots *= 2
+
+    table = [0] * slots
+
+    for number, name in enumerate(names):
+        position = slot(name, slots)
+
+        while table[position]:
+            position = (position + 1) & (slots - 1)
+
+        table[position] = number + 1
+
+    return slots, struct.pack('<{}I'.format(slots), *table)
+
+
+@measured
+def exportToBinary(filePath):
+    '''
+    Export inventory to binary file read by BinaryInventory, hostvars are streamed into the file while
+    they are fetched. The file is written next to filePath and renamed over it when complete.
+
+    Return string.
+    '''
+
+    zk = zkStartRo()
+
+    ## files read over fanout sessions at different inventory states are dropped (see consistentRead)
+    tmpPath, summary = consistentRead(zkStartFanout(), lambda reader: writeBinaryInventory(zk, reader, filePath),
+                                      lambda written: os.unlink(written[0]))
+    os.replace(tmpPath, filePath)
+
+    return summary
+
+
+def writeBinaryInventory(zk, reader, filePath):
+    '''
+    Write inventory read over reader into a temporary binary file next to filePath (see exportToBinary).
+
+    Return tuple (temporary file path, summary string).
+    '''
+
+    zk.sync(cfg.aPath)
+    zxid   = zk.last_zxid
+
+    groupList    = sorted(reader.get_children("{}/groups".format(cfg.aPath)))
+    groupMembers = fetchGroupMembers(reader, groupList)
+    hostZnodes   = reader.get_children("{}/hosts".format(cfg.aPath))
+    groupTree    = readGroupTree(reader)[0]
+
+    ## group members without host znode are kept as hosts without hostvar blob
+    hostList    = sorted(set(hostZnodes).union(*groupMembers.values()))
+    hostNumbers = dict((host, number) for number, host in enumerate(hostList))
+    hostGroups  = dict((host, []) for host in hostList)
+    strings     = {}
+
+    for number, group in enumerate(groupList):
+        for host in groupMembers[group]:
+            hostGroups[host].append(number)
+
+    for name in hostList + groupList:
+        strings.setdefault(name, len(strings))
+
+    directory = os.path.dirname(os.path.abspath(filePath))
+    tmpFd, tmpPath = tempfile.mkstemp(dir=directory, prefix='.ansible-keeper-bin.')
+    header = BinaryInventory.HEADER
+
+    try:
+        with os.fdopen(tmpFd, 'wb') as f:
+            f.write(b'\0' * header.size)
+            blobs = dict((host, 0) for host in hostList)
+
+            for host, varDict in iterHostVars(reader, sorted(hostZnodes)):
+                blob = [struct.pack('<I', len(varDict))]
+
+                for var, value in sorted(varDict.items()):
+                    value = hostVarText(value).encode('utf-8')
+                    blob.append(struct.pack('<II', strings.setdefault(var, len(strings)), len(value)) + value)
+
+                blob = b''.join(blob)
+                blobs[host] = f.tell()
+                f.write(struct.pack('<I', len(blob)) + blob)
+
+            ## hosts and groups may share a name, their arrays are kept apart
+            hostArrays, groupArrays = {}, {}
+
+            for host in hostList:
+                hostArrays[host] = f.tell()
+                f.write(struct.pack('<{}I'.format(len(hostGroups[host])), *hostGroups[host]))
+
+            for group in groupList:
+                groupArrays[group] = f.tell()
+                f.write(struct.pack('<{}I'.format(len(groupMembers[group])), *sorted(hostNumbers[host] for host in groupMembers[group])))
+
+            ## interned strings: offsets table first, string bytes right after it
+            stringList = sorted(strings, key=strings.get)
+            encoded    = [text.encode('utf-8') for text in stringList]
+            stringsAt  = f.tell()
+            offset     = stringsAt + 8 * (len(encoded) + 1)
+            offsets    = [offset]
+
+            for text in encoded:
+                offset += len(text)
+                offsets.append(offset)
+
+            f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+            f.write(b''.join(encoded))
+
+            hostsAt = f.tell()
+            f.write(b''.join(BinaryInventory.HOST.pack(strings[host], len(hostGroups[host]), hostArrays[host], blobs[host])
+                             for host in hostList))
+
+            groupsAt = f.tell()
+            f.write(b''.join(BinaryInventory.GROUP.pack(strings[group], len(groupMembers[group]), groupArrays[group])
+                             for group in groupList))
+
+            hostSlots, table = hashTable(hostList, BinaryInventory.slot)
+            hostHashAt = f.tell()
+            f.write(table)
+
+            groupSlots, table = hashTable(groupList, BinaryInventory.slot)
+            groupHashAt = f.tell()
+            f.write(table)
+
+            tree   = json.dumps(groupTree, sort_keys=True).encode('utf-8')
+            treeAt = f.tell()
+            f.write(struct.pack('<I', len(tree)) + tree)
+            size   = f.tell()
+
+            f.seek(0)
+            f.write(header.pack(BinaryInventory.MAGIC, len(stringList), len(hostList), len(groupList), hostSlots, groupSlots,
+                                stringsAt, hostsAt, groupsAt, hostHashAt, groupHashAt, treeAt, zxid))
+            f.flush()
+            os.fsync(f.fileno())
+
+    except BaseException:
+        os.unlink(tmpPath)
+        raise
+
+    return tmpPath, "Exported inventory to {0}: {1} hosts, {2} groups, {3} bytes, zxid {4}".format(
+        filePath, len(hostList), len(groupList), size, zxid)
+
+
+def openBinaryInventory(filePath):
+    '''
+    Open binary inventory file written by --export-bin.
+
+    Return BinaryInventory or string (in case of ERROR).
+    '''
+
+    try:
+        return BinaryInventory(filePath)
+    except (IOError, OSError, ValueError) as e:
+        return "ERROR  ==> could not read binary inventory {0}: {1} !!!".format(filePath, e)
+
+
+@measured
+def importFromBinary(filePath, dryRun=False):
+    '''
+    Import inventory from binary file written by --export-bin, hosts are streamed from the file
+    in batches of cfg.importBatch hosts, every batch is planned (see planImport) and committed
+    with chunked transactions. In dryRun mode only report planned operations.
+
+    Return string.
+    '''
+
+    inventory = openBinaryInventory(filePath)
+
+    if not isinstance(inventory, BinaryInventory):
+        return inventory
+
+    zk      = zkStartRo() if dryRun else zkStartRw()
+    started = time.time()
+    planned = 0
+    batches = 0
+
+    def commitPlan(groups, hostvars, groupRecords=None):
+        for attempt in writeAttempts():
+            ops   = planImport(zk, groups, hostvars, layout, groupRecords, memberHosts=False)
+            error = None if dryRun else commitOps(zk, ops, progress="IMPORTING")
+
+            if attempt == 0:
+                count = len(ops)
+
+            if error is None:
+                return count
+
+        if not dryRun:  ## batches and chunks committed before the failed one changed the inventory
+            markInventoryChanged(zk)
+
+        raise error
+
+    with inventory:
+        try:
+            if not dryRun:
+                zk.ensure_path("{}/groups".format(cfg.aPath))
+                zk.ensure_path("{}/hosts".format(cfg.aPath))
+
+            layout = getLayout(zk)
+            hosts  = inventory.iterHosts()
+
+            while True:
+                groups, hostvars = {}, {}
+                read = 0
+
+                ## group members exported without host record (None vars) get no host znode
+                for host, hostGroups, varDict in itertools.islice(hosts, cfg.importBatch):
+                    for group in hostGroups:
+                        groups.setdefault(group, []).append(host)
+                    if varDict is not None:
+                        hostvars[host] = varDict
+                    read += 1
+
+                if not read:
+                    break
+
+                planned += commitPlan(groups, hostvars)
+                batches += 1
+
+            ## groups without members, group vars and child groups
+            groupRecords = inventory.groupTree()['groups']
+            planned += commitPlan(dict((group, []) for group, members in inventory.iterGroups()), {}, groupRecords)
+
+        except ValueError as e:
+            if batches and not dryRun:
+                markInventoryChanged(zk)
+            return "ERROR  ==> could not import inventory from {0}: {1} !!!".format(filePath, e)
+
+    if not dryRun:
+        markInventoryChanged(zk)
+
+    if dryRun:
+        return "DRY RUN  ==> import from {0}: {1} operations planned in {2} host batches".format(filePath, planned, batches)
+
+    elapsed = max(time.time() - started, 1e-6)
+    return "Imported inventory from {0}: {1} operations in {2:.3f}s ({3:.0f} ops/s)".format(
+        filePath, planned, elapsed, planned / elapsed)
+
+
+def binaryHostAccess(hostName, filePath, effective=False):
+    '''
+    Ansible pre 1.3 compliant hostvars dump (see ansibleHostAccess) from binary inventory file.
+
+    Return dict or string (in case of ERROR).
+    '''
+
+    inventory = openBinaryInventory(filePath)
+
+    if not isinstance(inventory, BinaryInventory):
+        return inventory
+
+    with inventory:
+        found    = inventory.host(hostName)
+        hostVars = None if found is None else inventory.hostVars(found[1])
+
+        if hostVars is None:
+            return "ERROR  ==> no such host: {0} !!!".format(hostName)
+
+        if not effective:
+            return hostVars
+
+        groupTree = inventory.groupTree()
+
+        if not groupTree['groups']:  ## no group vars anywhere
+            return hostVars
+
+        return effectiveHostVars(hostVars, inventory.hostGroups(found[1]), groupTree)
+
+
+def binaryShowHostVars(znodeStringSplited, filePath):
+    '''
+    Show hostvars for a given hosts:hostname or groupname (see showHostVars) from binary inventory file.
+
+    Return dict or string (in case of ERROR).
+    '''
+
+    inventory = openBinaryInventory(filePath)
+
+    if not isinstance(inventory, BinaryInventory):
+        return inventory
+
+    with inventory:
+        if len(znodeStringSplited[0]) == 2:    ## check for groupname only
+            groupName = znodeStringSplited[0][0]
+
+            if inventory.group(groupName) is None:
+                return "ERROR  ==> no such groupname: {0} !!!".format(groupName)
+
+            ## hosts of child groups (flattened in group tree) are hosts of the group as well
+            groupList = [groupName] + inventory.groupTree()['descendants'].get(groupName, [])
+            hostList, seen = [], set()
+
+            for group in sorted(groupList):
+                found   = inventory.group(group)
+                members = [] if found is None else inventory.groupMembers(found[1])
+                hostList += [host for host in members if host not in seen]
+                seen.update(members)
+
+            hostDict = {}
+
+            for host in hostList:
+                hostDict[host] = inventory.hostVars(inventory.host(host)[1]) or {}
+
+            return hostDict
+
+        elif len(znodeStringSplited[0]) == 3:     ## check for hostname only
+            hostName = znodeStringSplited[0][0]
+            found    = inventory.host(hostName)
+            hostVars = None if found is None else inventory.hostVars(found[1])
+
+            if hostVars is None:
+                return "ERROR  ==> no such host: {0} !!!".format(hostName)
+
+            return {hostName: hostVars}
+
+        else:
+            return "ERROR with processing znodeStrings !!!"
+
+
+def hostStorePath():
+    '''
+    Return string (path of --host lookup store of cfg.zkServers and cfg.aPath).
+    '''
+
+    return cfg.hostStoreFile.format('{:08x}'.format(zlib.crc32("{0}{1}".format(cfg.zkServers, cfg.aPath).encode('utf-8'))))
+
+
+def hostStoreValid(zk, storePath):
+    '''
+    Check if --host lookup store was exported after the last change of hosts, groups and modcounter
+    znodes (see inventoryCacheKey).
+
+    Return bool.
+    '''
+
+    inventory = openBinaryInventory(storePath)
+
+    if not isinstance(inventory, BinaryInventory):
+        return False
+
+    with inventory:
+        zxid = inventory.zxid
+
+    stats = [stat for stat in inventoryCacheKey(zk)[2:] if stat is not None]
+
+    return all(pzxid <= zxid and mzxid <= zxid for pzxid, cversion, mzxid in stats)
+
+
+@measured
+def storedHostAccess(hostName, effective=False):
+    '''
+    Ansible pre 1.3 compliant hostvars dump (see ansibleHostAccess) read from --host lookup store (binary inventory,
+    see exportToBinary). The store is trusted without zookeeper session for cfg.hostStoreTtl seconds after it was
+    written or validated, then it is validated against znode stats and refreshed in bulk by one process at a time.
+    Readers are never blocked: a refresh is renamed over the store and busy refresh makes others read zookeeper.
+
+    Return dict or string (in case of ERROR).
+    '''
+
+    storePath = hostStorePath()
+
+    try:
+        age = time.time() - os.stat(storePath).st_mtime
+    except OSError:
+        age = None
+
+    if age is not None and 0 <= age < cfg.hostStoreTtl:
+        return storeLookup(hostName, storePath, effective=effective)
+
+    zk = zkStartRo()
+
+    if age is not None and hostStoreValid(zk, storePath):
+        try:
+            os.utime(storePath, None)
+        except OSError:
+            pass
+        return storeLookup(hostName, storePath, zk, effective)
+
+    try:
+        if not os.path.isdir(os.path.dirname(storePath)):
+            os.makedirs(os.path.dirname(storePath))
+
+        lockFile = open(storePath + '.lock', 'a')
+    except (IOError, OSError):
+        return ansibleHostAccess(hostName, zk, effective)
+
+    with lockFile:
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):  ## other process refreshes the store
+            return ansibleHostAccess(hostName, zk, effective)
+
+        if not hostStoreValid(zk, storePath):  ## unless refreshed while the lock was taken
+            exportToBinary(storePath)
+
+    return storeLookup(hostName, storePath, zk, effective)
+
+
+def storeLookup(hostName, storePath, zk=None, effective=False):
+    '''
+    Look hostname up in --host lookup store, hosts missing in it (added by other machines within
+    cfg.hostStoreTtl) or unreadable store are looked up in zookeeper.
+
+    Return dict or string (in case of ERROR).
+    '''
+
+    found = binaryHostAccess(hostName, storePath, effective)
+
+    if isinstance(found, dict):
+        return found
+
+    return ansibleHostAccess(hostName, zk, effective)
+
+
+def dropHostStore():
+    '''
+    Remove --host lookup store after a write of this process, so the next --host does not trust it for cfg.hostStoreTtl.
+    '''
+
+    if cfg.hostStoreFile is None:
+        return
+
+    try:
+        os.unlink(hostStorePath())
+    except OSError:
+        pass
+
+
+def parseBatchLine(line):
+    '''
+    Parse one --batch line: commandline option with its argument "<-A|-G|-D|-U|-R> argument"
+    or JSON object {"op": "-A", "arg": "groupname:hostname,var1:value1"}. JSON object may give
+    {"group": groupname, "host": hostname, "vars": {var1: value1}} instead of "arg" (-A|-G|-D|-U),
+    so hostvar values can hold commas and colons.
+
+    Return tuple (option, argument, operation) or raise ValueError.
+    '''
+
+    ## operation is a tuple of names checked against the zookeeper model by planBatch:
+    ## -A|-U: (groupname, hostname, varDict)  -G|-D: (groupname, hostname)  -R: (groups|hosts, oldname, newname)
+    ## -D groupname gives (groupname, None), -D hosts:hostname gives (None, hostname)
+
+    if line.startswith('{'):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            raise ValueError("no valid JSON: {0}".format(e))
+
+        if not isinstance(request, dict):
+            raise ValueError("no valid JSON object: {0}".format(line))
+
+        option = str(request.get('op', ''))
+        option = option if option.startswith('-') else '-' + option
+        arg    = request.get('arg')
+
+        if arg is None and option in ('-A', '-U') and 'group' in request and 'host' in request:
+            varDict = request.get('vars', {})
+            if not isinstance(varDict, dict):
+                raise ValueError("vars is not an object: {0}".format(varDict))
+            return option, "{0}:{1}".format(request['group'], request['host']), checkBatchNames(
+                option, (str(request['group']), str(request['host']), varDict))
+
+        if arg is None and option in ('-G', '-D') and ('group' in request or 'host' in request):
+            group, host = request.get('group'), request.get('host')
+            arg = "{0}:{1}".format(group, host) if group and host else group or "hosts:{0}".format(host)
+
+    else:
+        option, _, arg = line.partition(' ')
+        arg = arg.strip()
+
+    if option not in ('-A', '-G', '-D', '-U', '-R'):
+        raise ValueError("unknown option: {0} [-A|-G|-D|-U|-R]".format(option))
+
+    if not isinstance(arg, str) or not arg:
+        raise ValueError("missing argument of option: {0}".format(option))
+
+    if option in ('-A', '-U'):
+        try:
+            znodeDict = splitZnodeVarString(arg)
+        except IndexError:
+            raise ValueError("{0} <-- no valid hostvars string [groupname:hostname,var1:value1]".format(arg))
+
+        group = list(znodeDict.keys())[0]
+        host  = list(znodeDict[group].keys())[0]
+        return option, arg, checkBatchNames(option, (group, host, znodeDict[group][host]))
+
+    if option == '-R':
+        renameSplited = splitRenameZnodeString(arg)
+        if type(renameSplited) is not list:
+            raise ValueError(renameSplited[1])
+        kind = 'hosts' if 'hosts:' in arg else 'groups'
+        return option, arg, checkBatchNames(option, (kind, renameSplited[0][0], renameSplited[1][0]))
+
+    znodeSplited = splitZnodeString(arg)
+
+    if len(znodeSplited) == 2:
+        operation = (znodeSplited[0][0], znodeSplited[1][0])
+    elif option == '-G':
+        raise ValueError("{0} <-- no valid group member string [groupname:hostname]".format(arg))
+    elif len(znodeSplited[0]) == 2:
+        operation = (znodeSplited[0][0], None)
+    else:
+        operation = (None, znodeSplited[0][0])
+
+    return option, arg, checkBatchNames(option, operation)
+
+
+def checkBatchNames(option, operation):
+    '''
+    Check group and host names of a parsed --batch operation.
+
+    Return operation or raise ValueError.
+    '''
+
+    names = operation[1:] if option == '-R' else operation[:2]
+
+    for name in names:
+        if name is not None and (not name or '/' in name):
+            raise ValueError("no valid group or host name: '{0}'".format(name))
+
+    return operation
+
+
+def readBatch(filePath):
+    '''
+    Read and validate --batch operations from filePath (- for stdin), blank lines
+    and lines starting with # are skipped.
+
+    Return list of tuples (lineNumber, option, argument, operation, error), operation is None
+    and error is a string for invalid lines (argument is the whole line then).
+    '''
+
+    lines = []
+
+    f = sys.stdin if filePath == '-' else open(filePath, 'r')
+
+    try:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                option, arg, operation = parseBatchLine(line)
+                lines.append((number, option, arg, operation, None))
+            except ValueError as e:
+                lines.append((number, None, line, None, str(e)))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    return lines
+
+
+def planBatch(zk, operations, layout, createMissing=False):
+    '''
+    Check (option, operation) tuples one by one like their commandline options do against
+    a model of referenced groups and hosts read with pipelined async calls, then plan
+    transaction operations turning zookeeper into the final model. Hostvars given to -U
+    which do not exist are created when createMissing is set.
+
+    Return tuple (list of (status, message) results, list of transaction operations).
+    '''
+
+    groupsPath = "{}/groups".format(cfg.aPath)
+    hostsPath  = "{}/hosts".format(cfg.aPath)
+    indexPath  = "{}/index/host-groups".format(cfg.aPath)
+
+    groupRefs, hostRefs, hostGroupRefs, renamedGroups, patterns = set(), set(), set(), set(), set()
+
+    for option, operation in operations:
+        if option == '-U' and isHostPattern(operation[1]):
+            patterns.add(operation[:2])
+        elif option == '-R':
+            kind, oldName, newName = operation
+            (hostRefs if kind == 'hosts' else groupRefs).update([oldName, newName])
+            if kind == 'hosts':
+                hostGroupRefs.add(oldName)
+            else:
+                renamedGroups.add(oldName)
+        else:
+            group, host = operation[:2]
+            if group is not None:
+                groupRefs.add(group)
+            if host is not None:
+                hostRefs.add(host)
+            if option == '-D' and group is None:
+                hostGroupRefs.add(host)
+
+    (path, groupList), (path, hostList) = pipelineRequests(zk, [('get_children', groupsPath), ('get_children', hostsPath)])
+    groups, hosts = set(groupList or []), set(hostList or [])
+
+    tree, treeVersion, treeChunks = readGroupTree(zk)
+    treeGroups = tree['groups']
+
+    ## -U host glob patterns match members of the group and its child groups (see patternMembers)
+    for group, pattern in patterns:
+        if group == 'hosts':
+            hostRefs.update(fnmatch.filter(hosts, pattern))
+        else:
+            groupRefs.update([group] + tree['descendants'].get(group, []))
+
+    ## members of referenced groups and groups of deleted or renamed hosts, kept from both sides
+    groupHosts, hostGroups = {}, {}
+
+    def addMember(group, host):
+        groupHosts.setdefault(group, set()).add(host)
+        hostGroups.setdefault(host, set()).add(group)
+
+    def removeMember(group, host):
+        groupHosts[group].discard(host)
+        hostGroups[host].discard(group)
+
+    for group, members in fetchGroupMembers(zk, sorted(groupRefs & groups)).items():
+        for host in members:
+            addMember(group, host)
+
+    for host, memberOf in fetchHostGroups(zk, sorted(hostGroupRefs & hosts)).items():
+        for group in memberOf:
+            addMember(group, host)
+
+    for group, pattern in patterns:
+        if group != 'hosts':
+            for member in [group] + tree['descendants'].get(group, []):
+                hostRefs.update(fnmatch.filter(groupHosts.get(member, ()), pattern))
+
+    renamedPaths = ["{0}/{1}".format(groupsPath, group) for group in sorted(renamedGroups & groups)]
+    groupData    = dict((path.split('/')[-1], result[0]) for path, result in
+                        pipelineRequests(zk, [('get', path) for path in renamedPaths]) if result is not None)
+
+    records  = dict(iterHostRecords(zk, sorted(hostRefs & hosts), layout))
+    varDicts = dict((host, recordVars(record)) for host, record in records.items() if record is not None)
+    initVars = dict((host, dict(varDict)) for host, varDict in varDicts.items())
+
+    ## hosts deleted between the listing and the read of their records do not exist
+    hosts -= set(host for host, record in records.items() if record is None)
+
+    initGroups, initHosts = set(groups), set(hosts)
+    initMembers = set((group, host) for group, members in groupHosts.items() for host in members)
+    fresh, updates, results = set(), {}, []
+
+    def updateHost(host, varDict):
+        if host not in hosts:
+            return 'HOST_DOES_NOT_EXIST', "ERROR  ==> could not update host: {0} that does not exist !!!".format(host)
+
+        updatedDict  = dict((var, val) for var, val in varDict.items() if var in varDicts[host])
+        missingDict  = dict((var, val) for var, val in varDict.items() if var not in varDicts[host])
+        createdDict  = missingDict if createMissing else {}
+        nonExistList = [] if createMissing else list(missingDict)
+
+        for var, val in list(updatedDict.items()) + list(createdDict.items()):
+            varDicts[host][var] = hostVarText(val)
+            updates.setdefault(host, {})[var] = hostVarText(val)
+
+        message = updateMessage(host, updatedDict, createdDict, nonExistList)
+
+        return ('NOT_UPDATED' if message.startswith("NOT UPDATED") else 'UPDATED'), message
+
+    for option, operation in operations:
+        if option == '-A':
+            group, host, varDict = operation
+
+            if host in hosts:
+                results.append(('HOST_EXISTS', "host: {0} exists !!!".format(host)))
+            elif host in groupHosts.get(group, ()):
+                results.append(('HOST_EXISTS_IN_GROUP', "host: {0} in group {1} exists !!!".format(host, group)))
+            else:
+                hosts.add(host)
+                fresh.add(host)
+                varDicts[host] = dict((var, hostVarText(val)) for var, val in varDict.items())
+                groups.add(group)
+                addMember(group, host)
+                results.append(('ADDED_HOST_TO_GROUP', "ADDED  ==> host: {0} to group: {1}".format(host, group)))
+
+        elif option == '-G':
+            group, host = operation
+
+            if host in groupHosts.get(group, ()):
+                results.append(('HOST_EXISTS_IN_GROUP', "ERROR  ==> host: {0} in group {1} exists !!!".format(host, group)))
+            elif host not in hosts:
+                results.append(('HOST_DOES_NOT_EXIST', "ERROR  ==> host: {0} does not exist !!! Could not add non-existent host: {0} to group: {1}".format(host, group)))
+            else:
+                groups.add(group)
+                addMember(group, host)
+                results.append(('ADDED_HOST_TO_GROUP', "ADDED  ==> host: {0} to group: {1}".format(host, group)))
+
+        elif option == '-U':
+            group, host, varDict = operation
+
+            if not isHostPattern(host):
+                results.append(updateHost(host, varDict))
+                continue
+
+            ## host glob pattern: one result with a message per matching host and summary
+            if group == 'hosts':
+                candidates = hosts
+            elif group in groups:
+                descendants = buildGroupTree(treeGroups)['descendants'].get(group, [])
+                candidates  = set(member for name in [group] + descendants for member in groupHosts.get(name, ()))
+            else:
+                results.append(('GROUP_DOES_NOT_EXIST', "ERROR  ==> could not update hosts of group: {0} that does not exist !!!".format(group)))
+                continue
+
+            hostResults = [updateHost(member, varDict) for member in sorted(fnmatch.filter(candidates, host))]
+            statuses    = set(status for status, message in hostResults)
+            status      = 'UPDATED' if 'UPDATED' in statuses else 'NOT_UPDATED' if hostResults else 'HOST_DOES_NOT_EXIST'
+            messages    = [message for status, message in hostResults]
+            results.append((status, '\n'.join(messages + [patternSummary(group, host, messages)])))
+
+        elif option == '-D':
+            group, host = operation
+
+            if host is None:  ## <groupname> case
+                if group not in groups:
+                    results.append(('GROUP_DOES_NOT_EXIST', "ERROR  ==> could not delete group: {0} that does not exist !!!".format(group)))
+                else:
+                    for member in list(groupHosts.get(group, ())):
+                        removeMember(group, member)
+                    groups.discard(group)
+                    treeGroups = dropTreeGroup(treeGroups, group)
+                    results.append(('DELETED_GROUP', "DELETED ==> group: {0}".format(group)))
+
+            elif host not in hosts:
+                results.append(('HOST_DOES_NOT_EXIST', "ERROR  ==> could not delete host: {0} that does not exist !!!".format(host)))
+
+            elif group is None:  ## <hosts:hostname> case
+                for memberOf in list(hostGroups.get(host, ())):
+                    removeMember(memberOf, host)
+                hosts.discard(host)
+                fresh.discard(host)
+                updates.pop(host, None)
+                results.append(('DELETED_HOST', "DELETED ==> host: {0}".format(host)))
+
+            elif host not in groupHosts.get(group, ()):
+                results.append(('HOST_DOES_NOT_EXISTS_IN_GROUP', "ERROR  ==> could not delete host: {0} that does not exist in group: {1} !!!".format(host, group)))
+
+            else:
+                removeMember(group, host)
+                if not groupHosts[group] and not inGroupTree(treeGroups, group):  ## delete group if there was only one host in it
+                    groups.discard(group)
+                results.append(('DELETED_HOST_IN_GROUP', "DELETED ==> host: {0} in group: {1}".format(host, group)))
+
+        else:  ## -R
+            kind, oldName, newName = operation
+            existing = hosts if kind == 'hosts' else groups
+
+            if oldName not in existing:
+                results.append(('PATH_DOES_NOT_EXIST', "ERROR  ==> could not rename nonexistent path: {0}/{1}/{2} !!!".format(cfg.aPath, kind, oldName)))
+            elif newName in existing:
+                results.append(('PATH_EXISTS', "ERROR  ==> new path already exist: {0}/{1}/{2} !!!".format(cfg.aPath, kind, newName)))
+
+            elif kind == 'hosts':
+                for memberOf in list(hostGroups.get(oldName, ())):
+                    removeMember(memberOf, oldName)
+                    addMember(memberOf, newName)
+                hosts.add(newName)
+                fresh.add(newName)
+                varDicts[newName] = dict(varDicts[oldName])
+                hosts.discard(oldName)
+                fresh.discard(oldName)
+                updates.pop(oldName, None)
+                results.append(('RENAMED', "RENAMED {0} --> {1}".format(oldName, newName)))
+
+            else:
+                for member in list(groupHosts.get(oldName, ())):
+                    removeMember(oldName, member)
+                    addMember(newName, member)
+                groups.add(newName)
+                groupData[newName] = groupData.pop(oldName, b'')
+                groups.discard(oldName)
+                treeGroups = dropTreeGroup(treeGroups, oldName, newName)
+                results.append(('RENAMED', "RENAMED group {0} --> {1}".format(oldName, newName)))
+
+    finalMembers = set((group, host) for group, members in groupHosts.items() for host in members)
+    removed, added = sorted(initMembers - finalMembers), sorted(finalMembers - initMembers)
+
+    ## hosts deleted or created again lose their whole subtree and index znode first
+    dropped = set(host for host in hostRefs if host in initHosts and (host not in hosts or host in fresh))
+
+    ops  = removeMemberOps(zk, [member for member in removed if member[1] not in dropped])
+    ops += removeMemberOps(zk, [member for member in removed if member[1] in dropped], withIndex=False)
+
+    indexedDropped = existingPaths(zk, ["{0}/{1}".format(indexPath, host) for host in dropped])
+
+    for host in sorted(dropped):
+        if "{0}/{1}".format(indexPath, host) in indexedDropped:
+            ops += subtreeDeleteOps(zk, "{0}/{1}".format(indexPath, host))
+        ops += subtreeDeleteOps(zk, "{0}/{1}".format(hostsPath, host))
+
+    ops += [('delete', "{0}/{1}".format(groupsPath, group), -1) for group in sorted(initGroups - groups)]
+    ops += [('create', "{0}/{1}".format(groupsPath, group), groupData.get(group, b'')) for group in sorted(groups - initGroups)]
+
+    for host in sorted(fresh):
+        ops += hostVarsOps(host, None, varDicts[host], layout)
+
+    for host, varDict in sorted(updates.items()):
+        if host not in fresh:
+            ops += hostVarsOps(host, records[host], varDict, layout)
+
+    ops += [('create', "{0}/{1}/{2}".format(groupsPath, group, host), b'') for group, host in added]
+    ops += varIndexOps(zk, [(host, initVars.get(host, {}), varDicts.get(host, {}) if host in hosts else {})
+                            for host in sorted(hostRefs)])
+
+    if hostGroupsIndexed(zk):
+        entries   = set(added) | set((group, host) for host in dropped for group in hostGroups.get(host, ()))
+        entryList = sorted(set(host for group, host in entries) | fresh)
+        indexed   = existingPaths(zk, ["{0}/{1}".format(indexPath, host) for host in entryList if host not in dropped])
+
+        ops += [('create', "{0}/{1}".format(indexPath, host), b'') for host in entryList
+                if host in dropped or "{0}/{1}".format(indexPath, host) not in indexed]
+        ops += [('create', "{0}/{1}/{2}".format(indexPath, host, group), b'') for group, host in sorted(entries)]
+
+    ## deleted and renamed groups leave child groups of the others
+    ops += groupTreeOps(zk, tree, treeVersion, treeChunks, treeGroups, skip=initGroups - groups)
+
+    return results, ops
+
+
+@measured
+def runBatch(filePath, dryRun=False, createMissing=False):
+    '''
+    Run -A|-G|-D|-U|-R operations read from filePath (- for stdin) one per line over one zookeeper
+    session: all lines are validated first, then checked against one pipelined read of referenced
+    groups and hosts and written with chunked transactions. In dryRun mode nothing is written.
+    Hostvars given to -U which do not exist are created when createMissing is set.
+
+    Return list of JSON result lines, one per operation (status INVALID, NOT_APPLIED or PARTLY_APPLIED
+    of every line when the batch failed).
     '''
 
+    lines = readBatch(filePath)
+
+    def resultLines(results, committed):
+        return [json.dumps({'line': number, 'op': option, 'arg': arg, 'status': status,
+                            'result': message, 'committed': committed})
+                for (number, option, arg, operation, error), (status, message) in zip(lines, results)]
+
+    if any(error is not None for number, option, arg, operation, error in lines):
+        return resultLines([('INVALID', "ERROR  ==> {0}".format(error)) if error is not None else
+                            ('NOT_RUN', "NOT RUN  ==> batch has invalid lines")
+                            for number, option, arg, operation, error in lines], False)
+
+    operations = [(option, operation) for number, option, arg, operation, error in lines]
+
+    if dryRun:
+        zk = zkStartRo()
+        results, ops = planBatch(zk, operations, getLayout(zk), createMissing)
+        return resultLines(results, False)
+
     zk = zkStartRw()
+    zk.ensure_path("{}/groups".format(cfg.aPath))
+    zk.ensure_path("{}/hosts".format(cfg.aPath))
+    layout = getLayout(zk)
+
+    for attempt in writeAttempts():
+        results, ops = planBatch(zk, operations, layout, createMissing)
+        chunks    = chunkOps(ops)
+        committed = 0
+        error     = None
+
+        for chunk in chunks:
+            error = commitOps(zk, chunk)
+            if error is not None:
+                break
+            committed += 1
+
+        ## results are planned again only when nothing is committed yet
+        if error is None or committed > 0:
+            break
+
+    if committed > 0:
+        markInventoryChanged(zk)
+
+    if error is None:
+        return resultLines(results, True)
+
+    ## operations of all lines are merged into transactions, so a failed one leaves every line
+    ## not applied (first transaction) or partly applied (later ones)
+    if committed > 0:
+        status, reason = 'PARTLY_APPLIED', "PARTLY APPLIED  ==> {0} of {1} transactions committed before {2!r}, check the inventory before running the batch again".format(
+            committed, len(chunks), error)
+    else:
+        status, reason = 'NOT_APPLIED', "NOT APPLIED  ==> transaction failed with {0!r}".format(error)
+
+    return resultLines([(status, "{0} ===> {1}".format(reason, message)) for planned, message in results],
+                       'partial' if committed > 0 else False)
+
+
+def changedHosts(zk, hostList, since, layout):
+    '''
+    Find hosts from hostList created or changed after zxid since, comparing czxid, mzxid and pzxid
+    of host znodes (and of hostvar znodes for layouts storing them) read with pipelined async calls.
+
+    Return list of hostnames.
+    '''
+
+    ## packed hostvars and chunk znodes change host mzxid and pzxid, hostvar znodes change
+    ## host pzxid when created or deleted and their own mzxid when set
+
+    readChildren = layout != 'v2'
+    changed, varPaths = [], []
+    requests = []
+
+    for host in hostList:
+        hostPath = "{0}/hosts/{1}".format(cfg.aPath, host)
+        requests.append(('exists', hostPath))
+        if readChildren:
+            requests.append(('get_children', hostPath))
+
+    results = pipelineRequests(zk, requests)
+
+    for host in hostList:
+        path, stat = next(results)
+        if readChildren:
+            path, varList = next(results)
+
+        if stat is None:  ## deleted in the meantime, left to the next delta
+            continue
+
+        if max(stat.czxid, stat.mzxid, stat.pzxid) > since:
+            changed.append(host)
+        elif readChildren:
+            varPaths += [(host, "{0}/{1}".format(path, var)) for var in varList or [] if not var.startswith(CHUNK_PREFIX)]
+
+    found = set(changed)
+
+    for (host, varPath), (path, stat) in zip(varPaths, pipelineRequests(zk, [('exists', path) for host, path in varPaths])):
+        if stat is not None and stat.mzxid > since and host not in found:
+            changed.append(host)
+            found.add(host)
+
+    return [host for host in hostList if host in found]
+
+
+@measured
+def exportDelta(since):
+    '''
+    Export hosts, hostvars, groups, group members, group vars and child groups changed after zxid since
+    as a compact JSON changeset: changed hosts and groups are written whole, host and group name lists
+    only when hosts or groups were created or deleted (names missing in them are deleted by --apply-delta).
+    Zxid of the changeset is the since value for the next delta.
+
+    Return string (JSON changeset || ERROR ...).
+    '''
 
     try:
-        if len(znodeStringSplited) > 1:  ## check if it is <groupname:hostname> case
+        since = int(since, 0)
+    except ValueError:
+        return "ERROR  ==> {0} <-- no valid zxid !!!".format(since)
 
-            groupName, groupPath              = znodeStringSplited[0]
-            hostName, hostPath, hostGroupPath = znodeStringSplited[1]
+    zk = zkStartRo()
 
-            ERROR_MSGS = {
-                'HOST_DOES_NOT_EXIST': "ERROR  ==> could not delete host: {0} that does not exist !!!".format(hostName),
-                'HOST_DOES_NOT_EXISTS_IN_GROUP': "ERROR  ==> could not delete host: {0} that does not exist in group: {1} !!!".format(hostName, groupName),
-                'GROUP_DOES_NOT_EXIST': "ERROR  ==> could not delete group: {0} that does not exist !!!".format(groupName)
-            }
+    ## after sync the server has seen every write committed before, its zxid taken from
+    ## the reply header is the upper bound of the changeset; writes made during the export
+    ## may be exported again by the next delta, which is harmless as entries are written whole
+    zk.sync(cfg.aPath)
+    zk.exists(cfg.aPath)
+    zxid = zk.last_zxid
 
-            COMMON_MSGS = {
-                'DELETED_HOST_IN_GROUP': "DELETED ==> host: {0} in group: {1}".format(hostName, groupName),
-                'DELETED_GROUP': "DELETED ==> group: {0}".format(groupName),
-                'DELETED_HOST': "DELETED ==> host: {0}".format(hostName)
-                
-            }
+    groupsPath = "{}/groups".format(cfg.aPath)
+    hostsPath  = "{}/hosts".format(cfg.aPath)
 
-            
-            if zk.exists(hostPath) is None:
-                return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
+    (path, groupsStat), (path, hostsStat) = pipelineRequests(zk, [('exists', groupsPath), ('exists', hostsPath)])
+    (path, groupList), (path, hostList)   = pipelineRequests(zk, [('get_children', groupsPath), ('get_children', hostsPath)])
+    groupList, hostList = sorted(groupList or []), sorted(hostList or [])
+
+    delta = {'source': "{0}{1}".format(cfg.zkServers, cfg.aPath), 'since': since, 'zxid': zxid}
+
+    if groupsStat is not None and max(groupsStat.czxid, groupsStat.pzxid) > since:
+        delta['groupList'] = groupList
+
+    if hostsStat is not None and max(hostsStat.czxid, hostsStat.pzxid) > since:
+        delta['hostList'] = hostList
+
+    groupPaths = ["{0}/{1}".format(groupsPath, group) for group in groupList]
+    stored     = dict((path, result[0]) for path, result in pipelineRequests(zk, [('get', path) for path in groupPaths])
+                      if result is not None and max(result[1].czxid, result[1].mzxid, result[1].pzxid) > since)
+    records    = dict((path.split('/')[-1], unpackGroupData(value)) for path, (value, chunks) in decodeValues(zk, stored).items())
+    members    = fetchGroupMembers(zk, sorted(records))
+
+    delta['groups'] = dict((group, {'hosts': sorted(members[group]), 'vars': record['vars'], 'children': record['children']})
+                           for group, record in records.items())
+    delta['hosts']  = dict(iterHostVars(zk, changedHosts(zk, hostList, since, getLayout(zk))))
+
+    return json.dumps(delta, separators=(',', ':'), sort_keys=True)
+
+
+def readDeltaApplied(zk):
+    '''
+    Read source and zxid of the last changeset applied by --apply-delta from {aPath}/delta.
+
+    Return tuple (dict or None, version or None).
+    '''
+
+    try:
+        data, stat = zk.get("{}/delta".format(cfg.aPath))
+    except NoNodeError:
+        return None, None
+
+    return json.loads(data.decode('utf-8')), stat.version
+
+
+def planChangeset(zk, delta, layout):
+    '''
+    Plan transaction operations making hosts and groups of a changeset (see exportDelta) equal to it:
+    listed hosts and groups are written whole, hosts and groups missing in host and group name lists
+    (when present) are deleted.
+
+    Return tuple (list of transaction operations, list of planned changes: '+|-|~ host|group|member name')
+    or raise ValueError (child groups cycle).
+    '''
+
+    groupsPath = "{}/groups".format(cfg.aPath)
+    hostsPath  = "{}/hosts".format(cfg.aPath)
+
+    (path, groupList), (path, hostList) = pipelineRequests(zk, [('get_children', groupsPath), ('get_children', hostsPath)])
+    groups, hosts = set(groupList or []), set(hostList or [])
+
+    deltaGroups, deltaHosts = delta.get('groups', {}), delta.get('hosts', {})
+    goneGroups = sorted(groups - set(delta['groupList'])) if 'groupList' in delta else []
+    goneHosts  = sorted(hosts - set(delta['hostList'])) if 'hostList' in delta else []
+
+    ## members of deleted hosts are in changed groups, as removing them changed pzxid of their groups
+    members = fetchGroupMembers(zk, sorted((set(deltaGroups) | set(goneGroups)) & groups))
+    removed = [(group, host) for group in goneGroups for host in members[group]]
+    removed += [(group, host) for group, entry in sorted(deltaGroups.items())
+                for host in members.get(group, []) if host not in entry['hosts']]
+    added   = [(group, host) for group, entry in sorted(deltaGroups.items())
+               for host in entry['hosts'] if host not in members.get(group, [])]
+
+    plan  = ["- host {0}".format(host) for host in goneHosts]
+    plan += ["+ host {0}".format(host) for host in sorted(set(deltaHosts) - hosts)]
+    plan += ["- group {0}".format(group) for group in goneGroups]
+    plan += ["+ group {0}".format(group) for group in sorted(set(deltaGroups) - groups)]
+    plan += ["- member {0}:{1}".format(group, host) for group, host in removed if group not in goneGroups]
+    plan += ["+ member {0}:{1}".format(group, host) for group, host in added]
+
+    ops  = removeMemberOps(zk, [(group, host) for group, host in removed if host not in goneHosts])
+    ops += removeMemberOps(zk, [(group, host) for group, host in removed if host in goneHosts], withIndex=False)
+
+    ## index znodes and subtrees of deleted hosts are read together with pipelined async calls
+    indexPaths = existingPaths(zk, ["{0}/index/host-groups/{1}".format(cfg.aPath, host) for host in goneHosts])
+    ops += subtreeDeleteOps(zk, *(sorted(indexPaths) + ["{0}/{1}".format(hostsPath, host) for host in goneHosts]))
+
+    ops += [('delete', "{0}/{1}".format(groupsPath, group), -1) for group in goneGroups]
+    ops += [('create', "{0}/{1}".format(groupsPath, group), b'') for group in sorted(set(deltaGroups) - groups)]
+
+    ## hostvars are written at versions they were read with, so concurrent writers fail the transaction
+    versions = {}
+    records  = dict(iterHostRecords(zk, sorted(set(deltaHosts) & hosts), layout, versions))
+    indexed  = indexedVars(zk)
+    changes = [(host, varDict, {}) for host, varDict in iterHostVars(zk, goneHosts, layout)] if indexed else []
+
+    for host, varDict in sorted(deltaHosts.items()):
+        hostOps = hostVarsOps(host, records.get(host), varDict, layout, replace=True, versions=versions)
+        ops    += hostOps
+        changes.append((host, recordVars(records.get(host)), varDict))
+
+        if hostOps and host in hosts:
+            plan.append("~ host {0}".format(host))
+
+    ops += varIndexOps(zk, changes, indexed)
 
-            if zk.exists(hostGroupPath) is None:
-                return  ArgError('HOST_DOES_NOT_EXISTS_IN_GROUP',ERROR_MSGS['HOST_DOES_NOT_EXISTS_IN_GROUP']).format()
+    ops += addMemberOps(zk, added, hostGroupsIndexed(zk))
 
-            if len(zk.get_children(groupPath)) == 1:  ## delete group if there is only one host in it
-                zk.delete(groupPath, recursive=True)
+    tree, version, chunks = readGroupTree(zk)
+    treeGroups = json.loads(json.dumps(tree['groups']))
 
-            else:
-                zk.delete(hostGroupPath, recursive=True)
-                return CommonInformer('DELETED_HOST_IN_GROUP',ERROR_MSGS['DELETED_HOST_IN_GROUP']).format()
-    
-        elif len(znodeStringSplited) == 1:  ## check if it is <groupname> or <hosts:hostname> case    
-            if len(znodeStringSplited[0]) == 2:  ## first check for group only
-        
-                groupName, groupPath = znodeStringSplited[0]
-       
-                if zk.exists(groupPath) is None:
-                    return ArgError('GROUP_DOES_NOT_EXIST',ERROR_MSGS['GROUP_DOES_NOT_EXIST']).format()
+    for group in goneGroups:
+        treeGroups = dropTreeGroup(treeGroups, group)
 
-                else:
-                    zk.delete(groupPath, recursive=True)
-                    return CommonInformer('DELETED_GROUP',ERROR_MSGS['DELETED_GROUP']).format()
-            
-            else:  ## then assume check for hosts only 
+    for group, entry in deltaGroups.items():
+        treeGroups[group] = {'vars': entry['vars'], 'children': entry['children']}
 
-                hostName, hostPath, notUsedValue = znodeStringSplited[0]
-                
-                if zk.exists(hostPath) is None:
-                    return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
+        if group in groups and unpackGroupData(packGroupData(treeGroups[group])) != \
+                tree['groups'].get(group, {'vars': {}, 'children': []}):
+            plan.append("~ group {0}".format(group))
 
-                else:
-                    zk.delete(hostPath, recursive=True)
-                    return CommonInformer('DELETED_HOST',ERROR_MSGS['DELETED_HOST']).format()
-            
-        else:  ## Unknown cases        
-            return "ERROR with processing znodeStrings !!!"           
+    ops += groupTreeOps(zk, tree, version, chunks, treeGroups, skip=goneGroups)
 
-    finally:
-        zk.stop()
+    return ops, plan
 
 
-def updateZnode(znodeDict):
+def planDelta(zk, delta, layout):
     '''
-    Update znode with hostvars.
+    Plan transaction operations applying a changeset (see planChangeset),
+    the applied changeset marker {aPath}/delta is written last.
 
-    Return string (ERROR ... || UPDATED ... || NOT UPDATED ...).
+    Return list of transaction operations or raise ValueError (child groups cycle).
     '''
 
+    ops, plan = planChangeset(zk, delta, layout)
 
-    # COMMON_MSGS = {
-    #     'DELETED_HOST_IN_GROUP': "DELETED ==> host: {0} in group: {1}".format(hostName, groupName),
-    #     'DELETED_GROUP': "DELETED ==> group: {0}".format(groupName),
-    #     'DELETED_HOST': "DELETED ==> host: {0}".format(hostName)
+    applied, appliedVersion = readDeltaApplied(zk)
+    marker = json.dumps({'source': delta['source'], 'zxid': delta['zxid']}, sort_keys=True).encode('utf-8')
 
-    # }
+    if appliedVersion is None:
+        ops.append(('create', "{}/delta".format(cfg.aPath), marker))
+    else:
+        ops.append(('set_data', "{}/delta".format(cfg.aPath), marker, appliedVersion))
 
-    
-    zk = zkStartRw()
-    
-    groupName   = list(znodeDict.keys())[0]
-    hostName    = list(znodeDict[groupName].keys())[0]
-    hostPath    = "{0}/hosts/{1}".format(cfg.aPath, hostName)
-    hostVarList = zk.get_children(hostPath)
+    return ops
 
-    ERROR_MSGS = {
-        'HOST_DOES_NOT_EXIST': "ERROR  ==> could not update host: {0} that does not exist !!!".format(hostName)
-        # 'HOST_DOES_NOT_EXISTS_IN_GROUP': "ERROR  ==> could not delete host: {0} that does not exist in group: {1} !!!".format(hostName, groupName),
-        # 'GROUP_DOES_NOT_EXIST': "ERROR  ==> could not delete group: {0} that does not exist !!!".format(groupName)
-    }
 
-    
+@measured
+def applyDelta(filePath, dryRun=False):
+    '''
+    Apply changeset written by --export-delta from filePath (- for stdin) with chunked transactions,
+    changeset has to continue the last applied one of the same source (or start from zxid 0).
+    In dryRun mode only report planned operations.
+
+    Return string (APPLIED ... || DRY RUN ... || NOT APPLIED ... || ERROR ...).
+    '''
+
     try:
-        if zk.exists(hostPath) is None:
-#            return ArgError('HOST_DOES_NOT_EXIST',ERROR_MSGS['HOST_DOES_NOT_EXIST']).format()
-            return "ERROR  ==> could not update host: {0} that does not exist !!!".format(hostName)
+        if filePath == '-':
+            delta = json.load(sys.stdin)
+        else:
+            with open(filePath, 'r') as f:
+                delta = json.load(f)
+        source, since, zxid = delta['source'], delta['since'], delta['zxid']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        return "ERROR  ==> could not read changeset from {0}: {1} !!!".format(filePath, e)
 
-        for hostVar in hostVarList:
-            if zk.exists("{0}/{1}".format(hostPath, hostVar)) is None: 
-                return "ERROR  ==> hostvar: {0} for host {1} does not exist !!!".format(hostVar, hostName)
+    def plan(zk, layout):
+        applied, appliedVersion = readDeltaApplied(zk)
 
-        nonExistList = []    
-        updatedDict  = {}
-    
-        for var in znodeDict[groupName][hostName]:
-            varPath = "{0}/{1}".format(hostPath, var)
-            varVal  = znodeDict[groupName][hostName][var]
-        
-            if var in hostVarList: ## check if given variable exists
-                zk.set(varPath, varVal)
-                updatedDict[var] = varVal
-            
-            else:
-                nonExistList.append(var)
-           
-        if len(nonExistList) > 0 and len(updatedDict) == 0:
-            return "NOT UPDATED  ==> host: {0} with no existing hostvars {1} ===> NOT UPDATED hostvars {2} which do not exist".format(hostName, updatedDict, nonExistList)
+        if applied is not None and applied['source'] == source and applied['zxid'] >= zxid:
+            return "NOT APPLIED  ==> changeset {0} of {1} up to zxid {2} is already applied".format(filePath, source, zxid)
 
-        elif len(nonExistList) and len(updatedDict) > 0:
-            return "UPDATED  ==> host: {0} with new hostvars {1} ===> NOT UPDATED hostvars {2} which do not exist".format(hostName, updatedDict, nonExistList)
-    
-        else:
-            return "UPDATED  ==> host: {0} with new hostvars {1}".format(hostName, updatedDict)
+        if since > 0 and (applied is None or applied['source'] != source or applied['zxid'] < since):
+            return "ERROR  ==> changeset {0} of {1} starts at zxid {2}, last applied is {3} !!!".format(
+                filePath, source, since, "none" if applied is None else "{0} of {1}".format(applied['zxid'], applied['source']))
 
-    finally:
-        zk.stop()    
-        
-        
-def renameZnode(znodeRenameStringSplited):
-    '''
-    Rename znode for a given tuple of ((oldName, oldPath), (newName, newPath)).
+        try:
+            return planDelta(zk, delta, layout)
+        except ValueError as e:
+            return "ERROR  ==> could not apply changeset {0}: {1} !!!".format(filePath, e)
 
-    Return string (ERROR ... || RENAMED ... || NOT RENAMED ...).
-    '''
-    
-    zk = zkStartRw()
+    if dryRun:
+        zk  = zkStartRo()
+        ops = plan(zk, getLayout(zk))
 
-    oldName, oldPath  = znodeRenameStringSplited[0]
-    newName, newPath  = znodeRenameStringSplited[1]
-    
-    def renameHostInGroup(oldName, newName):
-        '''
-        Find a corresponding group in groups for oldName, rename host with newName
-        and delete that host.
+        if not isinstance(ops, list):
+            return ops
 
-        Return string (ERROR ...||RENAMED ...).
-        '''
+        return "DRY RUN  ==> apply {0}: {1} operations in {2} transactions ({3})".format(
+            filePath, len(ops), len(chunkOps(ops)), opsSummary(ops))
 
-        ## find a group where host resides and create newPath in that group
-        for child in zk.get_children('{}/groups'.format(cfg.aPath)):
-            if oldName in zk.get_children('{0}/groups/{1}'.format(cfg.aPath, child)):
-                print(('found ==> {0}/groups/{1}/{2}'.format(cfg.aPath, child, oldName)))
-                tmpOldHostGroupPath = '{0}/groups/{1}/{2}'.format(cfg.aPath, child, oldName)
-                tmpNewHostGroupPath = '{0}/groups/{1}/{2}'.format(cfg.aPath, child, newName)
-                zk.ensure_path(tmpNewHostGroupPath)
-                        
-                ## delete oldPath from groups/group_to_find/host     
-                zk.delete(tmpOldHostGroupPath)
-                return "RENAMED host {0} in group {1} --> {2}".format(oldName, child, newName)
+    zk = zkStartRw()
+    zk.ensure_path("{}/groups".format(cfg.aPath))
+    zk.ensure_path("{}/hosts".format(cfg.aPath))
+    layout = getLayout(zk)
 
-            else:
-                return "ERROR ---> NO GROUP FOUND !!!"
+    for attempt in writeAttempts():
+        ops = plan(zk, layout)
 
-    try:
-        if zk.exists(oldPath) is None:
-            return "ERROR  ==> could not rename nonexistent path: {0} !!!".format(oldPath)
+        if not isinstance(ops, list):
+            return ops
 
-        if zk.exists(newPath) is not None:
-            return "ERROR  ==> new path already exist: {0} !!!".format(newPath)
-    
-        ## rename only when newPath does not exist
-        if zk.exists(newPath) is None:
-            if 'hosts' in oldPath:
-                ## check for hostvars, if none create newPath and delete oldPath
-                if len(zk.get_children(oldPath)) == 0:
-                    zk.ensure_path(newPath)
-                
-                    ## find, rename and delete host with no hostvars in a corresponding group
-                    renameHostInGroup(oldName, newName)
-                    zk.delete(oldPath)
-                    return "RENAMED {0} --> {1}".format(oldName, newName)
+        ## marker is the last operation, a changeset applied partially is planned again
+        ## from what is committed and marked applied only when its last chunk commits
+        error = commitOps(zk, ops, progress="APPLYING")
 
-                else:
-                    ## create newPath in hosts copy hostvars from oldPath 
-                    varDict = {}
-                    for child in zk.get_children(oldPath):
-                        varDict[child] = zk.get('{0}/{1}'.format(oldPath,child))[0]
-                    
-                    zk.ensure_path(newPath)
-                    for var in varDict:
-                        zk.create('{0}/{1}'.format(newPath,var),varDict[var])
+        if error is None:
+            break
+    else:
+        ## chunks committed before the failed one changed the inventory
+        markInventoryChanged(zk)
+        raise error
 
-                    ## find, rename and delete host with no hostvars in a corresponding group
-                    renameHostInGroup(oldName, newName)
+    markInventoryChanged(zk)
 
-                    ## delete oldPath from hosts
-                    zk.delete(oldPath, recursive=True)
-                    return "RENAMED {0} --> {1}".format(oldName, newName)
+    return "APPLIED  ==> changeset {0} of {1} from zxid {2} to {3}: {4} operations ({5})".format(
+        filePath, source, since, zxid, len(ops), opsSummary(ops))
 
-            elif 'groups' in oldPath:
-            ## look for hosts in the group, create new group
-            ## delete theirs znode in that group ONLY and create new ones in the group
 
-                oldChildren = zk.get_children(oldPath)
-                zk.ensure_path(newPath)
+class CachedResult(object):
+    ''' Result of a read answered from memory, behaves like kazoo async result '''
 
-                for child in oldChildren:
-                    zk.ensure_path('{0}/{1}'.format(newPath, child))
+    def __init__(self, call, path):
+        try:
+            self.value, self.error = call(path), None
+        except NoNodeError as e:
+            self.value, self.error = None, e
 
-                ## delete old group with its members
-                zk.delete(oldPath, recursive=True)
-                return "RENAMED group {0} --> {1}".format(oldName, newName)
+    def get(self, block=True, timeout=None):
+        if self.error is not None:
+            raise self.error
 
-            else:
-                return "ERROR no valid keywords <groups|hosts> found"
+        return self.value
 
-    finally:
-        zk.stop()
-            
-            
-def showHostVars(znodeStringSplited):
-    '''
-    Show hostvars for a given hosts:hostname or groupname.
-    
-    Return dict or string (in case of ERROR).
-    '''
 
-    zk = zkStartRo()
+class TreeCacheReader(object):
+    ''' Read-only zookeeper client lookalike answering reads from kazoo TreeCache memory '''
 
-    try:
-        if len(znodeStringSplited[0]) == 2:    ## check for groupname only
+    def __init__(self, cache):
+        self.cache = cache
 
-            groupName, groupPath = znodeStringSplited[0]
+    def get(self, path):
+        node = self.cache.get_data(path)
+        if node is None or node.data is None:
+            raise NoNodeError(path)
 
-            if zk.exists(groupPath) is None:
-                return "ERROR  ==> no such groupname: {0} !!!".format(groupName)
+        return node.data, node.stat
 
-            else:
-                hostList    = zk.get_children(groupPath)
-                varDict     = {}
+    def get_children(self, path):
+        children = self.cache.get_children(path)
+        if children is None:
+            raise NoNodeError(path)
 
-                for host in hostList:             ## build a dict with host variables
-                    tmpHostPath    = "{0}/hosts/{1}".format(cfg.aPath, host)
-                    varDict[host]  = zk.get_children('{0}'.format(tmpHostPath))
+        return sorted(children)
 
-                    valDict = {}
-                    for var in varDict[host]:
-                        valDict[var] = zk.get('{0}/{1}'.format(tmpHostPath, var))[0]
+    def exists(self, path):
+        node = self.cache.get_data(path)
+        return None if node is None else node.stat
 
-                    varDict[host] = valDict
-                return varDict
-                    
-        elif len(znodeStringSplited[0]) == 3:     ## check for hostname only   
+    def get_async(self, path):
+        return CachedResult(self.get, path)
 
-            hostName, hostPath, notUsedValue =  znodeStringSplited[0]
+    def get_children_async(self, path):
+        return CachedResult(self.get_children, path)
 
-            if zk.exists(hostPath) is None:
-                return "ERROR  ==> no such host: {0} !!!".format(hostName)
+    def exists_async(self, path):
+        return CachedResult(self.exists, path)
 
-            else:
-                varDict  = {}
-                varDict[hostName]  = zk.get_children('{0}'.format(hostPath))
 
-                valDict = {}
-                for var in varDict[hostName]:
-                    valDict[var]  = zk.get('{0}/{1}'.format(hostPath, var))[0]
+class InventoryServer(object):
+    ''' In-memory copy of {aPath} kept current by zookeeper watches, answers inventory requests '''
 
-                varDict[hostName] = valDict
-                return varDict
+    ## every tree event bumps generation, rendered responses of an older generation are not served
 
-        else:
-            return "ERROR with processing znodeStrings !!!"
+    def __init__(self, zk):
+        self.generation  = 0
+        self.connected   = True
+        self.responses   = {}
+        self.initialized = threading.Event()
+        self.changed     = threading.Event()
 
-    finally:
-        zk.stop()
+        self.cache  = TreeCache(zk, cfg.aPath)
+        self.reader = TreeCacheReader(self.cache)
+        self.cache.listen(self.onEvent)
+        self.cache.start()
 
+        renderer = threading.Thread(target=self.render)
+        renderer.daemon = True
+        renderer.start()
 
-def inventoryDump(dumpMode):
-    '''
-    User friendly inventory dump for all|groups modes.
-    
-    Return dict or list.
-    '''
+    def onEvent(self, event):
+        if event.event_type == TreeEvent.CONNECTION_LOST:
+            self.connected = False
+        elif event.event_type == TreeEvent.CONNECTION_RECONNECTED:
+            self.connected = True
+        elif event.event_type == TreeEvent.INITIALIZED:
+            self.initialized.set()
 
-    zk = zkStartRo()
+        self.generation += 1
+        self.changed.set()
 
-    # from ipdb import set_trace; set_trace()
-    hostsList  = sorted(zk.get_children("{}/hosts".format(cfg.aPath)))
-    groupsList = sorted(zk.get_children("{}/groups".format(cfg.aPath)))
-    dumpDict   = {"hosts": hostsList}
+    def render(self):
+        '''
+        Render -I ansible response in background once tree changes settle down.
+        '''
 
-    tmpList = []
+        while True:
+            self.changed.wait()
+            time.sleep(cfg.serveDebounce)
+            self.changed.clear()
 
-    try:
-        if dumpMode == 'hosts':
-            return hostsList
-
-        elif dumpMode == 'groups':
-            return groupsList
-
-        elif dumpMode == 'all':
-            for group in groupsList:
-                tmpDict  = {}
-                path     = "{0}/groups/{1}".format(cfg.aPath, group)
-                children = sorted(zk.get_children(path))
-                tmpDict[group] = children
-                tmpList.append(tmpDict)
-                
-                dumpDict["groups"] = tmpList
+            if self.initialized.is_set():
+                self.response('ansible')
 
-            return dumpDict
+    def answer(self, request):
+        '''
+        Answer request line: ansible [groupname1,groupname2]|all|groups|hosts|host <hostname>|show <groupname:hostname|groupname|hosts:hostname>.
 
-    finally:
-        zk.stop()
+        Return dict, list or string (in case of ERROR).
+        '''
 
+        mode, sep, arg = request.partition(' ')
 
-def ansibleInventoryDump():
-    '''
-    Ansible compliant inventory dump for a given list of zookeeper servers and ansible-keeper path.
-    
-    Return dict.
-    '''
+        if mode == 'ansible' and parseScope(arg) is not None:
+            ## narrowed from memoized whole inventory response
+            return scopedInventory(json.loads(self.response('ansible').decode('utf-8')), parseScope(arg))
 
-    ## The stock inventory script system detailed above works for all versions of Ansible, but calling --host for
-    ## every host can be rather expensive, especially if it involves expensive API calls to a remote subsystem.
-    ## In Ansible 1.3 or later, if the inventory script returns a top level element called “_meta”,
-    ## it is possible to return all of the host variables in one inventory script call. When this meta element
-    ## contains a value for “hostvars”, the inventory script will not be invoked with --host for each host.
-    ## This results in a significant performance increase for large numbers of hosts, and also makes client side
-    ## caching easier to implement for the inventory script.
-    ##
-    ## Source: http://docs.ansible.com/ansible/dev_guide/developing_inventory.html#tuning-the-external-inventory-script
+        elif mode == 'ansible':
+            return ansibleInventoryDump(self.reader)
 
-    zk = zkStartRo()
+        elif mode in ('all', 'groups', 'hosts'):
+            return inventoryDump(mode, self.reader)
 
-    groupList = zk.get_children("{}/groups".format(cfg.aPath))
-    groupDict = {}
-    
-    for group in groupList:
-        path     = "{0}/groups/{1}".format(cfg.aPath, group)
-        children = zk.get_children(path)
-        tmpDict  = {}
-        tmpDict['hosts'] = children
-        tmpDict['vars']  = {} ## not yet implemented
-        groupDict[group] = tmpDict
-        
-    ## building ansible compliant hostvars dict:
-    ##
-    ## {"_meta": {
-    ##     "hostvars": {
-    ##         "moocow.example.com": {"asdf" : 1234, "var2": 111 },
-    ##         "llama.example.com": {"asdf": 5678, "var2": 222 }
-    ##     }
-    ## }}
+        elif mode == 'host':
+            return ansibleHostAccess(arg, self.reader)
 
-    hostList    = zk.get_children("{}/hosts".format(cfg.aPath))
-    hostVarDict = {}
-    varDict     = {}
+        elif mode == 'show':
+            return showHostVars(splitZnodeString(arg), self.reader)
 
-    for host in hostList:             ## build a dict with host variables
-        tmpHostPath    = "{0}/hosts/{1}".format(cfg.aPath, host)
-        varDict[host]  = zk.get_children('{0}'.format(tmpHostPath))
+        else:
+            return "ERROR  ==> unknown request: {0} !!!".format(request)
 
-        valDict = {}
-        for var in varDict[host]:
-            valDict[var] = zk.get('{0}/{1}'.format(tmpHostPath, var))[0]
+    def response(self, request):
+        '''
+        Serialized answer for request, whole inventory responses are rendered once per tree generation.
 
-        varDict[host] = valDict
+        Return bytes (JSON).
+        '''
 
-    ## modify output dict to be compliant with ansible >= 1.3 version
-    hostVarDict['hostvars'] = varDict
-    groupDict['_meta']      = hostVarDict
-    
-    zk.stop()
-    return groupDict
+        memoize = request in ('ansible', 'all', 'groups', 'hosts')
 
+        for attempt in writeAttempts():
+            generation = self.generation
 
-def ansibleHostAccess(hostName):
-    '''
-    Ansible pre 1.3 compliant hostvars dump.
+            if memoize and self.responses.get(request, (None, None))[0] == generation:
+                return self.responses[request][1]
 
-    Return dict.
-    '''
+            body = json.dumps(self.answer(request)).encode('utf-8')
 
-    ## Before version 1.0, each group could only have a list of hostnames/IP addresses, like the webservers,
-    ## marietta, and 5points groups above.
-    ##
-    ## When called with the arguments --host <hostname> (where <hostname> is a host from above), the script
-    ## must print either an empty JSON hash/dictionary, or a hash/dictionary of variables to make available
-    ## to templates and playbooks. Printing variables is optional, if the script does not wish to do this,
-    ## printing an empty hash/dictionary is the way to go
-    ##
-    ## Source: http://docs.ansible.com/ansible/dev_guide/developing_inventory.html#script-conventions
-    
-    zk = zkStartRo()
+            if generation == self.generation:  ## tree did not change while rendering
+                if memoize:
+                    self.responses[request] = (generation, body)
+                return body
 
-    hostPath = "{0}/hosts/{1}".format(cfg.aPath, hostName)
+        return body
 
-    try:
-        if zk.exists(hostPath) is None:
-            return "ERROR  ==> no such host: {0} !!!".format(hostName)
 
-        else:
-            varList = zk.get_children('{0}'.format(hostPath))
-      
-            varDict = {}
-            for var in varList:
-                varDict[var]  = zk.get('{0}/{1}'.format(hostPath, var))[0]
+class InventoryRequestHandler(socketserver.StreamRequestHandler):
+    ''' One request line per connection, JSON response, connection closed without response when disconnected '''
 
-            return varDict
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8').strip()
 
-    finally:
-        zk.stop()   
-        
-    
-def exportToToml(filePath):
-    '''
-    Export inventory to TOML file.
-    '''
-    inventory = ansibleInventoryDump()
-    with open(filePath, 'w') as f:
-        toml.dump(inventory, f)
-    return "Exported inventory to {}".format(filePath)
+        if self.server.inventory.connected:
+            self.wfile.write(self.server.inventory.response(request) + b'\n')
 
-def importFromToml(filePath):
+
+def serveInventory(socketPath=None):
     '''
-    Import inventory from TOML file.
+    Serve inventory requests on a unix socket from in-memory copy of {aPath}
+    kept current by zookeeper watches, until interrupted.
+
+    Return string (STOPPED ...).
     '''
-    try:
-        with open(filePath, 'r') as f:
-            inventory = toml.load(f)
-    except (IOError, toml.TomlDecodeError) as e:
-        return "Error reading TOML file: {}".format(e)
 
-    zk = zkStartRw()
-    try:
-        for group, data in inventory.items():
-            if group == '_meta':
-                continue
-            
-            groupPath = "{}/groups/{}".format(cfg.aPath, group)
-            zk.ensure_path(groupPath)
+    if socketPath is None:
+        socketPath = cfg.serveSocket
 
-            for host in data.get('hosts', []):
-                hostPath = "{}/hosts/{}".format(cfg.aPath, host)
-                zk.ensure_path(hostPath)
-                
-                hostGroupPath = "{}/{}".format(groupPath, host)
-                zk.ensure_path(hostGroupPath)
+    inventory = InventoryServer(zkStartRo())
+    inventory.initialized.wait()
+
+    if os.path.exists(socketPath):
+        os.unlink(socketPath)
+    elif not os.path.isdir(os.path.dirname(socketPath) or '.'):
+        os.makedirs(os.path.dirname(socketPath))
+
+    server = socketserver.ThreadingUnixStreamServer(socketPath, InventoryRequestHandler)
+    server.daemon_threads = True
+    server.inventory      = inventory
+    os.chmod(socketPath, 0o600)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
 
-                if '_meta' in inventory and 'hostvars' in inventory['_meta']:
-                    hostvars = inventory['_meta']['hostvars'].get(host, {})
-                    for var, val in hostvars.items():
-                        varPath = "{}/{}".format(hostPath, var)
-                        zk.create(varPath, str(val).encode('utf-8'), makepath=True)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop)
+    print("SERVING  ==> {0} on {1}".format(cfg.aPath, socketPath))
 
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
     finally:
-        zk.stop()
-    return "Imported inventory from {}".format(filePath)
+        server.server_close()
+        os.unlink(socketPath)
+        inventory.cache.close()
 
+    return "STOPPED  ==> serving {0} on {1}".format(cfg.aPath, socketPath)
 
-def exportToIni(filePath):
+
+def main():
     '''
-    Export inventory to INI file.
+    Main logic
     '''
-    inventory = ansibleInventoryDump()
-    config = configparser.ConfigParser(allow_no_value=True)
 
-    for group, data in inventory.items():
-        if group == '_meta':
-            continue
-        
-        config.add_section(group)
-        for host in data.get('hosts', []):
-            config.set(group, host, None)
+    if oParser()['readFanout'] is not None:
+        cfg.readFanout = oParser()['readFanout']
 
-    if '_meta' in inventory and 'hostvars' in inventory['_meta']:
-        for host, hostvars in inventory['_meta']['hostvars'].items():
-            section_name = "hostvars:{}".format(host)
-            config.add_section(section_name)
-            for var, val in hostvars.items():
-                config.set(section_name, var, val)
+    if oParser()['inventoryGroups'] is not None:
+        cfg.inventoryGroups = oParser()['inventoryGroups']
 
-    with open(filePath, 'w') as f:
-        config.write(f)
-    return "Exported inventory to {}".format(filePath)
+    with zkSession:
+        exitStatus = runOptions()
 
-def importFromIni(filePath):
-    '''
-    Import inventory from INI file.
-    '''
-    config = configparser.ConfigParser(allow_no_value=True)
-    try:
-        config.read(filePath)
-    except (IOError, configparser.Error) as e:
-        return "Error reading INI file: {}".format(e)
+    if oParser()['showStats']:
+        print(opMetrics.summary(), file=sys.stderr)
+        print(valueStats.summary(), file=sys.stderr)
 
-    zk = zkStartRw()
-    try:
-        for section in config.sections():
-            if section.startswith('hostvars:'):
-                continue
+    if oParser()['statsFile'] is not None:
+        opMetrics.writePrometheus(oParser()['statsFile'])
 
-            group = section
-            groupPath = "{}/groups/{}".format(cfg.aPath, group)
-            zk.ensure_path(groupPath)
+    if exitStatus:
+        sys.exit(exitStatus)
 
-            for host in config.options(section):
-                hostPath = "{}/hosts/{}".format(cfg.aPath, host)
-                zk.ensure_path(hostPath)
-                
-                hostGroupPath = "{}/{}".format(groupPath, host)
-                zk.ensure_path(hostGroupPath)
-
-                hostvars_section = "hostvars:{}".format(host)
-                if config.has_section(hostvars_section):
-                    for var, val in config.items(hostvars_section):
-                        varPath = "{}/{}".format(hostPath, var)
-                        zk.create(varPath, str(val).encode('utf-8'), makepath=True)
-    finally:
-        zk.stop()
-    return "Imported inventory from {}".format(filePath)
-    
-def main():
-    '''
-    Main logic
+
+def runOptions():
     '''
+    Run commandline options over the shared zookeeper session.
 
-    zk  = zkStartRw()
-    try:
-        assert type(zk).__name__ == 'KazooClient'
+    Return int (exit status).
+    '''
 
-    finally:
-        zk.stop()
+    exitStatus = 0
 
-   
     ## options for ansible only 
-    if oParser()['ansibleHost'] is not None:
-        print(json.dumps(ansibleHostAccess(oParser()['ansibleHost'])))
+    if oParser()['ansibleHost'] is not None and oParser()['fromBin'] is not None:
+        print(json.dumps(binaryHostAccess(oParser()['ansibleHost'], oParser()['fromBin'], oParser()['effectiveVars'])))
+
+    elif oParser()['ansibleHost'] is not None and (oParser()['noCache'] or cfg.hostStoreFile is None):
+        print(json.dumps(ansibleHostAccess(oParser()['ansibleHost'], effective=oParser()['effectiveVars'])))
+
+    elif oParser()['ansibleHost'] is not None:
+        print(json.dumps(storedHostAccess(oParser()['ansibleHost'], oParser()['effectiveVars'])))
 
     if oParser()['inventoryMode'] == 'ansible':
-        print(json.dumps(ansibleInventoryDump()))
+        writeAnsibleInventory(sys.stdout, oParser()['noCache'], parseScope(cfg.inventoryGroups))
 
     ## options for users
     if oParser()['inventoryMode'] == 'all':
@@ -875,7 +5546,13 @@ def main():
  
     if oParser()['updateMode'] is not None:
         znodeDict = splitZnodeVarString(oParser()['updateMode'])
-        print(updateZnode(znodeDict))
+        hostName  = list(list(znodeDict.values())[0].keys())[0]
+
+        if isHostPattern(hostName):
+            for resultLine in updateGroupZnodes(znodeDict, oParser()['createMissing']):
+                print(resultLine)
+        else:
+            print(updateZnode(znodeDict, oParser()['createMissing']))
         
     if oParser()['deleteMode'] is not None:
         znodeStringSplited = splitZnodeString(oParser()['deleteMode'])
@@ -888,21 +5565,88 @@ def main():
         else:
             print(znodeRenameStringSplited)
             
+    if oParser()['groupVarsMode'] is not None:
+        try:
+            print(setGroupVars(splitGroupVarString(oParser()['groupVarsMode'])))
+        except ValueError as e:
+            print("ERROR  ==> {0} !!!".format(e))
+
+    if oParser()['addChildMode'] is not None:
+        znodeStringSplited = splitZnodeString(oParser()['addChildMode'])
+        if len(znodeStringSplited) == 2:
+            print(addChildGroup(znodeStringSplited))
+        else:
+            print("ERROR  ==> {0} <-- no valid child group string [parentgroupname:childgroupname] !!!".format(oParser()['addChildMode']))
+
+    if oParser()['delChildMode'] is not None:
+        znodeStringSplited = splitZnodeString(oParser()['delChildMode'])
+        if len(znodeStringSplited) == 2:
+            print(deleteChildGroup(znodeStringSplited))
+        else:
+            print("ERROR  ==> {0} <-- no valid child group string [parentgroupname:childgroupname] !!!".format(oParser()['delChildMode']))
+
     if oParser()['showMode'] is not None:
         znodeStringSplited = splitZnodeString(oParser()['showMode'])
-        print(json.dumps(showHostVars(znodeStringSplited)))
+        if oParser()['fromBin'] is not None:
+            print(json.dumps(binaryShowHostVars(znodeStringSplited, oParser()['fromBin'])))
+        else:
+            print(json.dumps(showHostVars(znodeStringSplited)))
+
+    if oParser()['queryMode'] is not None:
+        print(json.dumps(queryVarIndex(oParser()['queryMode'])))
+
+    if oParser()['indexVars'] is not None:
+        print(indexVars(oParser()['indexVars']))
+
+    if oParser()['batchFile'] is not None:
+        for resultLine in runBatch(oParser()['batchFile'], oParser()['dryRun'], oParser()['createMissing']):
+            print(resultLine)
+            if json.loads(resultLine)['status'] in ('INVALID', 'NOT_APPLIED', 'PARTLY_APPLIED'):
+                exitStatus = 1
 
     if oParser()['importToml'] is not None:
-        print(importFromToml(oParser()['importToml']))
+        print(importFromToml(oParser()['importToml'], oParser()['dryRun']))
 
     if oParser()['exportToml'] is not None:
         print(exportToToml(oParser()['exportToml']))
 
     if oParser()['importIni'] is not None:
-        print(importFromIni(oParser()['importIni']))
+        print(importFromIni(oParser()['importIni'], oParser()['dryRun']))
 
     if oParser()['exportIni'] is not None:
         print(exportToIni(oParser()['exportIni']))
+
+    if oParser()['importBin'] is not None:
+        print(importFromBinary(oParser()['importBin'], oParser()['dryRun']))
+
+    if oParser()['exportBin'] is not None:
+        print(exportToBinary(oParser()['exportBin']))
+
+    if oParser()['syncToml'] is not None:
+        print(syncFromToml(oParser()['syncToml'], oParser()['dryRun'], oParser()['force']))
+
+    if oParser()['syncIni'] is not None:
+        print(syncFromIni(oParser()['syncIni'], oParser()['dryRun'], oParser()['force']))
+
+    if oParser()['exportDelta'] is not None:
+        print(exportDelta(oParser()['exportDelta']))
+
+    if oParser()['applyDelta'] is not None:
+        print(applyDelta(oParser()['applyDelta'], oParser()['dryRun']))
+
+    if oParser()['migrateLayout'] is not None:
+        print(migrateLayout(oParser()['migrateLayout']))
+
+    if oParser()['rebuildSnapshot']:
+        print(rebuildSnapshot())
+
+    if oParser()['rebuildIndex']:
+        print(rebuildIndex())
+
+    if oParser()['serveMode']:
+        print(serveInventory())
+
+    return exitStatus
                                   
         
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+## ansible inventory plugin reading ansible-keeper inventory in process, it needs ansibleKeeper.py
+## in the same directory: point ansible to it with inventory_plugins in ansible.cfg
+
+DOCUMENTATION = '''
+    name: ansible_keeper
+    short_description: ansible-keeper zookeeper inventory
+    description:
+        - Read groups, group vars, child groups and hostvars kept in zookeeper by ansibleKeeper.py
+          straight into ansible inventory, without running fetch-inventory.sh and parsing its JSON output.
+        - Inventory source file name has to end with C(ansible_keeper.yml) or C(ansible_keeper.yaml).
+    extends_documentation_fragment:
+        - inventory_cache
+    options:
+        plugin:
+            description: token that ensures this is a source file for the 'ansible_keeper' plugin.
+            required: True
+            choices: ['ansible_keeper']
+        zk_servers:
+            description: comma separated zookeeper servers, cfg.zkServers of ansibleKeeper.py when not set.
+            type: str
+        path:
+            description: ansible-keeper path in zookeeper, cfg.aPath of ansibleKeeper.py when not set.
+            type: str
+        groups:
+            description: read only hosts of these groups and of their child groups (see ansibleKeeper.py --groups).
+            type: list
+            elements: str
+            env:
+                - name: ANSIBLE_KEEPER_GROUPS
+        fanout:
+            description: spread reads over sessions to a given number of closest servers (see ansibleKeeper.py --fanout).
+            type: int
+            default: 0
+        use_snapshot:
+            description: read inventory snapshot znode when it is not stale.
+            type: bool
+            default: True
+'''
+
+EXAMPLES = '''
+    # inventory.ansible_keeper.yml
+    plugin: ansible_keeper
+    zk_servers: con1:2181,con2:2181,con3:2181
+    path: /ansible-test
+    cache: true
+    cache_plugin: jsonfile
+    cache_connection: ~/.cache/ansible-keeper/ansible
+'''
+
+import os
+import sys
+import zlib
+
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable
+
+try:
+    from ansible.template import trust_as_template
+except ImportError:  ## ansible-core < 2.19 templates every inventory string
+    trust_as_template = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ansibleKeeper
+
+
+class InventoryModule(BaseInventoryPlugin, Cacheable):
+    ''' ansible-keeper inventory read in process '''
+
+    NAME = 'ansible_keeper'
+
+    def verify_file(self, path):
+        '''
+        Return bool (path is inventory source file of this plugin).
+        '''
+
+        return super(InventoryModule, self).verify_file(path) and path.endswith(('ansible_keeper.yml', 'ansible_keeper.yaml'))
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path)
+
+        self._read_config_data(path)
+
+        cacheKey    = self.keeperCacheKey(path)
+        useCache    = self.get_option('cache') and cache
+        updateCache = self.get_option('cache') and not cache
+        keeperInventory = None
+
+        if useCache:
+            try:
+                keeperInventory = self._cache[cacheKey]
+            except KeyError:
+                updateCache = True
+
+        if keeperInventory is None:
+            keeperInventory = self.readKeeperInventory()
+
+        if updateCache:
+            self._cache[cacheKey] = keeperInventory
+
+        self.populate(keeperInventory)
+
+    def keeperCacheKey(self, path):
+        '''
+        Cache key of inventory source file extended with zookeeper servers, ansible-keeper path and groups
+        the inventory is narrowed to, so inventories read with other settings are never mixed up.
+
+        Return string.
+        '''
+
+        settings = [self.get_option('zk_servers') or ansibleKeeper.cfg.zkServers,
+                    self.get_option('path') or ansibleKeeper.cfg.aPath,
+                    ','.join(sorted(set(self.get_option('groups') or [])))]
+
+        return "{0}_{1:08x}".format(self.get_cache_key(path), zlib.crc32('\n'.join(settings).encode('utf-8')))
+
+    def readKeeperInventory(self):
+        '''
+        Read ansible compliant inventory with options of inventory source file, ansibleKeeper.cfg
+        settings changed for the read are restored afterwards, so they never leak into other sources.
+
+        Return dict.
+        '''
+
+        cfg   = ansibleKeeper.cfg
+        saved = dict((name, getattr(cfg, name)) for name in ('zkServers', 'aPath', 'readFanout', 'useSnapshot'))
+
+        try:
+            if self.get_option('zk_servers'):
+                cfg.zkServers = self.get_option('zk_servers')
+
+            if self.get_option('path'):
+                cfg.aPath = self.get_option('path')
+
+            cfg.readFanout  = self.get_option('fanout')
+            cfg.useSnapshot = self.get_option('use_snapshot')
+
+            with ansibleKeeper.zkSession:
+                return ansibleKeeper.readAnsibleInventory(self.get_option('groups') or None)
+        finally:
+            for name, value in saved.items():
+                setattr(cfg, name, value)
+
+    def populate(self, keeperInventory):
+        '''
+        Add groups, group vars, child groups and hosts with hostvars to ansible inventory,
+        like the script plugin does with fetch-inventory.sh output.
+        '''
+
+        knownHosts = set()
+
+        for group, entry in keeperInventory.items():
+            if group == '_meta':
+                continue
+
+            group = self.inventory.add_group(group)
+
+            for host in entry.get('hosts', []):
+                knownHosts.add(host)
+                self.inventory.add_host(host, group)
+
+            for var, value in entry.get('vars', {}).items():
+                self.inventory.set_variable(group, var, self.trusted(value))
+
+            for child in entry.get('children', []):
+                self.inventory.add_child(group, self.inventory.add_group(child))
+
+        hostVars = keeperInventory.get('_meta', {}).get('hostvars', {})
+
+        for host in knownHosts:
+            for var, value in hostVars.get(host, {}).items():
+                self.inventory.set_variable(host, var, self.trusted(value))
+
+    @staticmethod
+    def trusted(value):
+        '''
+        Mark string value as template source, script plugin trusts fetch-inventory.sh output the same way.
+
+        Return value.
+        '''
+
+        if trust_as_template is not None and isinstance(value, str):
+            return trust_as_template(value)
+
+        return value
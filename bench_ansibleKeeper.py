@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Benchmark ansibleKeeper.py commands on a synthetic inventory. A local zookeeper is started in docker
+## (zookeeper image, as in .travis.yml) unless --servers is given, the inventory is written to a scratch
+## path which is deleted afterwards. Results go to stdout (or --output) as JSON: wall times and zookeeper
+## requests with payload bytes per command run, --compare prints changes against results of an older version.
+## --stress runs parallel reader and writer processes instead, like many ansible runs and provisioning jobs:
+##
+##   ./bench_ansibleKeeper.py --hosts 10000 --vars 10 --value-bytes 64 --output bench-new.json
+##   ./bench_ansibleKeeper.py --servers 127.0.0.1:2181 --compare bench-old.json
+##   ./bench_ansibleKeeper.py --stress 60 --readers 40 --writers 4
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import socket
+import string
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import kazoo.version
+import ansibleKeeper
+from kazoo.client import KazooClient
+
+
+def oParser(argv=None):
+    '''
+    Return optparse options.
+    '''
+
+    parser = OptionParser()
+    parser.add_option("--servers", help="zookeeper servers to use instead of starting one in docker")
+    parser.add_option("--image", default="zookeeper", help="docker image of local zookeeper")
+    parser.add_option("--port", type="int", default=2181, help="local port of zookeeper started in docker")
+    parser.add_option("--path", default="/ansible-keeper-bench",
+                      help="scratch ansible-keeper path, deleted after the benchmark")
+    parser.add_option("--hosts", type="int", default=1000, help="number of hosts")
+    parser.add_option("--groups", type="int", default=20, help="number of groups")
+    parser.add_option("--groups-per-host", type="int", default=1, help="number of groups every host is member of")
+    parser.add_option("--vars", type="int", default=8, help="number of hostvars per host")
+    parser.add_option("--value-bytes", type="int", default=16, help="size of hostvar values")
+    parser.add_option("--layout", default="v1", help="hostvars storage layout: v1 or v2")
+    parser.add_option("--repeat", type="int", default=3, help="runs of every read command")
+    parser.add_option("--sample", type="int", default=20, help="runs of every write command (hosts changed)")
+    parser.add_option("--seed", type="int", default=1, help="random seed of synthetic inventory")
+    parser.add_option("--output", help="write JSON results to file instead of stdout")
+    parser.add_option("--compare", help="print changes against JSON results of an earlier run to stderr")
+    parser.add_option("--threshold", type="float", default=1.2,
+                      help="median time or requests ratio reported as regression by --compare (exit code 1)")
+    parser.add_option("--stress", type="float",
+                      help="run parallel readers and writers for a given number of seconds instead of the benchmark")
+    parser.add_option("--readers", type="int", default=16, help="--stress reader processes (-I ansible, --host)")
+    parser.add_option("--writers", type="int", default=2,
+                      help="--stress writer processes (addHostWithHostvars, updateZnode)")
+    parser.add_option("--host-ratio", type="float", default=0.5, help="share of --host among --stress reads")
+
+    return parser.parse_args(argv)[0]
+
+
+def startZookeeper(image, port):
+    '''
+    Start zookeeper docker container and wait until it accepts sessions.
+
+    Return tuple (container id, zookeeper servers).
+    '''
+
+    container = subprocess.check_output(['docker', 'run', '-d', '--rm', '-p', '127.0.0.1:{0}:2181'.format(port),
+                                         '-e', 'ZOO_4LW_COMMANDS_WHITELIST=mntr,srvr,ruok', image])
+    container = container.decode('utf-8').strip()
+    servers   = '127.0.0.1:{0}'.format(port)
+
+    for attempt in range(60):
+        zk = KazooClient(hosts=servers)
+
+        try:
+            zk.start(timeout=1)
+            zk.stop()
+            zk.close()
+            return container, servers
+        except Exception:
+            zk.close()
+            time.sleep(1)
+
+    stopZookeeper(container)
+    raise RuntimeError("zookeeper in docker container {0} did not start".format(container))
+
+
+def stopZookeeper(container):
+    subprocess.call(['docker', 'stop', container], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def generateInventory(opts):
+    '''
+    Generate synthetic inventory.
+
+    Return tuple (groups {groupname: [hostname1]}, hostvars {hostname1: {var1: value1}}).
+    '''
+
+    rnd       = random.Random(opts.seed)
+    groupList = ['bench_group{0:04d}'.format(number) for number in range(opts.groups)]
+    groups    = dict((group, []) for group in groupList)
+    hostvars  = {}
+
+    for number in range(opts.hosts):
+        host = 'bench{0:07d}.dmz'.format(number)
+
+        for group in rnd.sample(groupList, min(opts.groups_per_host, len(groupList))):
+            groups[group].append(host)
+
+        hostvars[host] = dict(('var{0}'.format(var), ''.join(rnd.choice(string.ascii_letters) for char in range(opts.value_bytes)))
+                              for var in range(opts.vars))
+
+    return groups, hostvars
+
+
+def dropPath(path):
+    '''
+    Delete scratch ansible-keeper path recursively.
+    '''
+
+    zk = ansibleKeeper.zkStartRw()
+
+    if zk.exists(path):
+        zk.delete(path, recursive=True)
+
+
+def requestCounts():
+    '''
+    Return dict ({zookeeper request type: [requests, bytes]}) counted so far by ansibleKeeper.opMetrics.
+    '''
+
+    counts = {}
+
+    with ansibleKeeper.opMetrics.lock:
+        for (command, op), (count, seconds, size, buckets) in ansibleKeeper.opMetrics.ops.items():
+            entry = counts.setdefault(op, [0, 0])
+            entry[0] += count
+            entry[1] += size
+
+    return counts
+
+
+class Bench(object):
+    ''' Timings and zookeeper requests of benchmarked commands '''
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, function, *args):
+        '''
+        Run function(*args) once, add its wall time and zookeeper requests to results of name.
+
+        Return function result.
+        '''
+
+        before  = requestCounts()
+        started = time.perf_counter()
+
+        with contextlib.redirect_stdout(sys.stderr):  ## progress lines of imports
+            result = function(*args)
+
+        seconds = time.perf_counter() - started
+        entry   = self.results.setdefault(name, {'runs': 0, 'seconds': [], 'requests': {}, 'bytes': 0})
+        entry['runs'] += 1
+        entry['seconds'].append(seconds)
+
+        for op, (count, size) in requestCounts().items():
+            count -= before.get(op, [0, 0])[0]
+            size  -= before.get(op, [0, 0])[1]
+
+            if count:
+                entry['requests'][op] = entry['requests'].get(op, 0) + count
+            entry['bytes'] += size
+
+        return result
+
+    def report(self):
+        '''
+        Return dict ({name: summary}), requests and bytes are per run.
+        '''
+
+        report = {}
+
+        for name, entry in self.results.items():
+            runs = entry['runs']
+            report[name] = {'runs': runs,
+                            'seconds': {'min': min(entry['seconds']), 'median': statistics.median(entry['seconds']),
+                                        'max': max(entry['seconds'])},
+                            'requests': dict((op, count / runs) for op, count in sorted(entry['requests'].items())),
+                            'requestsTotal': sum(entry['requests'].values()) / runs,
+                            'bytes': entry['bytes'] / runs}
+
+        return report
+
+
+def benchmark(opts):
+    '''
+    Seed scratch inventory and run benchmarked commands over it.
+
+    Return dict (results by command name).
+    '''
+
+    bench    = Bench()
+    benchDir = tempfile.mkdtemp(prefix='ansible-keeper-bench.')
+    groups, hostvars = generateInventory(opts)
+    hostList  = sorted(hostvars)
+    groupList = sorted(groups)
+    sample    = random.Random(opts.seed).sample(hostList, min(opts.sample, len(hostList)))
+    sourcePath, importPath = opts.path, opts.path + '-import'
+
+    ansibleKeeper.cfg.aPath = sourcePath
+    dropPath(sourcePath)
+
+    if opts.layout == 'v2':
+        ansibleKeeper.setLayout(ansibleKeeper.zkStartRw(), 'v2')
+
+    bench.run('importInventory', ansibleKeeper.importInventory, 'bench', groups, hostvars)
+    del hostvars
+
+    ## reads
+    for attempt in range(opts.repeat):
+        bench.run('ansibleInventoryDump', ansibleKeeper.ansibleInventoryDump)
+        bench.run('inventoryDump all', ansibleKeeper.inventoryDump, 'all')
+        bench.run('inventoryDump groups', ansibleKeeper.inventoryDump, 'groups')
+        bench.run('inventoryDump hosts', ansibleKeeper.inventoryDump, 'hosts')
+        bench.run('showHostVars group', ansibleKeeper.showHostVars, ansibleKeeper.splitZnodeString(groupList[0]))
+
+    for host in sample:
+        bench.run('showHostVars host', ansibleKeeper.showHostVars, ansibleKeeper.splitZnodeString('hosts:' + host))
+        bench.run('ansibleHostAccess', ansibleKeeper.ansibleHostAccess, host)
+
+    ## export/import pairs, imported into an empty scratch path
+    for kind, export, restore in (('toml', ansibleKeeper.exportToToml, ansibleKeeper.importFromToml),
+                                  ('ini', ansibleKeeper.exportToIni, ansibleKeeper.importFromIni),
+                                  ('bin', ansibleKeeper.exportToBinary, ansibleKeeper.importFromBinary)):
+        filePath = os.path.join(benchDir, 'inventory.' + kind)
+        bench.run('export ' + kind, export, filePath)
+
+        ansibleKeeper.cfg.aPath = importPath
+        dropPath(importPath)
+        bench.run('import ' + kind, restore, filePath)
+        dropPath(importPath)
+        ansibleKeeper.cfg.aPath = sourcePath
+
+        os.unlink(filePath)
+
+    ## writes
+    for number, host in enumerate(sample):
+        group = groupList[0]
+        bench.run('updateZnode', ansibleKeeper.updateZnode,
+                  ansibleKeeper.splitZnodeVarString('{0}:{1},var0:updated{2}'.format(group, host, number)))
+
+    for host in sample:
+        bench.run('renameZnode host', ansibleKeeper.renameZnode,
+                  ansibleKeeper.splitRenameZnodeString('hosts:{0}:{0}-renamed'.format(host)))
+
+    bench.run('renameZnode group', ansibleKeeper.renameZnode,
+              ansibleKeeper.splitRenameZnodeString('groups:{0}:{0}-renamed'.format(groupList[-1])))
+
+    for host in sample:
+        bench.run('deleteZnodeRecur host', ansibleKeeper.deleteZnodeRecur,
+                  ansibleKeeper.splitZnodeString('hosts:{0}-renamed'.format(host)))
+
+    bench.run('deleteZnodeRecur group', ansibleKeeper.deleteZnodeRecur,
+              ansibleKeeper.splitZnodeString(groupList[-1] + '-renamed'))
+
+    os.rmdir(benchDir)
+    return bench.report()
+
+
+def percentile(values, q):
+    '''
+    Return float (value at quantile q of sorted values, None for no values).
+    '''
+
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def serverConnections(servers):
+    '''
+    Sum zk_num_alive_connections of mntr four letter word over zookeeper servers.
+
+    Return int or None (mntr is not whitelisted or a server does not answer).
+    '''
+
+    total = 0
+
+    for server in servers.split(','):
+        host, sep, port = server.partition(':')
+
+        try:
+            with socket.create_connection((host, int(port or 2181)), timeout=1) as sock:
+                sock.sendall(b'mntr')
+                reply = b''.join(iter(lambda: sock.recv(65536), b'')).decode('utf-8', 'replace')
+        except (OSError, ValueError):
+            return None
+
+        for line in reply.splitlines():
+            if line.startswith('zk_num_alive_connections'):
+                total += int(line.split()[1])
+                break
+        else:
+            return None
+
+    return total
+
+
+def checkListing(inventory, varCount, anomalies):
+    '''
+    Look for consistency anomalies in -I ansible inventory seen by a stress reader:
+    group members without hostvars, hosts added by writers with some hostvars missing,
+    hostvars updated together by writers seen with different values.
+    '''
+
+    hostvars = inventory.get('_meta', {}).get('hostvars', {})
+
+    for group, entry in inventory.items():
+        if group == '_meta':
+            continue
+
+        for host in entry.get('hosts', []):
+            if host not in hostvars:
+                anomalies.append(('member without hostvars', '{0}:{1}'.format(group, host)))
+
+    for host, varDict in hostvars.items():
+        if host.startswith('stress-') and len(varDict) != varCount:
+            anomalies.append(('partial hostvars', '{0}: {1}/{2} vars'.format(host, len(varDict), varCount)))
+
+        if str(varDict.get('var0', '')).startswith('stress:') and varDict.get('var0') != varDict.get('var1'):
+            anomalies.append(('torn update', '{0}: var0={1} var1={2}'.format(host, varDict.get('var0'), varDict.get('var1'))))
+
+
+def stressWorker(role, number, settings, hostList, groupList, deadline, hostRatio, varCount, results):
+    '''
+    Run -I ansible|--host reads (role reader) or addHostWithHostvars|updateZnode writes (role writer)
+    until deadline, every operation in its own zookeeper session like a separate ansibleKeeper.py run.
+    Latencies, errors, anomalies and sessions opened are put to results queue.
+    '''
+
+    for name, value in settings.items():
+        setattr(ansibleKeeper.cfg, name, value)
+
+    rnd       = random.Random('{0}-{1}'.format(role, number))
+    latencies = {}
+    errors    = {}
+    anomalies = []
+    sessions  = 0
+    sequence  = 0
+
+    while time.time() < deadline:
+        if role == 'reader':
+            kind = '--host' if rnd.random() < hostRatio else '-I ansible'
+        else:
+            kind = 'updateZnode' if sequence % 2 else 'addHostWithHostvars'
+
+        sequence += 1
+        started   = time.perf_counter()
+        sessions += 1
+
+        try:
+            with ansibleKeeper.zkSession:
+                if kind == '-I ansible':
+                    output = io.StringIO()
+                    ansibleKeeper.writeAnsibleInventory(output, noCache=True)
+                    inventory = json.loads(output.getvalue())
+                    hostList  = [host for host in inventory.get('_meta', {}).get('hostvars', {})] or hostList
+
+                elif kind == '--host':
+                    host   = rnd.choice(hostList)
+                    result = ansibleKeeper.ansibleHostAccess(host)
+
+                    if not isinstance(result, dict):
+                        anomalies.append(('listed host missing', host))
+
+                elif kind == 'addHostWithHostvars':
+                    host   = 'stress-w{0}-{1}'.format(number, sequence)
+                    varDict = dict(('var{0}'.format(var), 'stress-add') for var in range(varCount))
+                    result = ansibleKeeper.addHostWithHostvars({rnd.choice(groupList): {host: varDict}})
+
+                else:
+                    value  = 'stress:{0}:{1}'.format(number, sequence)
+                    result = ansibleKeeper.updateZnode({groupList[0]: {rnd.choice(hostList): {'var0': value, 'var1': value}}})
+
+            if kind in ('addHostWithHostvars', 'updateZnode') and str(result).startswith('ERROR'):
+                errors[kind] = errors.get(kind, 0) + 1
+
+        except Exception:
+            errors[kind] = errors.get(kind, 0) + 1
+            continue
+
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+        if kind == '-I ansible':
+            checkListing(inventory, varCount, anomalies)
+
+    results.put({'latencies': latencies, 'errors': errors, 'anomalies': anomalies, 'sessions': sessions})
+
+
+def stress(opts, servers):
+    '''
+    Seed scratch inventory and run opts.readers reader and opts.writers writer processes against it
+    for opts.stress seconds, sampling zookeeper server connections meanwhile.
+
+    Return dict (throughput, latency, errors, anomalies and sessions).
+    '''
+
+    groups, hostvars = generateInventory(opts)
+    hostList  = sorted(hostvars)
+    groupList = sorted(groups)
+
+    ansibleKeeper.cfg.aPath = opts.path
+
+    with ansibleKeeper.zkSession:
+        dropPath(opts.path)
+
+        if opts.layout == 'v2':
+            ansibleKeeper.setLayout(ansibleKeeper.zkStartRw(), 'v2')
+
+        with contextlib.redirect_stdout(sys.stderr):
+            ansibleKeeper.importInventory('stress', groups, hostvars)
+
+    settings = dict((name, getattr(ansibleKeeper.cfg, name)) for name in
+                    ('zkServers', 'aPath', 'cacheFile', 'hostStoreFile', 'useSnapshot', 'fetchWindow'))
+    results  = multiprocessing.Queue()
+    deadline = time.time() + opts.stress
+    workers  = [multiprocessing.Process(target=stressWorker, args=(role, number, settings, hostList, groupList,
+                                                                   deadline, opts.host_ratio, opts.vars, results))
+                for role, count in (('reader', opts.readers), ('writer', opts.writers)) for number in range(count)]
+
+    for worker in workers:
+        worker.start()
+
+    connections = []
+
+    while time.time() < deadline:
+        connections.append(serverConnections(servers))
+        time.sleep(0.5)
+
+    reports = [results.get() for worker in workers]
+
+    for worker in workers:
+        worker.join()
+
+    latencies, errors, anomalies, samples = {}, {}, {}, []
+
+    for report in reports:
+        for kind, values in report['latencies'].items():
+            latencies.setdefault(kind, []).extend(values)
+
+        for kind, count in report['errors'].items():
+            errors[kind] = errors.get(kind, 0) + count
+
+        for kind, sample in report['anomalies']:
+            anomalies[kind] = anomalies.get(kind, 0) + 1
+            if len(samples) < 20:
+                samples.append('{0}: {1}'.format(kind, sample))
+
+    operations = {}
+
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        operations[kind] = {'count': len(values), 'perSecond': len(values) / opts.stress,
+                            'latency': {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+                                        'p99': percentile(values, 0.99), 'max': values[-1]}}
+
+    connections = [count for count in connections if count is not None]
+
+    return {'seconds': opts.stress, 'readers': opts.readers, 'writers': opts.writers,
+            'operations': operations, 'errors': errors, 'anomalies': anomalies, 'anomalySamples': samples,
+            'sessions': {'opened': sum(report['sessions'] for report in reports),
+                         'serverConnectionsMax': max(connections) if connections else None}}
+
+
+def gitVersion():
+    '''
+    Return string (git describe of this checkout) or None.
+    '''
+
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(old, new, threshold):
+    '''
+    Print median time and requests per run of new results against old ones to stderr.
+
+    Return list (names of commands slower or doing more requests by threshold ratio).
+    '''
+
+    regressions = []
+
+    print("{0:<24} {1:>10} {2:>10} {3:>7} {4:>10} {5:>10} {6:>7}".format(
+        'command', 'old s', 'new s', 'ratio', 'old req', 'new req', 'ratio'), file=sys.stderr)
+
+    for name in sorted(set(old['results']) & set(new['results'])):
+        oldEntry, newEntry = old['results'][name], new['results'][name]
+        oldTime, newTime   = oldEntry['seconds']['median'], newEntry['seconds']['median']
+        oldReqs, newReqs   = oldEntry['requestsTotal'], newEntry['requestsTotal']
+        timeRatio = newTime / oldTime if oldTime else 1.0
+        reqsRatio = newReqs / oldReqs if oldReqs else (1.0 if not newReqs else float('inf'))
+        regressed = timeRatio > threshold or reqsRatio > threshold
+
+        if regressed:
+            regressions.append(name)
+
+        print("{0:<24} {1:>10.4f} {2:>10.4f} {3:>6.2f}x {4:>10.1f} {5:>10.1f} {6:>6.2f}x{7}".format(
+            name, oldTime, newTime, timeRatio, oldReqs, newReqs, reqsRatio, '  <== REGRESSION' if regressed else ''),
+            file=sys.stderr)
+
+    return regressions
+
+
+def main(argv=None):
+    '''
+    Main logic
+    '''
+
+    opts      = oParser(argv)
+    container = None
+    servers   = opts.servers
+
+    ## local caches would hide zookeeper requests of the benchmarked commands
+    ansibleKeeper.cfg.cacheFile     = None
+    ansibleKeeper.cfg.hostStoreFile = None
+    ansibleKeeper.cfg.useSnapshot   = False
+
+    if servers is None:
+        container, servers = startZookeeper(opts.image, opts.port)
+
+    ansibleKeeper.cfg.zkServers = servers
+
+    try:
+        try:
+            if opts.stress:
+                stressResults = stress(opts, servers)
+            else:
+                with ansibleKeeper.zkSession:
+                    results = benchmark(opts)
+        finally:
+            with ansibleKeeper.zkSession:
+                dropPath(opts.path)
+                dropPath(opts.path + '-import')
+    finally:
+        if container is not None:
+            stopZookeeper(container)
+
+    document = {'ansibleKeeper': ansibleKeeper.__version__, 'git': gitVersion(),
+                'python': platform.python_version(), 'kazoo': kazoo.version.__version__,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'params': {'hosts': opts.hosts, 'groups': opts.groups, 'groupsPerHost': opts.groups_per_host,
+                           'vars': opts.vars, 'valueBytes': opts.value_bytes, 'layout': opts.layout,
+                           'repeat': opts.repeat, 'sample': opts.sample, 'seed': opts.seed,
+                           'fetchWindow': ansibleKeeper.cfg.fetchWindow}}
+
+    if opts.stress:
+        document['stress'] = stressResults
+    else:
+        document['results'] = results
+
+    if opts.output is not None:
+        with open(opts.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(document, indent=2, sort_keys=True))
+
+    if opts.compare is not None and not opts.stress:
+        with open(opts.compare) as f:
+            regressions = compareResults(json.load(f), document, opts.threshold)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Benchmark ansible inventory loading through the script path (ansibleKeeper.py -I ansible run by
+## ansible script plugin, as fetch-inventory.sh does without --serve daemon) against the in-process
+## ansible_keeper inventory plugin. Hosts are written to a scratch path which is deleted afterwards:
+##
+##   ./bench_inventory.py --servers con1:2181 --hosts 1000,10000,50000
+
+import os
+import sys
+import stat
+import time
+import tempfile
+import statistics
+from optparse import OptionParser
+
+repoDir = os.path.dirname(os.path.abspath(__file__))
+
+## ansible reads plugin settings once, before its modules are imported
+os.environ['ANSIBLE_INVENTORY_PLUGINS'] = repoDir
+os.environ['ANSIBLE_INVENTORY_ENABLED'] = 'script,ansible_keeper'
+os.environ.pop('ANSIBLE_KEEPER_GROUPS', None)
+
+sys.path.insert(0, repoDir)
+
+import ansibleKeeper
+from ansible.parsing.dataloader import DataLoader
+from ansible.inventory.manager import InventoryManager
+
+
+SCRIPT = '''#!{python}
+import sys
+sys.path.insert(0, {repoDir!r})
+import ansibleKeeper
+ansibleKeeper.cfg.zkServers   = {zkServers!r}
+ansibleKeeper.cfg.aPath       = {aPath!r}
+ansibleKeeper.cfg.useSnapshot = {useSnapshot!r}
+sys.argv = [sys.argv[0], '-I', 'ansible', '--no-cache']
+ansibleKeeper.main()
+'''
+
+PLUGIN = '''plugin: ansible_keeper
+zk_servers: {zkServers}
+path: {aPath}
+use_snapshot: {useSnapshot}
+'''
+
+
+def oParser():
+    '''
+    Return optparse options.
+    '''
+
+    parser = OptionParser()
+    parser.add_option("--servers", default=ansibleKeeper.cfg.zkServers,
+                      help="comma separated zookeeper servers")
+    parser.add_option("--path", default=ansibleKeeper.cfg.aPath + '-bench',
+                      help="scratch ansible-keeper path, deleted after the benchmark")
+    parser.add_option("--hosts", default="1000,10000,50000",
+                      help="comma separated inventory sizes")
+    parser.add_option("--groups", type="int", default=20,
+                      help="number of groups hosts are spread over")
+    parser.add_option("--vars", type="int", default=8,
+                      help="number of hostvars per host")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="inventory loads per source and size")
+    parser.add_option("--no-snapshot", action="store_true", default=False,
+                      help="walk the tree instead of reading inventory snapshot")
+
+    return parser.parse_args()[0]
+
+
+def seedInventory(hostCount, groupCount, varCount):
+    '''
+    Replace scratch inventory with hostCount hosts spread over groupCount groups, with snapshot.
+    '''
+
+    zk = ansibleKeeper.zkStartRw()
+
+    if zk.exists(ansibleKeeper.cfg.aPath):
+        zk.delete(ansibleKeeper.cfg.aPath, recursive=True)
+
+    groups, hostvars = {}, {}
+
+    for number in range(hostCount):
+        host = 'bench{0:06d}.dmz'.format(number)
+        groups.setdefault('bench_group{0:03d}'.format(number % groupCount), []).append(host)
+        hostvars[host] = dict(('var{0}'.format(var), 'value{0}-{1}'.format(var, number)) for var in range(varCount))
+
+    ansibleKeeper.importInventory('bench', groups, hostvars)
+    ansibleKeeper.rebuildSnapshot()
+
+
+def loadInventory(source, repeat):
+    '''
+    Load inventory source with ansible InventoryManager repeat times.
+
+    Return tuple (list of seconds, number of hosts).
+    '''
+
+    timings = []
+
+    for attempt in range(repeat):
+        started   = time.perf_counter()
+        inventory = InventoryManager(loader=DataLoader(), sources=[source])
+        timings.append(time.perf_counter() - started)
+
+    return timings, len(inventory.hosts)
+
+
+def main():
+    '''
+    Main logic
+    '''
+
+    opts = oParser()
+    ansibleKeeper.cfg.zkServers = opts.servers
+    ansibleKeeper.cfg.aPath     = opts.path
+
+    workDir = tempfile.mkdtemp()
+    script  = os.path.join(workDir, 'inventory.py')
+    plugin  = os.path.join(workDir, 'bench.ansible_keeper.yml')
+    options = {'python': sys.executable, 'repoDir': repoDir, 'zkServers': opts.servers,
+               'aPath': opts.path, 'useSnapshot': not opts.no_snapshot}
+
+    with open(script, 'w') as scriptFile:
+        scriptFile.write(SCRIPT.format(**options))
+
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+
+    with open(plugin, 'w') as pluginFile:
+        pluginFile.write(PLUGIN.format(**options))
+
+    print("{0:>8} {1:>8} {2:>10} {3:>10} {4:>8}".format('hosts', 'source', 'best s', 'median s', 'speedup'))
+
+    try:
+        for hostCount in [int(count) for count in opts.hosts.split(',')]:
+            with ansibleKeeper.zkSession:
+                seedInventory(hostCount, opts.groups, opts.vars)
+
+            scriptTimes, scriptHosts = loadInventory(script, opts.repeat)
+            pluginTimes, pluginHosts = loadInventory(plugin, opts.repeat)
+
+            if scriptHosts != pluginHosts or scriptHosts != hostCount:
+                print("ERROR  ==> script loaded {0}, plugin {1} of {2} hosts !!!".format(scriptHosts, pluginHosts, hostCount))
+
+            print("{0:>8} {1:>8} {2:>10.3f} {3:>10.3f}".format(hostCount, 'script', min(scriptTimes), statistics.median(scriptTimes)))
+            print("{0:>8} {1:>8} {2:>10.3f} {3:>10.3f} {4:>7.1f}x".format(hostCount, 'plugin', min(pluginTimes), statistics.median(pluginTimes),
+                                                                        statistics.median(scriptTimes) / statistics.median(pluginTimes)))
+    finally:
+        with ansibleKeeper.zkSession:
+            zk = ansibleKeeper.zkStartRw()
+
+            if zk.exists(ansibleKeeper.cfg.aPath):
+                zk.delete(ansibleKeeper.cfg.aPath, recursive=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,5 +5,40 @@
 ##
 
 ZOO_ANSIBLE_PATH=./
+ZOO_ANSIBLE_SOCKET=${ANSIBLE_KEEPER_SOCKET:-$HOME/.cache/ansible-keeper/serve.sock}
 
-$ZOO_ANSIBLE_PATH/ansibleKeeper.py -I ansible
+if [ "$1" == "--host" ]; then
+    REQUEST="host $2"
+    ARGS=(--host "$2")
+else
+    ## ANSIBLE_KEEPER_GROUPS=web,db narrows inventory to hosts of these groups
+    REQUEST="ansible${ANSIBLE_KEEPER_GROUPS:+ $ANSIBLE_KEEPER_GROUPS}"
+    ARGS=(-I ansible)
+fi
+
+## ask ansibleKeeper.py --serve daemon first, it answers from memory
+if [ -S "$ZOO_ANSIBLE_SOCKET" ]; then
+    if command -v socat > /dev/null; then
+        RESPONSE=$(printf '%s\n' "$REQUEST" | socat - "UNIX-CONNECT:$ZOO_ANSIBLE_SOCKET" 2> /dev/null)
+    else
+        RESPONSE=$(python3 -S -c '
+import sys, socket
+s = socket.socket(socket.AF_UNIX)
+s.connect(sys.argv[1])
+s.sendall(sys.argv[2].encode("utf-8") + b"\n")
+while True:
+    chunk = s.recv(1 << 20)
+    if not chunk:
+        break
+    sys.stdout.buffer.write(chunk)
+' "$ZOO_ANSIBLE_SOCKET" "$REQUEST" 2> /dev/null)
+    fi
+
+    if [ -n "$RESPONSE" ]; then
+        printf '%s\n' "$RESPONSE"
+        exit 0
+    fi
+fi
+
+## no daemon running or it is disconnected from zookeeper: read zookeeper directly
+exec $ZOO_ANSIBLE_PATH/ansibleKeeper.py "${ARGS[@]}"
@@ -1,3 +1,9 @@
+import sys
+import random
+import threading
+import pytest
+from kazoo.exceptions import NodeExistsError
+from kazoo.protocol.states import ZnodeStat
 from ansibleKeeper import * 
 
 def test_import_export_ini():
@@ -30,5 +36,928 @@ def test_import_export_ini():
 
 
 
+class StubResult(object):
+    '''
+    Result of stub async call.
+    '''
+
+    def __init__(self, call, *args):
+        try:
+            self.value, self.error = call(*args), None
+        except NoNodeError as e:
+            self.value, self.error = None, e
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class StubTransaction(object):
+    '''
+    Transaction of stub client, operations are applied all or nothing.
+    '''
+
+    def __init__(self, zk):
+        self.zk, self.ops = zk, []
+
+    def create(self, path, value=b''):
+        self.ops.append(('create', path, value))
+
+    def set_data(self, path, value, version=-1):
+        self.ops.append(('set_data', path, value, version))
+
+    def delete(self, path, version=-1):
+        self.ops.append(('delete', path, version))
+
+    def check(self, path, version):
+        self.ops.append(('check', path, version))
+
+    def commit(self):
+        saved = dict(self.zk.nodes)
+
+        try:
+            for op in self.ops:
+                if op[0] == 'check':
+                    if self.zk.get(op[1])[1].version != op[2]:
+                        raise BadVersionError()
+                else:
+                    getattr(self.zk, {'set_data': 'set'}.get(op[0], op[0]))(*op[1:])
+        except (NoNodeError, BadVersionError, NodeExistsError) as e:
+            self.zk.nodes = saved
+            return [e]
+
+        return [True] * len(self.ops)
+
+
+class StubZk(object):
+    '''
+    In memory zookeeper client with kazoo methods used by ansibleKeeper.
+    '''
+
+    ## nodes: {path: (data, version, czxid, mzxid, pzxid)}, every write takes the next zxid
+
+    def __init__(self, leader=None):
+        self.nodes     = {'/': (b'', 0, 0, 0, 0)} if leader is None else dict(leader.nodes)
+        self.last_zxid = 0 if leader is None else leader.last_zxid
+        self.leader    = leader  ## replica of leader client catching up on sync
+
+    def stat(self, path):
+        data, version, czxid, mzxid, pzxid = self.nodes[path]
+        children = len(self.get_children(path))
+        return ZnodeStat(czxid, mzxid, 0, 0, version, children, 0, 0, len(data), children, pzxid)
+
+    def childrenChanged(self, path):
+        parent = path.rsplit('/', 1)[0] or '/'
+        self.nodes[parent] = self.nodes[parent][:4] + (self.last_zxid,)
+
+    def get(self, path):
+        if path not in self.nodes:
+            raise NoNodeError()
+        return self.nodes[path][0], self.stat(path)
+
+    def get_children(self, path):
+        if path not in self.nodes:
+            raise NoNodeError()
+        prefix = path.rstrip('/') + '/'
+        return [node[len(prefix):] for node in self.nodes if node.startswith(prefix) and '/' not in node[len(prefix):]]
+
+    def exists(self, path):
+        return self.stat(path) if path in self.nodes else None
+
+    def create(self, path, value=b'', makepath=False):
+        parent = path.rsplit('/', 1)[0] or '/'
+        if path in self.nodes:
+            raise NodeExistsError()
+        if parent not in self.nodes:
+            if not makepath:
+                raise NoNodeError()
+            self.create(parent, makepath=True)
+        self.last_zxid += 1
+        self.nodes[path] = (value, 0, self.last_zxid, self.last_zxid, self.last_zxid)
+        self.childrenChanged(path)
+        return path
+
+    def ensure_path(self, path):
+        if path not in self.nodes:
+            self.create(path, makepath=True)
+
+    def set(self, path, value, version=-1):
+        if path not in self.nodes:
+            raise NoNodeError()
+        if version not in (-1, self.nodes[path][1]):
+            raise BadVersionError()
+        self.last_zxid += 1
+        self.nodes[path] = (value, self.nodes[path][1] + 1, self.nodes[path][2], self.last_zxid, self.nodes[path][4])
+
+    def delete(self, path, version=-1, recursive=False):
+        if path not in self.nodes:
+            raise NoNodeError()
+        if version not in (-1, self.nodes[path][1]):
+            raise BadVersionError()
+        for node in [node for node in self.nodes if node.startswith(path + '/')]:
+            del self.nodes[node]
+        del self.nodes[path]
+        self.last_zxid += 1
+        self.childrenChanged(path)
+
+    def sync(self, path):
+        if self.leader is not None:
+            self.nodes, self.last_zxid = dict(self.leader.nodes), self.leader.last_zxid
+
+    def sync_async(self, path):
+        return StubResult(self.sync, path)
+
+    def transaction(self):
+        return StubTransaction(self)
+
+    def get_async(self, path):
+        return StubResult(self.get, path)
+
+    def get_children_async(self, path):
+        return StubResult(self.get_children, path)
+
+    def exists_async(self, path):
+        return StubResult(self.exists, path)
+
+
+def useClient(monkeypatch, zk):
+    '''
+    Point ansibleKeeper sessions to another stub client.
+    '''
+
+    for start in ('zkStartRo', 'zkStartRw', 'zkStartFanout'):
+        monkeypatch.setattr(sys.modules['ansibleKeeper'], start, lambda: zk)
+
+
+@pytest.fixture
+def stubZk(monkeypatch):
+    '''
+    Point ansibleKeeper sessions to a fresh stub client.
+    '''
+
+    zk = StubZk()
+    monkeypatch.setattr(cfg, 'aPath', '/ansible-test')
+    monkeypatch.setattr(cfg, 'cacheFile', None)
+    monkeypatch.setattr(cfg, 'hostStoreFile', None)
+    monkeypatch.setattr(cfg, 'snapshotOnWrite', False)
+    useClient(monkeypatch, zk)
+    return zk
+
+
+def test_import_ini_children_only(stubZk, tmp_path):
+    '''
+    Test importFromIni() with parent and vars-only groups having no plain section.
+    '''
+
+    iniPath = tmp_path / "inventory.ini"
+    iniPath.write_text("[web]\nweb1\n\n[dmz:children]\nweb\n\n[db:vars]\nport = 5432\n")
+
+    assert importFromIni(str(iniPath)).startswith("Imported inventory")
+
+    groups = stubZk.get_children("{}/groups".format(cfg.aPath))
+    assert sorted(groups) == ['db', 'dmz', 'web']
+    assert readGroupTree(stubZk)[0]['groups']['dmz']['children'] == ['web']
+    assert ansibleInventoryDump(stubZk)['db']['vars'] == {'port': '5432'}
+
+
+def test_sync_empty_inventory(stubZk, tmp_path):
+    '''
+    Test syncFromIni() refusing a file without hosts and groups unless forced.
+    '''
+
+    iniPath = tmp_path / "empty.ini"
+    iniPath.write_text("")
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+
+    assert syncFromIni(str(iniPath)).startswith("ERROR  ==> no hosts or groups")
+    assert stubZk.get_children("{}/hosts".format(cfg.aPath)) == ['web1']
+    assert syncFromIni(str(iniPath), dryRun=True).startswith("- ")
+
+    assert syncFromIni(str(iniPath), force=True).startswith("SYNCED")
+    assert stubZk.get_children("{}/hosts".format(cfg.aPath)) == []
+    assert stubZk.get_children("{}/groups".format(cfg.aPath)) == []
+
+
+def test_sync_concurrent_hostvar_write(stubZk, tmp_path, monkeypatch):
+    '''
+    Test syncFromIni() planning again when a hostvar is changed between its read and the commit.
+    '''
+
+    iniPath = tmp_path / "inventory.ini"
+    iniPath.write_text("[web]\nweb1\n\n[hostvars:web1]\nntp = b\n")
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a', 'dns': 'a'}}})
+    addHostWithHostvars({'web': {'old1': {}}})
+
+    commit = sys.modules['ansibleKeeper'].commitOps
+    calls  = []
+
+    def racingCommit(zk, ops, progress=None):
+        calls.append(ops)
+        if len(calls) == 1:
+            zk.set("{}/hosts/web1/ntp".format(cfg.aPath), b'changed')
+        return commit(zk, ops, progress)
+
+    monkeypatch.setattr(sys.modules['ansibleKeeper'], 'commitOps', racingCommit)
+
+    assert syncFromIni(str(iniPath)).startswith("SYNCED")
+    assert len(calls) == 2
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'b'}
+    assert stubZk.get_children("{}/hosts".format(cfg.aPath)) == ['web1']
+
+
+def test_host_store_after_write(stubZk, tmp_path, monkeypatch):
+    '''
+    Test storedHostAccess() right after writes of this process and for hosts missing in the store.
+    '''
+
+    monkeypatch.setattr(cfg, 'hostStoreFile', str(tmp_path / "hosts-{}.akb"))
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+    assert storedHostAccess('web1') == {'ntp': 'a'}
+
+    updateZnode({'web': {'web1': {'ntp': 'b'}}})
+    assert storedHostAccess('web1') == {'ntp': 'b'}
+
+    ## host created by another machine while the store is trusted
+    stubZk.create("{}/hosts/web2".format(cfg.aPath), b'', makepath=True)
+    assert storedHostAccess('web2') == {}
+    assert storedHostAccess('web3').startswith("ERROR  ==> no such host")
+
+
+def test_migrate_layout_keeps_concurrent_update(stubZk, monkeypatch):
+    '''
+    Test migrateLayout() when a hostvar is changed between its read and the batch commit.
+    '''
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a', 'dns': 'b'}}})
+    commit = sys.modules['ansibleKeeper'].commitOps
+    raced  = []
+
+    def racingCommit(zk, ops, progress=None):
+        if not raced:
+            raced.append(True)
+            zk.set("{}/hosts/web1/ntp".format(cfg.aPath), b'changed')
+        return commit(zk, ops, progress)
+
+    monkeypatch.setattr(sys.modules['ansibleKeeper'], 'commitOps', racingCommit)
+
+    assert migrateLayout('v2').startswith("MIGRATED")
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'changed', 'dns': 'b'}
+
+
+def test_batch_failed_transaction(stubZk, tmp_path, monkeypatch):
+    '''
+    Test runBatch() reporting every line when a later transaction of the batch fails.
+    '''
+
+    batchPath = tmp_path / "batch.txt"
+    batchPath.write_text("-A web:web1,ntp:a\n-A web:web2,ntp:b\n-A db:db1,ntp:c\n")
+    commit = sys.modules['ansibleKeeper'].commitOps
+    calls  = []
+
+    def failingCommit(zk, ops, progress=None):
+        calls.append(ops)
+        if len(calls) == 2:
+            return NodeExistsError()
+        return commit(zk, ops, progress)
+
+    monkeypatch.setattr(cfg, 'txnMaxOps', 3)
+    monkeypatch.setattr(sys.modules['ansibleKeeper'], 'commitOps', failingCommit)
+
+    results = [json.loads(line) for line in runBatch(str(batchPath))]
+
+    assert [result['line'] for result in results] == [1, 2, 3]
+    assert set(result['status'] for result in results) == {'PARTLY_APPLIED'}
+    assert set(result['committed'] for result in results) == {'partial'}
+
+
+def test_update_pattern_child_groups(stubZk, tmp_path):
+    '''
+    Test -U host glob patterns matching hosts of child groups, on the commandline and in --batch.
+    '''
+
+    for group, host in (('web', 'web1'), ('web', 'web2'), ('dmz', 'dmz1'), ('db', 'db1')):
+        addHostWithHostvars({group: {host: {'ntp': 'a'}}})
+    addChildGroup(splitZnodeString('dmz:web'))
+
+    results = updateGroupZnodes({'dmz': {'*': {'ntp': 'b'}}})
+
+    assert [line.split(' with')[0] for line in results[:-1]] == \
+           ["UPDATED  ==> host: {0}".format(host) for host in ('dmz1', 'web1', 'web2')]
+    assert sorted(host for host, varDict in fetchHostVars(stubZk, ['db1', 'dmz1', 'web1', 'web2']).items()
+                  if varDict['ntp'] == 'b') == ['dmz1', 'web1', 'web2']
+
+    batchPath = tmp_path / "batch.txt"
+    batchPath.write_text("-U dmz:web*,ntp:c\n-U hosts:d*,ntp:d\n-U nogroup:*,ntp:e\n")
+    results = [json.loads(line) for line in runBatch(str(batchPath))]
+
+    assert [result['status'] for result in results] == ['UPDATED', 'UPDATED', 'GROUP_DOES_NOT_EXIST']
+    assert results[0]['result'].splitlines()[-1].startswith("SUMMARY  ==> group: dmz, hosts matching web*: 2")
+    assert fetchHostVars(stubZk, ['db1', 'dmz1', 'web1', 'web2']) == \
+           {'db1': {'ntp': 'd'}, 'dmz1': {'ntp': 'd'}, 'web1': {'ntp': 'c'}, 'web2': {'ntp': 'c'}}
+
+
+def test_fanout_consistent_read(stubZk):
+    '''
+    Test consistentRead() syncing lagging fanout sessions and reading again after a write during the fetch.
+    '''
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+    replica = StubZk(stubZk)
+    addHostWithHostvars({'web': {'web2': {'ntp': 'a'}}})
+    reader  = FanoutReader([(stubZk, 0.001), (replica, 0.002)])
+
+    assert consistentRead(reader, ansibleInventoryDump) == ansibleInventoryDump(stubZk)
+
+    calls, discarded = [], []
+
+    def racingFetch(zk):
+        result = ansibleInventoryDump(zk)
+        calls.append(result)
+        if len(calls) == 1:
+            updateZnode({'web': {'web1': {'ntp': 'b'}}})
+        return result
+
+    result = consistentRead(reader, racingFetch, discarded.append)
+
+    assert len(calls) == 2 and discarded == calls[:1]
+    assert result['_meta']['hostvars']['web1'] == {'ntp': 'b'}
+
+
+def test_delta_round_trip(stubZk, tmp_path, monkeypatch):
+    '''
+    Test exportDelta() and applyDelta() with created, changed and deleted hosts and groups.
+    '''
+
+    replica = StubZk()
+
+    def exported(name, since):
+        useClient(monkeypatch, stubZk)
+        deltaPath = tmp_path / name
+        deltaPath.write_text(exportDelta(str(since)))
+        return str(deltaPath), json.loads(deltaPath.read_text())['zxid']
+
+    def applied(deltaPath):
+        useClient(monkeypatch, replica)
+        return applyDelta(deltaPath)
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+    addHostWithHostvars({'web': {'web2': {'ntp': 'a'}}})
+    addHostWithHostvars({'db': {'db1': {'port': '5432'}}})
+    setGroupVars({'web': {'dns': 'a'}})
+
+    fullPath, fullZxid = exported('full.json', 0)
+
+    assert applied(fullPath).startswith("APPLIED")
+    assert ansibleInventoryDump(replica) == ansibleInventoryDump(stubZk)
+    assert applied(fullPath).startswith("NOT APPLIED")
+
+    useClient(monkeypatch, stubZk)
+    deleteZnodeRecur(splitZnodeString('hosts:web2'))
+    deleteZnodeRecur(splitZnodeString('db'))
+    deleteZnodeRecur(splitZnodeString('hosts:db1'))
+    updateZnode({'web': {'web1': {'ntp': 'b'}}})
+
+    nextPath, nextZxid = exported('next.json', fullZxid)
+
+    useClient(monkeypatch, stubZk)
+    addHostWithHostvars({'web': {'web3': {}}})
+    laterPath, laterZxid = exported('later.json', nextZxid)
+
+    ## changeset starting after the last applied one is refused
+    assert applied(laterPath).startswith("ERROR  ==> changeset {0} of".format(laterPath))
+    assert readDeltaApplied(replica)[0]['zxid'] == fullZxid
+
+    assert applied(nextPath).startswith("APPLIED")
+    assert sorted(replica.get_children("{}/hosts".format(cfg.aPath))) == ['web1']
+    assert sorted(replica.get_children("{}/groups".format(cfg.aPath))) == ['web']
+    assert fetchHostVars(replica, ['web1'])['web1'] == {'ntp': 'b'}
+
+    assert applied(laterPath).startswith("APPLIED")
+    assert readDeltaApplied(replica)[0] == {'source': "{0}{1}".format(cfg.zkServers, cfg.aPath), 'zxid': laterZxid}
+    assert ansibleInventoryDump(replica) == ansibleInventoryDump(stubZk)
+
+
+def test_batch_update_create_missing_and_vanished_host(stubZk, tmp_path, monkeypatch):
+    '''
+    Test runBatch() -U with createMissing and with a host deleted between its listing and the read of its record.
+    '''
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+    addHostWithHostvars({'web': {'web2': {'ntp': 'a'}}})
+
+    batchPath = tmp_path / "batch.txt"
+    batchPath.write_text("-U web:web1,ntp:b,rack:r1\n")
+
+    assert json.loads(runBatch(str(batchPath))[0])['status'] == 'UPDATED'
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'b'}
+
+    result = json.loads(runBatch(str(batchPath), createMissing=True)[0])
+    assert result['result'] == "UPDATED  ==> host: web1 with new hostvars {'ntp': 'b'} ===> CREATED hostvars {'rack': 'r1'}"
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'b', 'rack': 'r1'}
+
+    read = sys.modules['ansibleKeeper'].iterHostRecords
+
+    def racingRead(zk, hostList, layout, versions=None):
+        stubZk.delete("{}/hosts/web2".format(cfg.aPath))
+        return read(zk, hostList, layout, versions)
+
+    monkeypatch.setattr(sys.modules['ansibleKeeper'], 'iterHostRecords', racingRead)
+    batchPath.write_text("-U web:web2,ntp:c\n-U web:web1,ntp:c\n")
+    results = [json.loads(line) for line in runBatch(str(batchPath), dryRun=True)]
+
+    assert [result['status'] for result in results] == ['HOST_DOES_NOT_EXIST', 'UPDATED']
+
+
+def test_host_access_raw_and_effective(stubZk):
+    '''
+    Test ansibleHostAccess() returning raw hostvars unless effective vars are asked for.
+    '''
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'host'}}})
+    setGroupVars({'web': {'ntp': 'group', 'dns': 'group'}})
+
+    assert ansibleHostAccess('web1') == {'ntp': 'host'}
+    assert ansibleHostAccess('web1') == ansibleInventoryDump(stubZk)['_meta']['hostvars']['web1']
+    assert ansibleHostAccess('web1', effective=True) == {'ntp': 'host', 'dns': 'group'}
+
+
+def test_modcounter_only_after_write(stubZk):
+    '''
+    Test that refused and failed commands leave inventory modification counter alone.
+    '''
+
+    modCounterPath = "{}/modcounter".format(cfg.aPath)
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+    version = stubZk.get(modCounterPath)[1].version
+
+    assert addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})[0] == 'HOST_EXISTS'
+    assert deleteZnodeRecur(splitZnodeString('nogroup'))[0] == 'GROUP_DOES_NOT_EXIST'
+    assert updateZnode({'web': {'nohost': {'ntp': 'b'}}}).startswith("ERROR")
+    assert stubZk.get(modCounterPath)[1].version == version
+
+    assert updateZnode({'web': {'web1': {'ntp': 'b'}}}).startswith("UPDATED")
+    assert stubZk.get(modCounterPath)[1].version == version + 1
+
+
+@pytest.mark.parametrize('layout', ['v1', 'v2'])
+def test_update_retries_conflict(stubZk, monkeypatch, layout):
+    '''
+    Test updateZnode() reading the host again when a concurrent writer changed it before the commit.
+    '''
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a', 'dns': 'a'}}})
+    if layout == 'v2':
+        migrateLayout('v2')
+
+    commit = sys.modules['ansibleKeeper'].commitOps
+    calls  = []
+
+    def racingCommit(zk, ops, progress=None):
+        calls.append(ops)
+        if len(calls) == 1 and layout == 'v1':
+            zk.set("{}/hosts/web1/ntp".format(cfg.aPath), b'changed')
+            zk.set("{}/hosts/web1/dns".format(cfg.aPath), b'changed')
+        elif len(calls) == 1:
+            zk.set("{}/hosts/web1".format(cfg.aPath), packHostVars({'ntp': 'changed', 'dns': 'changed'}))
+        return commit(zk, ops, progress)
+
+    monkeypatch.setattr(sys.modules['ansibleKeeper'], 'commitOps', racingCommit)
+
+    assert updateZnode({'web': {'web1': {'ntp': 'b'}}}).startswith("UPDATED")
+    assert len(calls) == 2
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'b', 'dns': 'changed'}
+
+
+def test_update_create_missing(stubZk, monkeypatch):
+    '''
+    Test updateZnode() creating missing hostvars in the transaction updating the others.
+    '''
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+
+    assert updateZnode({'web': {'web1': {'ntp': 'b', 'rack': 'r1'}}}).startswith("UPDATED  ==> host: web1 with new hostvars {'ntp': 'b'} ===> NOT UPDATED")
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'b'}
+
+    commit = sys.modules['ansibleKeeper'].commitOps
+    calls  = []
+    monkeypatch.setattr(sys.modules['ansibleKeeper'], 'commitOps',
+                        lambda zk, ops, progress=None: calls.append(ops) or commit(zk, ops, progress))
+
+    result = updateZnode({'web': {'web1': {'ntp': 'c', 'rack': 'r1'}}}, createMissing=True)
+
+    assert result == "UPDATED  ==> host: web1 with new hostvars {'ntp': 'c'} ===> CREATED hostvars {'rack': 'r1'}"
+    assert len(calls) == 1
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'c', 'rack': 'r1'}
+
+
+def test_write_retries_below_one(stubZk, monkeypatch):
+    '''
+    Test that writes still make one attempt when cfg.writeRetries is 0.
+    '''
+
+    monkeypatch.setattr(cfg, 'writeRetries', 0)
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+
+    assert updateZnode({'web': {'web1': {'ntp': 'b'}}}).startswith("UPDATED  ==> host: web1")
+    assert fetchHostVars(stubZk, ['web1'])['web1'] == {'ntp': 'b'}
+
+
+def test_value_index(stubZk, tmp_path):
+    '''
+    Test value index kept current by add, update, rename and delete of hosts and -Q queries of it.
+    '''
+
+    valuesPath = "{}/index/vars/ntp".format(cfg.aPath)
+
+    addHostWithHostvars({'web': {'web1': {'ntp': '10.0.0.1', 'site': 'a'}}})
+    addHostWithHostvars({'web': {'web2': {'ntp': '10.0.0.1'}}})
+
+    assert queryVarIndex('ntp=10.0.0.1').startswith("ERROR  ==> hostvar: ntp is not indexed")
+    assert indexVars('ntp').startswith("INDEXED")
+    assert queryVarIndex('ntp=10.0.0.1') == ['web1', 'web2']
+
+    addHostWithHostvars({'db': {'db1': {'ntp': '10.0.0.2'}}})
+    updateZnode({'web': {'web1': {'ntp': '10.1.0.1'}}})
+
+    assert queryVarIndex('ntp=10.0.0.1') == ['web2']
+    assert queryVarIndex('ntp~10.0.') == ['db1', 'web2']
+    assert queryVarIndex('ntp~10.') == ['db1', 'web1', 'web2']
+    assert queryVarIndex('site=a') == "ERROR  ==> hostvar: site is not indexed (see --index-var) !!!"
+
+    renameZnode(splitRenameZnodeString('hosts:web2:web9'))
+    assert queryVarIndex('ntp=10.0.0.1') == ['web9']
+
+    deleteZnodeRecur(splitZnodeString('hosts:web9'))
+    assert queryVarIndex('ntp=10.0.0.1') == []
+
+    batchPath = tmp_path / "batch.txt"
+    batchPath.write_text("-U db:db1,ntp:10.1.0.1\n-A web:web3,ntp:10.2.0.1\n")
+    runBatch(str(batchPath))
+
+    assert queryVarIndex('ntp=10.1.0.1') == ['db1', 'web1']
+    assert queryVarIndex('ntp=10.2.0.1') == ['web3']
+
+    ## value znodes left without hosts are deleted
+    assert sorted(stubZk.get_children(valuesPath)) == [indexValueName('10.1.0.1'), indexValueName('10.2.0.1')]
+
+
+def test_host_groups_index(stubZk):
+    '''
+    Test host-groups index kept current by rename and delete of hosts in several groups and by group rename.
+    '''
+
+    indexPath = "{}/index/host-groups".format(cfg.aPath)
+
+    def indexed():
+        return dict((host, sorted(stubZk.get_children("{0}/{1}".format(indexPath, host))))
+                    for host in stubZk.get_children(indexPath))
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+    addHostWithHostvars({'web': {'web2': {}}})
+    addHostToGroup(splitZnodeString('db:web1'))
+
+    assert rebuildIndex().startswith("REBUILT")
+    assert indexed() == {'web1': ['db', 'web'], 'web2': ['web']}
+
+    addHostToGroup(splitZnodeString('mon:web1'))
+    assert indexed() == {'web1': ['db', 'mon', 'web'], 'web2': ['web']}
+
+    renameZnode(splitRenameZnodeString('hosts:web1:web9'))
+    assert indexed() == {'web9': ['db', 'mon', 'web'], 'web2': ['web']}
+    assert dict((group, sorted(members)) for group, members in fetchGroupMembers(stubZk, ['db', 'mon', 'web']).items()) == \
+           {'db': ['web9'], 'mon': ['web9'], 'web': ['web2', 'web9']}
+    assert fetchHostVars(stubZk, ['web9'])['web9'] == {'ntp': 'a'}
+
+    renameZnode(splitRenameZnodeString('groups:web:front'))
+    assert indexed() == {'web9': ['db', 'front', 'mon'], 'web2': ['front']}
+    assert dict((host, sorted(groups)) for host, groups in fetchHostGroups(stubZk, ['web2', 'web9']).items()) == \
+           {'web2': ['front'], 'web9': ['db', 'front', 'mon']}
+
+    deleteZnodeRecur(splitZnodeString('mon:web9'))
+    assert indexed() == {'web9': ['db', 'front'], 'web2': ['front']}
+
+    deleteZnodeRecur(splitZnodeString('hosts:web9'))
+    assert indexed() == {'web2': ['front']}
+    assert sorted(stubZk.get_children("{}/groups".format(cfg.aPath))) == ['db', 'front']
+    assert fetchGroupMembers(stubZk, ['db', 'front']) == {'db': [], 'front': ['web2']}
+
+
+def test_prometheus_textfile_concurrent_runs(tmp_path):
+    '''
+    Test OpMetrics.writePrometheus() keeping increments of runs writing the textfile at the same time.
+    '''
+
+    statsPath = str(tmp_path / "ansible_keeper.prom")
+    metrics   = OpMetrics()
+    metrics.recordCommand('updateZnode', 0.5)
+
+    def run():
+        for number in range(10):
+            metrics.writePrometheus(statsPath)
+
+    threads = [threading.Thread(target=run) for number in range(8)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(statsPath) as f:
+        samples = dict(line.rsplit(' ', 1) for line in f if not line.startswith('#'))
+
+    assert float(samples['ansible_keeper_command_runs_total{command="updateZnode"}']) == 80
+
+
+def test_buildGroupTree():
+    '''
+    Test buildGroupTree() ancestors, descendants and depth of nested child groups.
+    '''
+
+    tree = buildGroupTree({'all':   {'vars': {}, 'children': ['dmz', 'lan']},
+                           'dmz':   {'vars': {}, 'children': ['web']},
+                           'lan':   {'vars': {'ntp': 'lan'}, 'children': ['web']}})
+
+    assert tree['ancestors'] == {'dmz': ['all'], 'lan': ['all'], 'web': ['all', 'dmz', 'lan']}
+    assert tree['descendants'] == {'all': ['dmz', 'lan', 'web'], 'dmz': ['web'], 'lan': ['web']}
+    assert tree['depth'] == {'dmz': 1, 'lan': 1, 'web': 2}
+
+
+def test_buildGroupTree_cycle():
+    '''
+    Test buildGroupTree() refusing child groups cycle.
+    '''
+
+    with pytest.raises(ValueError) as error:
+        buildGroupTree({'a': {'vars': {}, 'children': ['b']},
+                        'b': {'vars': {}, 'children': ['c']},
+                        'c': {'vars': {}, 'children': ['a']}})
+
+    assert "cycle" in str(error.value)
+
+    with pytest.raises(ValueError):
+        buildGroupTree({'a': {'vars': {}, 'children': ['a']}})
+
+
+def test_effectiveHostVars():
+    '''
+    Test effectiveHostVars() precedence: parent groups first, then by name, hostvars on top.
+    '''
+
+    tree = buildGroupTree({'all': {'vars': {'ntp': 'all', 'dns': 'all', 'tz': 'all'}, 'children': ['a', 'b']},
+                           'a':   {'vars': {'ntp': 'a', 'dns': 'a'}, 'children': []},
+                           'b':   {'vars': {'ntp': 'b'}, 'children': []}})
+
+    assert effectiveHostVars({'ntp': 'host'}, ['a', 'b'], tree) == {'ntp': 'host', 'dns': 'a', 'tz': 'all'}
+    assert effectiveHostVars({}, ['a', 'b'], tree) == {'ntp': 'b', 'dns': 'a', 'tz': 'all'}
+    assert effectiveHostVars({'x': '1'}, ['nogroupvars'], tree) == {'x': '1'}
+
+
+def test_planImport(stubZk):
+    '''
+    Test planImport() against stub client: only missing or changed parts are planned.
+    '''
+
+    groups   = {'web': ['web1', 'web2']}
+    hostvars = {'web1': {'ntp': 'a'}, 'lone': {'ntp': 'c'}}
+    records  = {'dmz': {'vars': {'tz': 'utc'}, 'children': ['web']}}
+
+    stubZk.ensure_path("{}/groups".format(cfg.aPath))
+    stubZk.ensure_path("{}/hosts".format(cfg.aPath))
+
+    ops     = planImport(stubZk, groups, hostvars, 'v1', records)
+    created = set(op[1] for op in ops if op[0] == 'create')
+
+    for path in ('groups/web', 'groups/dmz', 'groups/web/web1', 'groups/web/web2',
+                 'hosts/web1', 'hosts/web1/ntp', 'hosts/web2', 'hosts/lone', 'hosts/lone/ntp'):
+        assert "{0}/{1}".format(cfg.aPath, path) in created
+
+    commitOrRaise(stubZk, ops)
+
+    assert planImport(stubZk, groups, hostvars, 'v1', records) == []
+    assert [op[0] for op in planImport(stubZk, groups, {'web1': {'ntp': 'b'}}, 'v1')] == ['set_data']
+
+
+def test_parseBatchLine():
+    '''
+    Test parseBatchLine() for option and JSON lines.
+    '''
+
+    assert parseBatchLine("-A web:web1,ntp:a") == ('-A', 'web:web1,ntp:a', ('web', 'web1', {'ntp': 'a'}))
+    assert parseBatchLine("-G web:web1") == ('-G', 'web:web1', ('web', 'web1'))
+    assert parseBatchLine("-D web") == ('-D', 'web', ('web', None))
+    assert parseBatchLine("-D hosts:web1") == ('-D', 'hosts:web1', (None, 'web1'))
+    assert parseBatchLine("-R hosts:web1:web2")[2] == ('hosts', 'web1', 'web2')
+    assert parseBatchLine('{"op": "-U", "group": "web", "host": "web1", "vars": {"cert": "a,b:c"}}')[2] == \
+        ('web', 'web1', {'cert': 'a,b:c'})
+    assert parseBatchLine('{"op": "D", "host": "web1"}')[1] == 'hosts:web1'
+
+    for line in ("-X web", "-A", '{"op": "-A"', "-G web", '{"op": "-U", "group": "web", "host": "a/b"}'):
+        with pytest.raises(ValueError):
+            parseBatchLine(line)
+
+
+def test_scope_helpers():
+    '''
+    Test parseScope() and scopedInventory() narrowing inventory to groups and their child groups.
+    '''
+
+    assert parseScope(None) is None
+    assert parseScope(" , ") is None
+    assert parseScope("web, db,") == ['web', 'db']
+
+    inventory = {'all':   {'hosts': [], 'vars': {}, 'children': ['web']},
+                 'web':   {'hosts': ['web1'], 'vars': {'ntp': 'a'}, 'children': ['front']},
+                 'front': {'hosts': ['front1'], 'vars': {}},
+                 'db':    {'hosts': ['db1', 'web1'], 'vars': {}},
+                 '_meta': {'hostvars': {'web1': {'x': '1'}, 'db1': {'x': '2'}, 'front1': {}}}}
+
+    scoped = scopedInventory(inventory, ['web'])
+
+    assert scoped['web']['hosts'] == ['web1']
+    assert scoped['front']['hosts'] == ['front1']
+    assert scoped['db']['hosts'] == ['web1']
+    assert scoped['web']['vars'] == {'ntp': 'a'}
+    assert scoped['_meta']['hostvars'] == {'web1': {'x': '1'}, 'front1': {}}
+    assert scopedInventory(inventory, ['nogroup'])['_meta']['hostvars'] == {}
+
+    tree = buildGroupTree({'web': {'vars': {}, 'children': ['front']}})
+    assert scopeGroupList(tree, ['web']) == ['front', 'web']
+    assert scopeHostSet({'web': ['web1'], 'front': ['front1'], 'db': ['db1']}, tree, ['web']) == set(['web1', 'front1'])
+
+
+def storeValue(zk, path, raw):
+    '''
+    Store raw bytes into znode path through the value codec.
+
+    Return stored data.
+    '''
+
+    stat   = zk.exists(path)
+    chunks = valueChunks(zk.get(path)[0]) if stat else []
+    commitOrRaise(zk, valueOps(path, raw, stat is not None, -1, chunks))
+    return zk.get(path)[0]
+
+
+def test_value_codec_round_trip(stubZk, monkeypatch):
+    '''
+    Test valueOps() and decodeValues() with plain, compressed, chunked and marker-prefixed values.
+    '''
+
+    monkeypatch.setattr(cfg, 'valueCompressMin', 64)
+    monkeypatch.setattr(cfg, 'valueChunkBytes', 1024)
+    stubZk.ensure_path('/v')
+
+    plain      = b'10.1.1.1'
+    compressed = b'ntp ' * 200
+    noise      = random.Random(1)
+    chunked    = bytes(bytearray(noise.getrandbits(8) for number in range(5000)))
+    marked     = b'\xffzbinary'
+
+    assert storeValue(stubZk, '/v/plain', plain) == plain
+    assert storeValue(stubZk, '/v/compressed', compressed).startswith(b'\xffz')
+    assert storeValue(stubZk, '/v/chunked', chunked).startswith(b'\xffc')
+    assert storeValue(stubZk, '/v/marked', marked).startswith(b'\xffr')
+    assert len(stubZk.get_children('/v/chunked')) == 5
+
+    stored = dict((path, stubZk.get(path)[0]) for path in ('/v/plain', '/v/compressed', '/v/chunked', '/v/marked'))
+    values = decodeValues(stubZk, stored)
+
+    assert values['/v/plain'] == (plain, [])
+    assert values['/v/compressed'] == (compressed, [])
+    assert values['/v/chunked'][0] == chunked and len(values['/v/chunked'][1]) == 5
+    assert values['/v/marked'] == (marked, [])
+
+    ## chunks of the previous value are deleted with the new one
+    storeValue(stubZk, '/v/chunked', plain)
+    assert stubZk.get_children('/v/chunked') == []
+    assert decodeValues(stubZk, {'/v/chunked': stubZk.get('/v/chunked')[0]})['/v/chunked'] == (plain, [])
+
+
+def test_value_codec_legacy_values(stubZk):
+    '''
+    Test decodeValues() with values written before the value codec which start with the value marker.
+    '''
+
+    legacy = {'/plain': b'\xff\xfelegacy', '/notzlib': b'\xffzlegacy', '/notmanifest': b'\xffc{legacy'}
+
+    for path, data in legacy.items():
+        stubZk.create(path, data)
+
+    values = decodeValues(stubZk, legacy)
+
+    assert dict((path, value[0]) for path, value in values.items()) == legacy
+
+
+def test_binary_inventory_round_trip(stubZk, tmp_path):
+    '''
+    Test exportToBinary() followed by lookups in the binary file, and truncated or corrupt files.
+    '''
+
+    binPath = str(tmp_path / "inventory.akb")
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'host'}}})
+    addHostWithHostvars({'web': {'web2': {}}})
+    addHostWithHostvars({'db': {'db1': {'port': '5432'}}})
+    setGroupVars({'web': {'ntp': 'group', 'dns': 'group'}})
+    addChildGroup(splitZnodeString('dmz:web'))
+
+    assert exportToBinary(binPath).startswith("Exported inventory")
+
+    assert binaryHostAccess('web1', binPath) == ansibleHostAccess('web1')
+    assert binaryHostAccess('web1', binPath, effective=True) == ansibleHostAccess('web1', effective=True)
+    assert binaryHostAccess('db1', binPath) == {'port': '5432'}
+    assert binaryHostAccess('nohost', binPath).startswith("ERROR  ==> no such host")
+    assert sorted(binaryShowHostVars(splitZnodeString('dmz'), binPath)) == ['web1', 'web2']
+
+    with openBinaryInventory(binPath) as inventory:
+        assert sorted(inventory.iterGroups()) == [('db', ['db1']), ('dmz', []), ('web', ['web1', 'web2'])]
+        assert sorted(host for host, groups, varDict in inventory.iterHosts()) == ['db1', 'web1', 'web2']
+
+    with open(binPath, 'rb') as f:
+        data = f.read()
+
+    header  = list(BinaryInventory.HEADER.unpack_from(data, 0))
+    corrupt = {'truncated': data[:len(data) // 2],
+               'header': data[:BinaryInventory.HEADER.size - 1],
+               'offset': BinaryInventory.HEADER.pack(*(header[:11] + [len(data) * 2] + header[12:])) + data[BinaryInventory.HEADER.size:]}
+
+    for name, content in corrupt.items():
+        path = tmp_path / name
+        path.write_bytes(content)
+        assert openBinaryInventory(str(path)).startswith("ERROR  ==> could not read binary inventory")
+        assert binaryHostAccess('web1', str(path)).startswith("ERROR  ==> could not read binary inventory")
+
+
+def test_binary_inventory_shared_name(stubZk, tmp_path):
+    '''
+    Test exportToBinary() with a host and a group of the same name.
+    '''
+
+    binPath = str(tmp_path / "inventory.akb")
+
+    addHostWithHostvars({'web': {'db': {'ntp': 'a'}}})
+    addHostWithHostvars({'db': {'a1': {'ntp': 'b'}}})
+
+    assert exportToBinary(binPath).startswith("Exported inventory")
+
+    with openBinaryInventory(binPath) as inventory:
+        assert inventory.hostGroups(inventory.host('db')[1]) == ['web']
+        assert inventory.groupMembers(inventory.group('db')[1]) == ['a1']
+        assert sorted((host, groups) for host, groups, varDict in inventory.iterHosts()) == [('a1', ['db']), ('db', ['web'])]
+
+
+
+def test_binary_inventory_import_member_without_host(stubZk, monkeypatch, tmp_path):
+    '''
+    Test importFromBinary() into an empty inventory adds group members without host record to groups only.
+    '''
+
+    binPath = str(tmp_path / "inventory.akb")
+
+    addHostWithHostvars({'web': {'web1': {'ntp': 'a'}}})
+    stubZk.create("{}/groups/web/ghost".format(cfg.aPath))
+
+    assert exportToBinary(binPath).startswith("Exported inventory")
+
+    target = StubZk()
+    useClient(monkeypatch, target)
+
+    assert importFromBinary(binPath).startswith("Imported inventory")
+    assert sorted(target.get_children("{}/groups/web".format(cfg.aPath))) == ['ghost', 'web1']
+    assert target.get_children("{}/hosts".format(cfg.aPath)) == ['web1']
+    assert fetchHostVars(target, ['web1'])['web1'] == {'ntp': 'a'}
+
+
+def test_plugin_restores_cfg(stubZk, monkeypatch):
+    '''
+    Test that the inventory plugin does not leak its source options into ansibleKeeper.cfg.
+    '''
+
+    import ansibleKeeper
+    pytest.importorskip('ansible')
+    from ansible_keeper import InventoryModule
+
+    seen    = []
+    options = {'zk_servers': 'zk-other:2181', 'path': '/ansible-other', 'fanout': 3, 'use_snapshot': True, 'groups': None}
+    before  = (cfg.zkServers, cfg.aPath, cfg.readFanout, cfg.useSnapshot)
+
+    def readInventory(scope=None):
+        seen.append((cfg.zkServers, cfg.aPath, cfg.readFanout, cfg.useSnapshot))
+        return {'_meta': {'hostvars': {}}}
+
+    monkeypatch.setattr(ansibleKeeper, 'readAnsibleInventory', readInventory)
+
+    plugin = InventoryModule()
+    monkeypatch.setattr(plugin, 'get_option', options.get)
+
+    assert plugin.readKeeperInventory() == {'_meta': {'hostvars': {}}}
+    assert seen == [('zk-other:2181', '/ansible-other', 3, True)]
+    assert (cfg.zkServers, cfg.aPath, cfg.readFanout, cfg.useSnapshot) == before
+
+
 if __name__ == "__main__": 
     test_import_export_ini()